@@ -0,0 +1,177 @@
+from collections import deque, OrderedDict
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import path
+from singleton_type import SingletonType
+from threading import Condition
+from time import monotonic
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# files and bytes being signed at the same time
+MAX_FILES = MyConfigLoader().get_admission_config()["max_files"]
+MAX_BYTES = MyConfigLoader().get_admission_config()["max_bytes"]
+# batches are admitted this many files at a time
+CHUNK_FILES = MyConfigLoader().get_admission_config()["chunk_files"]
+# waiting requests before new ones are refused at once
+MAX_WAITING = MyConfigLoader().get_admission_config()["max_waiting"]
+# seconds a new request may wait for its turn
+MAX_WAIT = MyConfigLoader().get_admission_config()["max_wait"]
+# Retry-After hint of refused requests, in seconds
+RETRY_AFTER = MyConfigLoader().get_admission_config()["retry_after"]
+# size assumed for http:// files, unknown before download
+URL_FILE_BYTES = MyConfigLoader().get_admission_config()["url_file_bytes"]
+####################################################################
+
+
+logger = get_logger("admission")
+
+
+# custom exceptions
+class AdmissionRejected(Exception):
+    ''' Raised when the server is too busy to accept a request '''
+
+    def __init__(self, message, retry_after=RETRY_AFTER):
+        super().__init__(message, retry_after)
+        self.message = message
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return self.message
+
+
+class _Waiter:
+    def __init__(self, files, nbytes):
+        self.files = files
+        self.nbytes = nbytes
+        self.admitted = False
+
+
+class AdmissionController(object, metaclass=SingletonType):
+    ''' Bounds the files and bytes in flight on the smart card
+
+        Requests over the limits wait in one FIFO queue per user, the
+        queues are served round robin: a user with a huge batch (admitted
+        `CHUNK_FILES` at a time) can not starve the short requests of the
+        others.
+
+        A request is always admitted by an idle server, even over the
+        limits: a single file bigger than `MAX_BYTES` can not be split and
+        would wait forever. It runs alone, nothing else fits until it is
+        released.
+    '''
+
+    def __init__(self):
+        self._condition = Condition()
+        self._files = 0
+        self._bytes = 0
+        # user_id: deque of _Waiter, in round robin order
+        self._queues = OrderedDict()
+        self._waiting = 0
+
+    def acquire(self, user_id, files, nbytes, timeout=None):
+        ''' Wait for room for `files` and `nbytes`. Raise an `AdmissionRejected`
+
+            Param:
+                timeout: seconds to wait, forever when None
+        '''
+
+        with self._condition:
+            if not self._queues and self._fits(files, nbytes):
+                self._take(files, nbytes)
+                return
+            if timeout is not None and self._waiting >= MAX_WAITING:
+                raise AdmissionRejected(f"{self._waiting} requests already waiting")
+
+            waiter = _Waiter(files, nbytes)
+            self._queues.setdefault(user_id, deque()).append(waiter)
+            self._waiting += 1
+            self._dispatch()
+            deadline = None if timeout is None else monotonic() + timeout
+            try:
+                while not waiter.admitted:
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise AdmissionRejected(f"not admitted within {timeout}s")
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting -= 1
+                if not waiter.admitted:
+                    self._remove(user_id, waiter)
+
+    def release(self, files, nbytes):
+        with self._condition:
+            self._files -= files
+            self._bytes -= nbytes
+            self._dispatch()
+
+    def in_flight(self):
+        with self._condition:
+            return self._files, self._bytes, self._waiting
+
+    def _fits(self, files, nbytes):
+        # anything fits an idle server, or an oversized request would wait
+        # forever: it runs alone, the limits keep the others out meanwhile
+        if self._files == 0:
+            return True
+        return self._files + files <= MAX_FILES and self._bytes + nbytes <= MAX_BYTES
+
+    def _take(self, files, nbytes):
+        self._files += files
+        self._bytes += nbytes
+
+    def _dispatch(self):
+        ''' Admit queue heads round robin while they fit '''
+
+        admitted = False
+        progress = True
+        while progress and self._queues:
+            progress = False
+            for user_id in list(self._queues):
+                queue = self._queues[user_id]
+                waiter = queue[0]
+                if not self._fits(waiter.files, waiter.nbytes):
+                    continue
+                self._take(waiter.files, waiter.nbytes)
+                waiter.admitted = True
+                admitted = progress = True
+                queue.popleft()
+                # served users go to the back of the line
+                del self._queues[user_id]
+                if queue:
+                    self._queues[user_id] = queue
+        if admitted:
+            self._condition.notify_all()
+
+    def _remove(self, user_id, waiter):
+        queue = self._queues.get(user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        if not queue:
+            del self._queues[user_id]
+        # a big head removed may let smaller ones in
+        self._dispatch()
+
+
+def file_bytes(file_path):
+    ''' Size of a file to sign, as counted by the admission control '''
+
+    if file_path.startswith("http://"):
+        return URL_FILE_BYTES
+    try:
+        return path.getsize(file_path)
+    except OSError:
+        logger.warning(f"can not get the size of {file_path}")
+        return 0
+
+
+def chunks(items):
+    ''' Split a batch in the parts admitted one at a time '''
+    return [items[start:start + CHUNK_FILES] for start in range(0, len(items), CHUNK_FILES)]
@@ -0,0 +1,292 @@
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime
+from hashlib import sha256
+from json import dumps, load
+from os import path
+from platform import platform, python_version
+from statistics import mean, quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter, perf_counter_ns
+import sys
+import tracemalloc
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# synthetic pdf of the base case, the others change one dimension
+BASE_PDF = {"pages": 1, "size": 16 * 1024, "signatures": 0}
+VARIATIONS = {
+    "pages": (10, 100),
+    "size": (1024 ** 2, 8 * 1024 ** 2),
+    "signatures": (1, 4),
+}
+QUICK_VARIATIONS = {
+    "pages": (10,),
+    "size": (1024 ** 2,),
+    "signatures": (2,),
+}
+# p7m content sizes
+P7M_SIZES = (16 * 1024, 1024 ** 2, 8 * 1024 ** 2)
+QUICK_P7M_SIZES = (16 * 1024, 1024 ** 2)
+SIG_ATTRIBUTES = {"visibility": "visible", "text_template": "", "p7m_sig_type": "",
+                  "position": {"page": "n", "width": 200.0, "height": 60.0,
+                               "padding_width": 75.0, "padding_height": 670.0}}
+# "X" * 15 skips the owner check
+USER_CF = "X" * 15
+# ops/s drop against the baseline reported as a regression
+TOLERANCE = 0.15
+####################################################################
+
+
+def synthetic_pdf(pages, size, signatures=0, session=None):
+    ''' A pdf of `pages` pages, padded to about `size` bytes with page
+        content, signed `signatures` times with `session`
+    '''
+
+    objects = [b"<</Type/Catalog/Pages 2 0 R>>", None, b"<</Producer(digiSign benchmark)>>"]
+    kids = []
+    padding = max(0, size - 200 * pages) // pages
+    for page in range(pages):
+        text = b"BT /F1 12 Tf 72 720 Td (page %d) Tj ET\n" % (page + 1)
+        # comments are valid content and compress like nothing
+        text += b"%" + b"x" * max(0, padding - len(text) - 2) + b"\n"
+        objects.append(b"<</Length %d>>\nstream\n%b\nendstream" % (len(text), text))
+        kids.append(len(objects) + 1)
+        objects.append(b"<</Type/Page/Parent 2 0 R/MediaBox [0 0 612 792]/Contents %d 0 R>>"
+                       % len(objects))
+    objects[1] = b"<</Type/Pages/Kids[%b]/Count %d>>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), pages)
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, pdf_object in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%b\nendobj\n" % (number, pdf_object)
+    startxref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<</Size %d/Root 1 0 R/Info 3 0 R>>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, startxref)
+
+    for _ in range(signatures):
+        pdf += sign_pdf(pdf, session)
+    return pdf
+
+
+def sign_pdf(pdf, session):
+    ''' Incremental update signing `pdf` with the token of `session` '''
+
+    import pdf_builder
+    from signature_util import SignatureUtils
+
+    certificate = SignatureUtils.fetch_certificate(session)
+    certificate_value = SignatureUtils.get_certificate_value(session, certificate)
+    return pdf_builder.sign(pdf, session, certificate, certificate_value, "sha256", SIG_ATTRIBUTES)
+
+
+def measure(operation, iterations, warmup, min_time):
+    ''' Run `operation` at least `iterations` times and `min_time` seconds
+
+        Returns:
+            ops/s, latency percentiles in milliseconds and the peak of the
+            memory allocated by one run
+    '''
+
+    for _ in range(warmup):
+        operation()
+
+    samples = []
+    start = perf_counter()
+    while len(samples) < iterations or perf_counter() - start < min_time:
+        begin = perf_counter_ns()
+        operation()
+        samples.append(perf_counter_ns() - begin)
+    total = sum(samples) / 1e9
+
+    # apart from the timed runs, tracemalloc slows them down
+    tracemalloc.start()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    milliseconds = [sample / 1e6 for sample in samples]
+    cuts = quantiles(milliseconds, n=100, method="inclusive") if len(samples) > 1 else milliseconds * 99
+    return {
+        "iterations": len(samples),
+        "ops_per_second": round(len(samples) / total, 3),
+        "latency_ms": {
+            "min": round(min(milliseconds), 3),
+            "mean": round(mean(milliseconds), 3),
+            "p50": round(cuts[49], 3),
+            "p90": round(cuts[89], 3),
+            "p99": round(cuts[98], 3),
+            "max": round(max(milliseconds), 3),
+        },
+        "peak_memory_bytes": peak,
+    }
+
+
+def cases(session, workdir, quick=False):
+    ''' (name, parameters, operation) of every benchmark '''
+
+    from digiSign_lib import DigiSignLib
+    from p7m_encoder import P7mAttributes, P7mEncoder
+    from signature_util import SignatureUtils
+    from verify import verify
+
+    certificate = SignatureUtils.fetch_certificate(session)
+    certificate_value = SignatureUtils.get_certificate_value(session, certificate)
+    issuer = SignatureUtils.get_certificate_issuer(session, certificate)
+    serial_number = SignatureUtils.get_certificate_serial_number(session, certificate)
+
+    variations = QUICK_VARIATIONS if quick else VARIATIONS
+    pdf_parameters = [dict(BASE_PDF)]
+    for dimension, values in variations.items():
+        pdf_parameters += [{**BASE_PDF, dimension: value} for value in values]
+
+    for parameters in pdf_parameters:
+        pdf = synthetic_pdf(session=session, **parameters)
+        yield ("pdf_builder.sign", parameters,
+               lambda pdf=pdf: sign_pdf(pdf, session))
+        signed_pdf = pdf + sign_pdf(pdf, session)
+        # every signature is verified, the new one included
+        yield ("verify.verify", {**parameters, "signatures": parameters["signatures"] + 1},
+               lambda signed_pdf=signed_pdf: verify(signed_pdf, [certificate_value]))
+
+    # a signature of the right size, encoding does not check it
+    signature = bytes(256)
+    for size in QUICK_P7M_SIZES if quick else P7M_SIZES:
+        content = bytes(size)
+        file_path = path.join(workdir, f"document_{size}.txt")
+        with open(file_path, "wb") as _file:
+            _file.write(content)
+
+        def encode(content=content):
+            content_digest = sha256(content).digest()
+            certificate_digest = sha256(certificate_value).digest()
+            signed_attributes = P7mEncoder.encode_signed_attributes(content_digest, certificate_digest)
+            P7mEncoder.bytes_to_sign(content_digest, certificate_digest)
+            signer_info = P7mEncoder.encode_signer_info(issuer, serial_number, signed_attributes,
+                                                        signature, b"")
+            return P7mEncoder.make_a_p7m(content, certificate_value, signer_info,
+                                         P7mAttributes(b"", b"", b""))
+
+        yield ("P7mEncoder", {"size": size}, encode)
+        yield ("DigiSignLib.sign_p7m", {"size": size},
+               lambda file_path=file_path: DigiSignLib.sign_p7m(file_path, session, USER_CF,
+                                                                SIG_ATTRIBUTES))
+
+
+def run(session, token, iterations, warmup, min_time, quick=False, only=None, progress=None):
+    ''' Run the benchmarks, `only` the ones whose name contains it
+
+        Returns:
+            the report: environment and one result per benchmark
+    '''
+
+    results = []
+    with TemporaryDirectory(prefix="digisign-benchmark-") as workdir:
+        for name, parameters, operation in cases(session, workdir, quick):
+            if only and only not in name:
+                continue
+            result = {"name": name, "parameters": parameters,
+                      **measure(operation, iterations, warmup, min_time)}
+            results.append(result)
+            if progress is not None:
+                progress(result)
+    return {
+        "environment": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": python_version(),
+            "platform": platform(),
+            "token": token,
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    ''' Benchmarks of `report` slower than in `baseline` by more than `tolerance`
+
+        Returns:
+            a list of {name, parameters, baseline_ops_per_second, ops_per_second, change}
+    '''
+
+    previous = {(item["name"], dumps(item["parameters"], sort_keys=True)): item
+                for item in baseline["results"]}
+    regressions = []
+    for item in report["results"]:
+        old = previous.get((item["name"], dumps(item["parameters"], sort_keys=True)))
+        if old is None or not old["ops_per_second"]:
+            continue
+        change = item["ops_per_second"] / old["ops_per_second"] - 1
+        if change < -tolerance:
+            regressions.append({"name": item["name"], "parameters": item["parameters"],
+                                "baseline_ops_per_second": old["ops_per_second"],
+                                "ops_per_second": item["ops_per_second"],
+                                "change": round(change, 3)})
+    return regressions
+
+
+def pkcs11_session(library, pin):
+    ''' Logged in session on the first token of a PKCS#11 `library`, e.g. SoftHSM.
+        The token needs two certificates, the second one with its key, as the smart cards
+    '''
+
+    from PyKCS11 import PyKCS11Lib, CKF_SERIAL_SESSION, CKF_RW_SESSION
+
+    pkcs11 = PyKCS11Lib()
+    pkcs11.load(library)
+    slot = pkcs11.getSlotList(tokenPresent=True)[0]
+    session = pkcs11.openSession(slot, CKF_SERIAL_SESSION | CKF_RW_SESSION)
+    session.login(pin)
+    return session
+
+
+def _progress(result):
+    print(f"{result['name']} {dumps(result['parameters'])}: {result['ops_per_second']} ops/s, "
+          f"p50 {result['latency_ms']['p50']} ms, p99 {result['latency_ms']['p99']} ms, "
+          f"peak {result['peak_memory_bytes'] // 1024} KiB", file=sys.stderr, flush=True)
+
+
+####################################################################
+#       CLI                                                        #
+####################################################################
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark signing and verification with a software token")
+    parser.add_argument("--pkcs11-lib", help="PKCS#11 library (SoftHSM), the pure Python mock when missing")
+    parser.add_argument("--pin", default="1234")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds per benchmark")
+    parser.add_argument("--quick", action="store_true", help="fewer pdf and p7m variations")
+    parser.add_argument("--only", help="run the benchmarks whose name contains this")
+    parser.add_argument("--output", help="JSON report, stdout when missing")
+    parser.add_argument("--baseline", help="JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    if args.pkcs11_lib:
+        session, token = pkcs11_session(args.pkcs11_lib, args.pin), args.pkcs11_lib
+    else:
+        from mock_pkcs11 import MockSession
+        session, token = MockSession(), "mock"
+
+    # the libraries print, stdout is kept for the report
+    with redirect_stdout(sys.stderr):
+        report = run(session, token, args.iterations, args.warmup, args.min_time,
+                     args.quick, args.only, _progress)
+
+    if args.baseline:
+        with open(args.baseline) as _file:
+            report["regressions"] = compare(report, load(_file), args.tolerance)
+
+    if args.output:
+        with open(args.output, "w") as _file:
+            _file.write(dumps(report, indent=2))
+    else:
+        print(dumps(report, indent=2))
+    sys.exit(1 if report.get("regressions") else 0)
@@ -0,0 +1,293 @@
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from json import dumps, load, dump
+from mmap import mmap, ACCESS_READ
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger, log_queue, use_log_queue
+from os import cpu_count, path, walk, remove, replace
+from time import perf_counter
+import sys
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# verification processes, 0 for one per CPU
+WORKERS = MyConfigLoader().get_verify_config()["bulk_workers"] or cpu_count()
+# files sent to the workers ahead of the results written
+IN_FLIGHT_PER_WORKER = 4
+# results written between two checkpoints
+CHECKPOINT_EVERY = MyConfigLoader().get_verify_config()["checkpoint_every"]
+# seconds between two throughput reports
+REPORT_INTERVAL = 10
+PDF_EXTENSIONS = (".pdf",)
+P7M_EXTENSIONS = (".p7m",)
+####################################################################
+
+
+logger = get_logger("bulk_verify")
+
+# certificates trusted by the worker process, besides the trust store ones
+_trusted = None
+
+
+class BulkVerifyStats(object):
+    ''' Throughput of a bulk verification '''
+
+    def __init__(self, skipped=0):
+        self.start = perf_counter()
+        self.skipped = skipped
+        self.files = 0
+        self.bytes = 0
+        self.valid = 0
+        self.invalid = 0
+        self.errors = 0
+        # valid files with a signature of unknown revocation status
+        self.revocation_unknown = 0
+
+    def add(self, result):
+        self.files += 1
+        self.bytes += result["bytes"]
+        if result["error"] is not None:
+            self.errors += 1
+        elif result["valid"]:
+            self.valid += 1
+            if any(signature.get("revocationok?", True) is None for signature in result["signatures"]):
+                self.revocation_unknown += 1
+        else:
+            self.invalid += 1
+
+    def as_dict(self):
+        seconds = perf_counter() - self.start
+        return {
+            "files": self.files,
+            "skipped": self.skipped,
+            "valid": self.valid,
+            "invalid": self.invalid,
+            "errors": self.errors,
+            "revocation_unknown": self.revocation_unknown,
+            "bytes": self.bytes,
+            "seconds": round(seconds, 3),
+            "files_per_second": round(self.files / seconds, 2) if seconds else 0.0,
+            "mb_per_second": round(self.bytes / seconds / 2 ** 20, 2) if seconds else 0.0,
+        }
+
+
+def iter_files(paths):
+    ''' Signed documents of `paths`, files and directories walked in name order '''
+
+    for item in paths:
+        if path.isdir(item):
+            for folder, folders, files in walk(item):
+                folders.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(PDF_EXTENSIONS + P7M_EXTENSIONS):
+                        yield path.join(folder, name)
+        else:
+            yield item
+
+
+def verify_file(file_path, file_name=None):
+    ''' Verify every signature of a pdf or p7m file, memory mapped
+
+        Param:
+            file_name: reported instead of `file_path`, an uploaded file name
+
+        Returns:
+            {file, type, bytes, valid, signatures, error, seconds}
+    '''
+
+    start = perf_counter()
+    result = _new_result(file_name or file_path)
+    try:
+        with open(file_path, "rb") as _file:
+            result["bytes"] = path.getsize(file_path)
+            if result["bytes"] == 0:
+                raise ValueError("empty file")
+            with mmap(_file.fileno(), 0, access=ACCESS_READ) as content:
+                _verify(result, content)
+    except Exception as err:
+        result["error"] = f"{err.__class__.__name__} {err}"
+    result["seconds"] = round(perf_counter() - start, 4)
+    return result
+
+
+def _new_result(file_name):
+    return {"file": file_name, "type": None, "bytes": 0, "valid": False,
+            "signatures": [], "error": None}
+
+
+def _verify(result, content):
+    # imported by the workers only
+    from verify import verify, verify_p7m
+
+    if file_type(result["file"], content) == "p7m":
+        result["type"] = "p7m"
+        result["signatures"] = verify_p7m(content, _trusted)
+    else:
+        result["type"] = "pdf"
+        result["signatures"] = verify(content, _trusted)
+    if not result["signatures"]:
+        raise ValueError("no signature found")
+    result["valid"] = all(signature_valid(item) for item in result["signatures"])
+
+
+def signature_valid(signature):
+    ''' Whether every check of a verification result passed. An unknown
+        revocation status (no up to date CRL) is not a failure, only a
+        revoked certificate is
+    '''
+
+    return signature["hashok?"] and signature["signatureok?"] and signature["certok?"] \
+        and signature.get("revocationok?") is not False
+
+
+def file_type(file_name, content):
+    ''' "pdf" or "p7m", from the name and the first bytes of `content` '''
+
+    head = content[:1024]
+    # DER or PEM CMS, a p7m of a pdf holds a pdf header too
+    if head[:1] == b"\x30" or head.startswith(b"-----BEGIN"):
+        return "p7m"
+    if head.find(b"%PDF-") != -1:
+        return "pdf"
+    return "p7m" if file_name.lower().endswith(P7M_EXTENSIONS) else "pdf"
+
+
+def bulk_verify(paths, output, checkpoint=None, workers=WORKERS, trusted=None, report=None):
+    ''' Verify the signed documents of `paths` in a process pool, one JSON
+        result per line written to `output` in the order of `paths`
+
+        Param:
+            paths: iterable of files and directories
+            output: JSON Lines file path, stdout when None
+            checkpoint: JSON file of the progress, the run resumes from it
+                when present. Needs `output`
+            workers: verification processes
+            trusted: DER certificates trusted besides the trust store ones
+            report: callable(stats dict) called every `REPORT_INTERVAL` seconds
+
+        Returns:
+            the final stats dict
+    '''
+
+    done, offset = _read_checkpoint(checkpoint) if checkpoint is not None else (0, 0)
+    if output is None:
+        if checkpoint is not None:
+            raise ValueError("a checkpoint needs an output file")
+        out = sys.stdout
+    else:
+        if done and (not path.exists(output) or path.getsize(output) < offset):
+            # the results of the checkpoint are lost, truncate() would pad with NUL bytes
+            logger.warning(f"{output} missing or shorter than the checkpoint, starting over")
+            remove(checkpoint)
+            done, offset = 0, 0
+        out = open(output, "r+" if done else "w")
+        # lines written after the checkpoint are written again
+        out.seek(offset)
+        out.truncate()
+
+    stats = BulkVerifyStats(skipped=done)
+    files = iter_files(paths)
+    for _ in range(done):
+        next(files, None)
+
+    last_report = perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_worker_init,
+                                 initargs=(trusted, log_queue())) as pool:
+            pending = deque()
+            for file_path in files:
+                pending.append(pool.submit(verify_file, file_path))
+                # bounded, millions of files are never all queued
+                while len(pending) >= workers * IN_FLIGHT_PER_WORKER:
+                    done = _write(pending.popleft().result(), out, stats, done, checkpoint)
+                if report is not None and perf_counter() - last_report > REPORT_INTERVAL:
+                    report(stats.as_dict())
+                    last_report = perf_counter()
+            while pending:
+                done = _write(pending.popleft().result(), out, stats, done, checkpoint)
+        out.flush()
+        if checkpoint is not None:
+            _write_checkpoint(checkpoint, done, out.tell())
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return stats.as_dict()
+
+
+def _write(result, out, stats, done, checkpoint):
+    out.write(dumps(result) + "\n")
+    stats.add(result)
+    done += 1
+    if checkpoint is not None and done % CHECKPOINT_EVERY == 0:
+        out.flush()
+        _write_checkpoint(checkpoint, done, out.tell())
+    return done
+
+
+def _read_checkpoint(checkpoint):
+    ''' Returns the files already verified and the output size they fill '''
+
+    if not path.exists(checkpoint):
+        return 0, 0
+    with open(checkpoint) as _file:
+        progress = load(_file)
+    logger.info(f"resuming after {progress['done']} files")
+    return progress["done"], progress["output_bytes"]
+
+
+def _write_checkpoint(checkpoint, done, output_bytes):
+    temp_path = f"{checkpoint}.part"
+    with open(temp_path, "w") as _file:
+        dump({"done": done, "output_bytes": output_bytes}, _file)
+    replace(temp_path, checkpoint)
+
+
+def _worker_init(trusted, log_queue):
+    global _trusted
+    use_log_queue(log_queue)
+    _trusted = trusted
+    # one trust store per worker, loaded before the first file
+    from trust_store import TrustStore
+    TrustStore().load()
+
+
+def _read_lines(file_path):
+    with open(file_path) as _file:
+        for line in _file:
+            if line.strip():
+                yield line.strip()
+
+
+def _report(stats):
+    print(dumps(stats), file=sys.stderr, flush=True)
+
+
+####################################################################
+#       CLI                                                        #
+####################################################################
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Verify the signatures of signed pdf and p7m files")
+    parser.add_argument("paths", nargs="*", help="files and directories")
+    parser.add_argument("--files-from", help="file with one path per line")
+    parser.add_argument("--output", help="JSON Lines results, stdout when missing")
+    parser.add_argument("--checkpoint", help="progress file, the run resumes from it")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--trusted", nargs="*", default=[], help="DER certificates to trust")
+    args = parser.parse_args()
+
+    paths = args.paths
+    if args.files_from:
+        paths = chain(paths, _read_lines(args.files_from))
+    trusted = []
+    for cert_path in args.trusted:
+        with open(cert_path, "rb") as _file:
+            trusted.append(_file.read())
+
+    stats = bulk_verify(paths, args.output, args.checkpoint, args.workers, trusted or None, _report)
+    _report(stats)
+    sys.exit(1 if stats["invalid"] or stats["errors"] else 0)
@@ -0,0 +1,106 @@
+from json import load
+from my_config_loader import MyConfigLoader, BASE_PATH
+from my_logger import get_logger
+from os import path, stat
+from threading import Lock
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# never open a window: unattended batch signing and servers. Always set
+# by the production server, a popup would hold a request for GUI_TIMEOUT
+HEADLESS = MyConfigLoader().get_credentials_config()["headless"]
+# asked in order whether to sign with an expired certificate, the
+# first decision is taken: file, gui. Nobody deciding means no
+POLICY_PROVIDERS = MyConfigLoader().get_credentials_config()["policy_providers"]
+# pre-approved decisions:
+# {"allow_expired": false,
+#  "allow_expired_users": [codice fiscale, ...],
+#  "allow_expired_serials": [certificate serial number in hex, ...]}
+POLICY_FILE = path.join(BASE_PATH, MyConfigLoader().get_credentials_config()["policy_file"])
+# seconds before an unanswered popup is closed
+GUI_TIMEOUT = MyConfigLoader().get_credentials_config()["gui_timeout"]
+####################################################################
+
+
+logger = get_logger("certificate_policy")
+
+# (mtime, policy) of the policy file read last
+_policy_file = (None, None)
+_policy_lock = Lock()
+
+
+def expired_certificate_allowed(certificate_x509, user_cf):
+    ''' Whether to sign with the expired `certificate_x509` of `user_cf`,
+        asking the `POLICY_PROVIDERS` in order
+    '''
+
+    for name in POLICY_PROVIDERS:
+        if name not in _PROVIDERS:
+            logger.warning(f"unknown certificate policy provider {name}")
+            continue
+        try:
+            allowed = _PROVIDERS[name](certificate_x509, user_cf)
+        except Exception as err:
+            logger.warning(f"certificate policy provider {name} failed: {err.__class__.__name__} {err}")
+            continue
+        if allowed is not None:
+            logger.info(f"expired certificate {'allowed' if allowed else 'refused'} by {name}")
+            return allowed
+    logger.warning("no decision on the expired certificate, refused")
+    return False
+
+
+def certificate_not_valid_yet():
+    ''' Tell the user that the certificate is not valid yet, with a popup unless `HEADLESS` '''
+
+    logger.warning("Certificate not valid yet")
+    if not HEADLESS and "gui" in POLICY_PROVIDERS:
+        from digiSign_lib import DigiSignLib
+        DigiSignLib._not_valid_yet_popup(GUI_TIMEOUT)
+
+
+def _file_policy(certificate_x509, user_cf):
+    ''' Decision of `POLICY_FILE`, None when missing or not covering the certificate '''
+
+    policy = _load_policy()
+    if policy is None:
+        return None
+    serial = format(certificate_x509.get_serial_number(), "x")
+    if serial in [item.lower().lstrip("0") for item in policy.get("allow_expired_serials", [])]:
+        return True
+    if user_cf.upper() in [item.upper() for item in policy.get("allow_expired_users", [])]:
+        return True
+    return policy.get("allow_expired")
+
+
+def _gui_policy(certificate_x509, user_cf):
+    ''' Decision of the user in a popup, None in `HEADLESS` mode or when the popup is closed '''
+
+    if HEADLESS:
+        return None
+    from digiSign_lib import DigiSignLib
+    return DigiSignLib._proceed_with_expired_certificate(GUI_TIMEOUT)
+
+
+def _load_policy():
+    ''' Content of `POLICY_FILE`, read again when modified '''
+
+    global _policy_file
+    try:
+        mtime = stat(POLICY_FILE).st_mtime_ns
+    except OSError:
+        return None
+    with _policy_lock:
+        if _policy_file[0] != mtime:
+            with open(POLICY_FILE) as _file:
+                _policy_file = (mtime, load(_file))
+        return _policy_file[1]
+
+
+_PROVIDERS = {
+    "file": _file_policy,
+    "gui": _gui_policy,
+}
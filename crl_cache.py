@@ -0,0 +1,275 @@
+from asn1crypto import pem, x509 as asn1_x509
+from collections import namedtuple
+from cryptography import x509
+from datetime import datetime, timezone
+from hashlib import sha256
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import path, listdir, makedirs, replace, stat
+from singleton_type import SingletonType
+from threading import Lock
+from trust_store import TrustStore
+from uuid import uuid4
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+ENABLED = MyConfigLoader().get_crl_config()["enabled"]
+# CRLs, PEM or DER, one per issuer: the newest one wins. Only used once
+# verified with the issuer certificate, a trusted CA or one of the chain
+CRL_FOLDER = MyConfigLoader().get_crl_config()["crl_folder"]
+CRL_EXTENSIONS = (".crl", ".pem", ".der")
+# download a missing or expired CRL from the certificate distribution
+# points, kept only when signed by the issuer certificate
+FETCH = MyConfigLoader().get_crl_config()["fetch"]
+FETCH_TIMEOUT = MyConfigLoader().get_crl_config()["fetch_timeout"]
+####################################################################
+
+
+logger = get_logger("crl_cache")
+
+# serials: revoked serial numbers, the index of a lookup
+# crl: the parsed CRL while its signature is not verified, else None
+CrlEntry = namedtuple("CrlEntry", "serials this_update next_update file_path mtime crl")
+
+
+class CrlCache(object, metaclass=SingletonType):
+    ''' Revoked serial numbers of the CRLs of `CRL_FOLDER`, by issuer
+
+        Each CRL is parsed once into a set of serial numbers, so a lookup
+        is O(1) whatever the size of the CRL. A CRL past its next update
+        is read again when its file changed, or downloaded again with
+        `FETCH`. The folder is scanned again when files are added.
+
+        The signature of a CRL is verified when it is read, with the
+        trusted CA certificate of its issuer; a CRL of an intermediate
+        CA is verified with the issuer in the chain of the first
+        certificate checked against it. Unverified CRLs are never used.
+    '''
+
+    def __init__(self):
+        self.enabled = ENABLED
+        self._lock = Lock()
+        # issuer: CrlEntry
+        self._index = {}
+        # file path: mtime of the CRL files read
+        self._files = {}
+        self._folder_mtime = None
+
+    def load(self):
+        ''' Index the CRLs of `CRL_FOLDER`, only when the folder changed '''
+
+        if not self.enabled:
+            return
+        try:
+            folder_mtime = stat(CRL_FOLDER).st_mtime_ns
+        except OSError:
+            return
+        with self._lock:
+            if folder_mtime == self._folder_mtime:
+                return
+            self._folder_mtime = folder_mtime
+            for name in sorted(listdir(CRL_FOLDER)):
+                file_path = path.join(CRL_FOLDER, name)
+                if not name.lower().endswith(CRL_EXTENSIONS):
+                    continue
+                try:
+                    # the files already indexed are not parsed again
+                    if self._files.get(file_path) == stat(file_path).st_mtime_ns:
+                        continue
+                except OSError:
+                    continue
+                self._read(file_path)
+            logger.info(f"{len(self._index)} CRLs indexed")
+
+    def check(self, certificate, chain=()):
+        ''' Revocation status of an asn1crypto `certificate`
+
+            Param:
+                chain: DER certificates where to find the issuer, needed
+                    to trust a downloaded CRL
+
+            Returns:
+                True when not revoked, False when revoked, None when no
+                up to date CRL of the issuer is known
+        '''
+
+        self.load()
+        issuer = certificate.issuer.hashable
+        entry = self._fresh_entry(issuer)
+        if entry is not None and entry.crl is not None:
+            entry = self._verify_entry(entry, certificate, chain)
+        if entry is None and FETCH:
+            entry = self._fetch(certificate, chain)
+        if entry is None:
+            return None
+        return certificate.serial_number not in entry.serials
+
+    def _fresh_entry(self, issuer):
+        ''' CRL of `issuer` not past its next update, its file is read again when changed '''
+
+        with self._lock:
+            entry = self._index.get(issuer)
+            if entry is None:
+                return None
+            if entry.next_update is not None and entry.next_update < _now():
+                try:
+                    if stat(entry.file_path).st_mtime_ns != entry.mtime:
+                        self._read(entry.file_path)
+                        entry = self._index.get(issuer)
+                except OSError:
+                    pass
+            if entry.next_update is not None and entry.next_update < _now():
+                logger.info(f"CRL {entry.file_path} expired on {entry.next_update}")
+                return None
+            return entry
+
+    def _verify_entry(self, entry, certificate, chain):
+        ''' Verify the CRL of `entry` with the issuer of `certificate` in `chain`
+
+            Returns:
+                the verified CrlEntry, None when it can not be trusted
+        '''
+
+        issuer_certificate = _find_issuer(certificate, chain)
+        if issuer_certificate is None:
+            logger.info(f"CRL {entry.file_path} not verified, issuer certificate unknown")
+            return None
+        issuer = certificate.issuer.hashable
+        with self._lock:
+            if self._index.get(issuer) is not entry:
+                # read again or verified meanwhile
+                entry = self._index.get(issuer)
+                return entry if entry is not None and entry.crl is None else None
+            if not _signed_by(entry.crl, issuer_certificate):
+                logger.warning(f"CRL {entry.file_path} not signed by the issuer, discarded")
+                del self._index[issuer]
+                return None
+            entry = self._index[issuer] = entry._replace(crl=None)
+            return entry
+
+    def _read(self, file_path):
+        ''' Parse `file_path` into the index, skipped when unreadable, older
+            or not signed by its trusted issuer
+        '''
+
+        try:
+            with open(file_path, "rb") as _file:
+                mtime = stat(_file.fileno()).st_mtime_ns
+                crl = _load_crl(_file.read())
+            verified = _verify_trusted(crl)
+        except Exception as err:
+            logger.warning(f"CRL {file_path} skipped: {err.__class__.__name__} {err}")
+            return
+        if verified is False:
+            logger.warning(f"CRL {file_path} not signed by the issuer, skipped")
+            self._files[file_path] = mtime
+            return
+        self._add(crl, file_path, mtime, verified)
+
+    def _add(self, crl, file_path, mtime, verified=True):
+        self._files[file_path] = mtime
+        issuer = asn1_x509.Name.load(crl.issuer.public_bytes()).hashable
+        current = self._index.get(issuer)
+        if current is not None and current.file_path != file_path \
+                and current.this_update >= crl.last_update_utc:
+            return
+        self._index[issuer] = CrlEntry(frozenset(revoked.serial_number for revoked in crl),
+                                       crl.last_update_utc, crl.next_update_utc, file_path, mtime,
+                                       None if verified else crl)
+
+    def _fetch(self, certificate, chain):
+        ''' Download the CRL of `certificate` from its distribution points
+
+            Returns:
+                the new CrlEntry, None when none could be downloaded and trusted
+        '''
+
+        issuer_certificate = _find_issuer(certificate, chain)
+        if issuer_certificate is None:
+            logger.info("CRL not downloaded, issuer certificate unknown")
+            return None
+        # imported here, only a download needs it
+        from requests import get
+
+        for point in certificate.crl_distribution_points:
+            url = point.url
+            if url is None or not url.startswith(("http://", "https://")):
+                continue
+            try:
+                response = get(url, timeout=FETCH_TIMEOUT)
+                response.raise_for_status()
+                crl = _load_crl(response.content)
+                if not _signed_by(crl, issuer_certificate):
+                    logger.warning(f"CRL of {url} not signed by the issuer, discarded")
+                    continue
+            except Exception as err:
+                logger.warning(f"CRL download from {url} failed: {err.__class__.__name__} {err}")
+                continue
+            if crl.next_update_utc is not None and crl.next_update_utc < _now():
+                logger.warning(f"CRL of {url} already expired, discarded")
+                continue
+            return self._store(crl, response.content, certificate.issuer.hashable)
+        return None
+
+    def _store(self, crl, content, issuer):
+        ''' Save a downloaded CRL in `CRL_FOLDER` and index it '''
+
+        makedirs(CRL_FOLDER, exist_ok=True)
+        file_path = path.join(CRL_FOLDER, f"{sha256(issuer.encode()).hexdigest()[:32]}.crl")
+        temp_path = f"{file_path}.{uuid4().hex}.part"
+        with open(temp_path, "wb") as _file:
+            _file.write(content)
+        replace(temp_path, file_path)
+        with self._lock:
+            self._add(crl, file_path, stat(file_path).st_mtime_ns)
+            return self._index.get(issuer)
+
+
+def _load_crl(content):
+    if pem.detect(content):
+        return x509.load_pem_x509_crl(content)
+    return x509.load_der_x509_crl(content)
+
+
+def _verify_trusted(crl):
+    ''' Signature check of `crl` with the trusted CA certificates of its issuer
+
+        Returns:
+            True or False, None when its issuer is not a trusted CA
+    '''
+
+    verified = None
+    for ca_certificate in TrustStore().load():
+        ca_certificate = ca_certificate.to_cryptography()
+        if ca_certificate.subject != crl.issuer:
+            continue
+        # more certificates of the same CA after a key renewal
+        if _signed_by(crl, ca_certificate):
+            return True
+        verified = False
+    return verified
+
+
+def _signed_by(crl, issuer_certificate):
+    try:
+        return crl.is_signature_valid(issuer_certificate.public_key())
+    except Exception:
+        # key type not matching the signature
+        return False
+
+
+def _find_issuer(certificate, chain):
+    ''' cryptography certificate of the issuer of `certificate` among the DER `chain` '''
+
+    for cert_der in chain:
+        candidate = asn1_x509.Certificate.load(cert_der)
+        if candidate.subject.hashable == certificate.issuer.hashable:
+            return x509.load_der_x509_certificate(cert_der)
+    return None
+
+
+def _now():
+    return datetime.now(timezone.utc)
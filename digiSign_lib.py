@@ -1,14 +1,32 @@
 from asn1crypto import cms
+from certificate_policy import certificate_not_valid_yet, expired_certificate_allowed
 from datetime import datetime
+from hashlib import sha256
+from metrics import timed
 from mimetypes import MimeTypes
-from my_logger import MyLogger
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
 from OpenSSL import crypto
 from os import path
 from p7m_encoder import P7mEncoder, P7mAttributes
 from signature_util import SignatureUtils
-from tkinter import Tk, Label, Button, Frame
+from verifier import verify_digest
 from verify import verify
 import pdf_builder
+import pdf_signer
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# after signing a pdf: "signature" verifies the new signature only,
+# in memory; "audit" verifies every signature of the signed file
+POST_SIGN_VERIFICATION = MyConfigLoader().get_verify_config()["post_sign"]
+####################################################################
+
+
+logger = get_logger("digiSign_lib")
 
 
 
@@ -31,7 +49,6 @@ class CertificateOwnerException(Exception):
 
 
 class DigiSignLib():
-    PROCEED = None
 
     @staticmethod
     def get_smart_cards_sessions():
@@ -75,45 +92,84 @@ class DigiSignLib():
         certificate_value = SignatureUtils.get_certificate_value(
             open_session, certificate)
 
-        # check for signer identity
-        # if user_cf == "X" * 15, avoid this check
-        if user_cf != "X" * 15:
-            # only for REST calls
-            DigiSignLib()._check_certificate_owner(certificate_value, user_cf)
-
-        # check for certificate time validity
-        DigiSignLib()._check_certificate_validity(certificate_value)
+        DigiSignLib().check_certificate(certificate_value, user_cf)
 
-        MyLogger().my_logger().info(f"reading pdf file {file_path}")
+        logger.info(f"reading pdf file {file_path}")
         datau = open(file_path, 'rb').read()
-        datas = pdf_builder.sign(datau, open_session, certificate, certificate_value, 'sha256', sig_attributes)
+        pdfdata2, zeros, digest = pdf_builder.prepare(datau, certificate_value, 'sha256', sig_attributes)
+        try:
+            contents = pdf_signer.sign(None, open_session, certificate, certificate_value, 'sha256', True, digest)
+            datas = pdf_builder.finalize(pdfdata2, zeros, contents)
+        except Exception:
+            raise pdf_builder.PDFSigningError('error in the sign procedure')
+
+        DigiSignLib().check_signed_pdf(datau + datas, contents, digest, certificate_value)
 
         signed_file_path = DigiSignLib().get_signed_files_path(file_path, 'pdf')
 
-        MyLogger().my_logger().info(f"saving output to {signed_file_path}")
+        logger.info(f"saving output to {signed_file_path}")
         with open(signed_file_path, 'wb') as fp:
             fp.write(datau)
             fp.write(datas)
 
-        MyLogger().my_logger().info(f"verifying pdf signatures of {signed_file_path}")
-        try:
-            new_data = open(signed_file_path, 'rb').read()
+        return signed_file_path
+
+    @staticmethod
+    def check_signed_pdf(new_data, contents, digest, certificate_value):
+        ''' Post-sign verification of the signed pdf `new_data`, as `POST_SIGN_VERIFICATION`
+            says. Raise a `PdfVerificationError`
+
+            Param:
+                new_data: signed pdf content
+                contents: signature just embedded, CMS
+                digest: digest of the byte ranges it signs
+                certificate_value: signer certificate
+        '''
+
+        if POST_SIGN_VERIFICATION == "audit":
+            DigiSignLib.verify_pdf_content(new_data, certificate_value)
+        else:
+            DigiSignLib.verify_pdf_signature(contents, digest, certificate_value)
+
+    @staticmethod
+    def verify_pdf_content(new_data, certificate_value):
+        ''' Verify every signature of the signed pdf `new_data`. Raise a `PdfVerificationError` '''
+
+        with timed("verify"):
             results = verify(new_data, [certificate_value])
+        DigiSignLib._check_verify_results(results)
+
+    @staticmethod
+    def verify_pdf_signature(contents, digest, certificate_value):
+        ''' Verify the signature `contents` of the data with `digest`, in memory.
+            Raise a `PdfVerificationError`
+        '''
+
+        with timed("verify"):
+            results = verify_digest(contents, digest, [certificate_value])
+        DigiSignLib._check_verify_results(results)
+
+    @staticmethod
+    def _check_verify_results(results):
+        key = 0
+        try:
             for key, res in enumerate(results, start=1):
-                print('Signature %d: ' % key, res)
-                MyLogger().my_logger().info(f"Signature {key}: {res}")
+                logger.info(f"Signature {key}: {res}")
                 if not res['hashok?']:
                     raise PdfVerificationError(f"Hash verification of Signature {key} is failed.")
                 if not res['signatureok?']:
                     raise PdfVerificationError(f"Signature verification of Signature {key} is failed.")
                 if not res['certok?']:
                     # TODO verify certificates
-                    MyLogger().my_logger().error(f"Certificate verification of Signature {key} is failed.")
+                    logger.error(f"Certificate verification of Signature {key} is failed.")
+                if res.get('revocationok?') is False:
+                    raise PdfVerificationError(f"Certificate of Signature {key} is revoked.")
+                if res.get('revocationok?') is None and 'revocationok?' in res:
+                    logger.warning(f"Revocation status of Signature {key} is unknown.")
         except:
-            MyLogger().my_logger().error(f"Error during verification of Signature {key}:")
+            logger.error(f"Error during verification of Signature {key}:")
             raise
 
-        return signed_file_path
 
     @staticmethod
     def sign_p7m(file_path, open_session, user_cf, sig_attrs):
@@ -130,40 +186,62 @@ class DigiSignLib():
         sig_type = sig_attrs['p7m_sig_type']
         # fetching file content
         file_content = DigiSignLib().get_file_content(file_path)
-        # check existing signatures
-        p7m_attrs = P7mAttributes(b'', b'', b'')
-        mime = MimeTypes().guess_type(file_path)[0]
-        if mime == 'application/pkcs7':
-            info = cms.ContentInfo.load(file_content)
-            # retrieving existing signatures attributes
-            signed_data = info['content']
-            p7m_attrs.algos = signed_data['digest_algorithms'].contents
-            p7m_attrs.certificates = signed_data['certificates'].contents
-            #
-            if sig_type == 'parallel':
-                p7m_attrs.signer_infos = signed_data['signer_infos'].contents
-                file_content = signed_data['encap_content_info'].native['content']
-
-        # hashing file content
-        file_content_digest = SignatureUtils().digest(open_session, file_content)
 
         # fetching smart card certificate
         certificate = SignatureUtils().fetch_certificate(open_session)
         # getting certificate value
         certificate_value = SignatureUtils().get_certificate_value(
             open_session, certificate)
-        # hashing certificate value
-        certificate_value_digest = SignatureUtils().digest(
-            open_session, certificate_value)
 
-        # check for signer identity
-        # if user_cf == "X" * 15, avoid this check
-        if user_cf != "X" * 15:
-            # only for REST calls
-            DigiSignLib()._check_certificate_owner(certificate_value, user_cf)
+        DigiSignLib().check_certificate(certificate_value, user_cf)
 
-        # check for certificate time validity
-        DigiSignLib()._check_certificate_validity(certificate_value)
+        signed_attributes, bytes_to_sign = DigiSignLib().prepare_p7m(
+            file_path, file_content, certificate_value, sig_attrs)
+
+        # fetching private key from smart card
+        privKey = SignatureUtils().fetch_private_key(open_session, certificate)
+        # signing bytes to be signed
+        signed_attributes_signed = SignatureUtils().signature(
+            open_session, privKey, bytes_to_sign)
+
+        # getting issuer from certificate
+        issuer = SignatureUtils().get_certificate_issuer(open_session, certificate)
+        # getting serial number from certificate
+        serial_number = SignatureUtils().get_certificate_serial_number(
+            open_session, certificate)
+
+        output_content = DigiSignLib().finalize_p7m(
+            file_path, file_content, certificate_value, sig_attrs,
+            signed_attributes, signed_attributes_signed, issuer, serial_number)
+
+        # saves p7m to file
+        signed_file_path = DigiSignLib().get_signed_files_path(file_path, 'p7m', sig_type)
+        DigiSignLib().save_file_content(signed_file_path, output_content)
+
+        return signed_file_path
+
+
+    @staticmethod
+    def prepare_p7m(file_path, file_content, certificate_value, sig_attrs):
+        ''' CPU-bound half of the p7m signature, it does not need the smart card
+
+            Param:
+                file_path: path (or name) of the file to sign, used to detect existing p7m
+                file_content: content of the file to sign
+                certificate_value: value field of the smart card certificate
+
+            Returns:
+                the signed attributes p7m field and the bytes to be signed
+        '''
+
+        file_content, _ = DigiSignLib()._p7m_content(
+            file_path, file_content, sig_attrs['p7m_sig_type'])
+
+        with timed("hashing"):
+            # hashing file content
+            file_content_digest = sha256(file_content).digest()
+            # hashing certificate value
+            certificate_value_digest = sha256(certificate_value).digest()
 
         # getting signed attributes p7m field
         try:
@@ -178,22 +256,29 @@ class DigiSignLib():
         except:
             raise P7mCreationError("Exception on encoding bytes to sign")
 
-        # fetching private key from smart card
-        privKey = SignatureUtils().fetch_private_key(open_session, certificate)
-        # signing bytes to be signed
-        signed_attributes_signed = SignatureUtils().signature(
-            open_session, privKey, bytes_to_sign)
+        return signed_attributes, bytes_to_sign
+
+
+    @staticmethod
+    def finalize_p7m(file_path, file_content, certificate_value, sig_attrs,
+                     signed_attributes, signature, issuer, serial_number):
+        ''' Return the p7m content built around the smart card `signature`
+
+            Param:
+                signed_attributes: signed attributes p7m field (from prepare_p7m())
+                signature: signed bytes to be signed (from the smart card)
+                issuer: smart card certificate issuer (bytes)
+                serial_number: smart card certificate serial number (int)
+        '''
+
+        file_content, p7m_attrs = DigiSignLib()._p7m_content(
+            file_path, file_content, sig_attrs['p7m_sig_type'])
 
-        # getting issuer from certificate
-        issuer = SignatureUtils().get_certificate_issuer(open_session, certificate)
-        # getting serial number from certificate
-        serial_number = SignatureUtils().get_certificate_serial_number(
-            open_session, certificate)
         # getting signer info p7m field
         try:
             signer_info = P7mEncoder().encode_signer_info(
                 issuer, serial_number, signed_attributes,
-                signed_attributes_signed, p7m_attrs.signer_infos)
+                signature, p7m_attrs.signer_infos)
         except:
             raise P7mCreationError("Exception on encoding signer info")
 
@@ -204,11 +289,28 @@ class DigiSignLib():
         except:
             raise P7mCreationError("Exception on encoding p7m file content")
 
-        # saves p7m to file
-        signed_file_path = DigiSignLib().get_signed_files_path(file_path, 'p7m', sig_type)
-        DigiSignLib().save_file_content(signed_file_path, output_content)
+        return output_content
 
-        return signed_file_path
+
+    @staticmethod
+    def _p7m_content(file_path, file_content, sig_type):
+        ''' Return the content to sign and the existing signatures attributes '''
+
+        # check existing signatures
+        p7m_attrs = P7mAttributes(b'', b'', b'')
+        mime = MimeTypes().guess_type(file_path)[0]
+        if mime == 'application/pkcs7':
+            info = cms.ContentInfo.load(file_content)
+            # retrieving existing signatures attributes
+            signed_data = info['content']
+            p7m_attrs.algos = signed_data['digest_algorithms'].contents
+            p7m_attrs.certificates = signed_data['certificates'].contents
+            #
+            if sig_type == 'parallel':
+                p7m_attrs.signer_infos = signed_data['signer_infos'].contents
+                file_content = signed_data['encap_content_info'].native['content']
+
+        return file_content, p7m_attrs
 
 
     @staticmethod
@@ -231,7 +333,7 @@ class DigiSignLib():
     def get_file_content(file_path):
         ''' Return `file_path` content in binary form '''
 
-        MyLogger().my_logger().info(f"reading file {file_path}")
+        logger.info(f"reading file {file_path}")
         with open(file_path, "rb") as file:
             file_content = file.read()
 
@@ -242,14 +344,28 @@ class DigiSignLib():
     def save_file_content(file_path, content):
         ''' Save content to `file_path` '''
 
-        MyLogger().my_logger().info(f"saving output to {file_path}")
+        logger.info(f"saving output to {file_path}")
         with open(file_path, "wb") as file:
             file.write(content)
 
 
     @staticmethod
-    def _check_certificate_validity(certificate_value):
-        MyLogger().my_logger().info("Chech for certificate time validity")
+    def check_certificate(certificate_value, user_cf):
+        ''' Check signer identity and certificate time validity '''
+
+        # check for signer identity
+        # if user_cf == "X" * 15, avoid this check
+        if user_cf != "X" * 15:
+            # only for REST calls
+            DigiSignLib()._check_certificate_owner(certificate_value, user_cf)
+
+        # check for certificate time validity
+        DigiSignLib()._check_certificate_validity(certificate_value, user_cf)
+
+
+    @staticmethod
+    def _check_certificate_validity(certificate_value, user_cf):
+        logger.info("Chech for certificate time validity")
         certificate_x509 = crypto.load_certificate(crypto.FILETYPE_ASN1, bytes(certificate_value))
         # [2:14] gets rid of "b'" at the beginning and "##Z" at the end
         # precision in minutes
@@ -264,7 +380,7 @@ class DigiSignLib():
 
         # <= for safety
         if diff <= 0:
-            DigiSignLib()._not_valid_yet_popup()
+            certificate_not_valid_yet()
             raise CertificateValidityError("Certificate not valid yet")
 
         try:
@@ -273,23 +389,15 @@ class DigiSignLib():
             raise ValueError(f"Impossible to cast {notAfter} to int")
 
         # <= for safety
-        if diff <= 0:
-            DigiSignLib().PROCEED = None
-            DigiSignLib()._proceed_with_expired_certificate()
-            if DigiSignLib().PROCEED == None:
-                MyLogger().my_logger().error("PROCEED is still None")
-                raise ValueError("Something went wrong with the expired certificate choise popup")
-            if not DigiSignLib().PROCEED:
-                MyLogger().my_logger().warning("User chosen to NOT proceed")
-                raise CertificateValidityError("Certificate expired")
-        MyLogger().my_logger().info("User chosen to proceed")
+        if diff <= 0 and not expired_certificate_allowed(certificate_x509, user_cf):
+            raise CertificateValidityError("Certificate expired")
 
 
     @staticmethod
     def _check_certificate_owner(certificate_value, user_cf):
         ''' Check if user_cf is equal to smart card cf. Raise a `CertificateOwnerException` '''
 
-        MyLogger().my_logger().info("Chech for certificate owner")
+        logger.info("Chech for certificate owner")
         certificate_x509 = crypto.load_certificate(crypto.FILETYPE_ASN1, bytes(certificate_value))
 
         subject = certificate_x509.get_subject()
@@ -300,14 +408,18 @@ class DigiSignLib():
         if codice_fiscale.upper() != user_cf.upper():
             raise CertificateOwnerException(f"{user_cf} (input) != {codice_fiscale} (smartcard)")
         else:
-            MyLogger().my_logger().info("owner verified")
+            logger.info("owner verified")
 
 
     @staticmethod
-    def _not_valid_yet_popup():
-        ''' Little popup for telling the user that his certificate is not valid yet '''
+    def _not_valid_yet_popup(timeout):
+        ''' Little popup for telling the user that his certificate is not valid yet,
+            closed after `timeout` seconds
+        '''
+
+        from tkinter import Tk, Label, Button, Frame
 
-        MyLogger().my_logger().info("Certificate not valid yet")
+        logger.info("Certificate not valid yet")
         widget = Tk()
         row = Frame(widget)
         label1 = Label(row, text="Il certificato di firma non è ancora valido,")
@@ -328,14 +440,22 @@ class DigiSignLib():
         widget.attributes("-topmost", True)
         widget.update()
         DigiSignLib()._center(widget)
+        widget.after(timeout * 1000, widget.destroy)
         widget.mainloop()
 
 
-    @classmethod
-    def _proceed_with_expired_certificate(cls):
-        ''' Little popup for asking the user if he wants to sign with an expired dertificate '''
+    @staticmethod
+    def _proceed_with_expired_certificate(timeout):
+        ''' Little popup for asking the user if he wants to sign with an expired dertificate,
+            closed after `timeout` seconds
+
+            Returns:
+                the choice, None when the popup is closed
+        '''
+
+        from tkinter import Tk, Label, Button, Frame
 
-        MyLogger().my_logger().info("Certificate expired")
+        logger.info("Certificate expired")
         widget = Tk()
         row1 = Frame(widget)
         label1 = Label(row1, text="Il certificato di firma risulta scaduto,")
@@ -344,13 +464,17 @@ class DigiSignLib():
         label1.pack(side="top")
         label2.pack(side="top")
 
+        proceed = None
+
         def on_click_ok():
+            nonlocal proceed
             widget.destroy()
-            cls.PROCEED = True
+            proceed = True
 
         def on_click_nok():
+            nonlocal proceed
             widget.destroy()
-            cls.PROCEED = False
+            proceed = False
 
         row2 = Frame(widget)
         button_ok = Button(row2, width=10, command=on_click_ok, text="OK")
@@ -365,7 +489,9 @@ class DigiSignLib():
         widget.attributes("-topmost", True)
         widget.update()
         DigiSignLib()._center(widget)
+        widget.after(timeout * 1000, widget.destroy)
         widget.mainloop()
+        return proceed
 
 
     @staticmethod
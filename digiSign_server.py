@@ -1,18 +1,36 @@
-from datetime import datetime, timedelta
-from digiSign_lib import DigiSignLib, CertificateOwnerException
-from flask import Flask, render_template, request, send_from_directory, make_response, Response, jsonify
+from admission import AdmissionRejected
+from contextvars import copy_context
+from datetime import datetime
+from flask import Flask, render_template, request, send_from_directory, make_response, Response, jsonify, url_for
 from flask_cors import CORS, cross_origin
+from json import dumps
+from log_archive import LogArchive
+from metrics import Metrics, MetricsPusher, count_error
 from mimetypes import MimeTypes
+from multiprocessing import freeze_support
 from my_config_loader import MyConfigLoader
-from my_logger import MyLogger
-from os import path, remove, sys, listdir, fsdecode, makedirs, environ
-from requests import post
-from shutil import move
-from tkinter import Tk, Entry, Label, Button, Frame
-from traceback import extract_tb
-from urllib import request as urlfile
+from my_logger import get_logger
+from os import path, makedirs
+from pin_manager import get_user_pin, clear_pin, has_valid_pin
+from profiling import profiled_request
+from sign_pipeline import StagePools
+from sign_service import SignService, SignRequestError
+from threading import Thread
+from uuid import uuid4
+from token_owner import start_token_owner, token_owner, admission_controller, batch_registry
+from tracing import background_trace, traced_request
+from verify_service import VerifyService, VerifyPool, VerifyRequestError, NOTHING_TO_VERIFY
+from werkzeug.formparser import parse_form_data
+from warm_up import start_warm_up
+from werkzeug.serving import make_server
 from werkzeug.utils import secure_filename
-from zipfile import ZipFile
+from workspace import Workspace, WorkspaceReaper
+from zip_stream import zip_stream
+import certificate_policy
+import os
+import pin_manager
+import signal
+import socket
 
 
 
@@ -22,23 +40,33 @@ from zipfile import ZipFile
 # url
 HOST = MyConfigLoader().get_server_config()["host"]
 PORT = MyConfigLoader().get_server_config()["port"]
+# development|production
+SERVER_MODE = MyConfigLoader().get_server_config()["mode"]
+HTTP_WORKERS = MyConfigLoader().get_server_config()["http_workers"]
 # mapped directories
 TEMPLATE_FOLDER = MyConfigLoader().get_server_config()["template_folder"]
 UPLOAD_FOLDER = MyConfigLoader().get_server_config()["uploaded_file_folder"]
 SIGNED_FOLDER = MyConfigLoader().get_server_config()["signed_file_folder"]
-LOGS_FOLDER = MyConfigLoader().get_logger_config()["log_folder"]
-# Allowed signature types
-P7M = "p7m"
-PDF = "pdf"
-ALLOWED_SIGNATURE_TYPES = set([P7M, PDF])
-# Memorized pin
-memorized_pin = {}
-PIN_TIMEOUT = MyConfigLoader().get_server_config()["pin_validity_time"]
+# seconds between two keepalive comments of an idle event stream
+EVENTS_KEEPALIVE = MyConfigLoader().get_server_config()["events_keepalive"]
+# bytes of an uploaded document read at once
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# bytes of a request body, larger ones are refused with 413
+MAX_CONTENT_LENGTH = MyConfigLoader().get_server_config()["max_content_length"]
+# user tips
+SERVER_BUSY = "Il server è occupato con altre firme, riprovare tra poco"
+SIGN_FAILED = "Impossibile firmare i file, contatta l'amministratore di sistema"
+INVALID_JOB = "Firma non trovata o scaduta"
+INVALID_LOG_RANGE = "Intervallo di date non valido, usare il formato AAAA-MM-GG o AAAA-MM-GGThh:mm"
 ####################################################################
 
 
+logger = get_logger("digiSign_server")
+
+
 # Initialize the Flask application
 server = Flask(__name__, template_folder=TEMPLATE_FOLDER)
+server.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 # enable CORS for /api/*
 CORS(server, resources={r"/api/*": {"origins": "*"}})
 
@@ -52,6 +80,8 @@ def index():
 
 
 @server.route("/upload", methods=["POST"])
+@profiled_request
+@traced_request
 def upload():
     uploaded_files = request.files.getlist("files[]")
     output_type = request.form["type"]
@@ -62,9 +92,8 @@ def upload():
     if 'p7m_sig_type' in request.form:
         p7m_sig_type = request.form["p7m_sig_type"]
 
-    # Folder cleanup
-    for _file in listdir(UPLOAD_FOLDER):
-        remove(path.join(UPLOAD_FOLDER, _file))
+    # job folders, signed files stay there for download
+    workspace = Workspace(keep_signed=True)
 
     file_paths_to_sign = []
     # Foreach file uploaded
@@ -72,8 +101,8 @@ def upload():
         if uploaded_file:
             # Make the filename safe, remove unsupported chars
             file_name = secure_filename(uploaded_file.filename)
-            # Save file in /upload folder
-            uploaded_file_path = path.join(UPLOAD_FOLDER, file_name)
+            # Save file in the job upload folder
+            uploaded_file_path = path.join(workspace.upload_folder, file_name)
             uploaded_file.save(uploaded_file_path)
             # Path added to files to sign
             file_paths_to_sign.append(uploaded_file_path)
@@ -95,65 +124,42 @@ def upload():
         }
     }
 
-    json_request = {
-        "user_id": "X" * 15,
-        "file_list": [],
-        "output_path": SIGNED_FOLDER
-    }
-
+    file_list = []
     for _file in file_paths_to_sign:
         json_file = json_file.copy()
         json_file.update({"file": _file})
-        json_request["file_list"].append(json_file)
+        file_list.append(json_file)
 
-    url = f"http://{HOST}:{PORT}/api/sign"
+    # same signing batch of /api/sign, in background: the page follows
+    # its progress and links every signed file as soon as it is delivered
+    batch_id = start_batch("X" * 15, file_list, workspace.signed_folder, workspace)
+    return render_template("upload.html", job_id=workspace.job_id, batch_id=batch_id)
 
-    if "HTTP_PROXY" in environ:
-        del environ["HTTP_PROXY"]
-    res = post(url=url, json=json_request,
-               headers={'Content-Type': 'application/json'})
-
-    if res.status_code != 200:
-        user_tip = res.json()["user_tip"]
-        return render_template("error_page.html", usertip=user_tip)
-
-    signed_files_list = []
-    not_signed_files_list = []
-    for item in res.json()["signed_file_list"]:
-        if item["signed"] == "yes":
-            file_name = path.basename(item["signed_file"])
-            signed_files_list.append(file_name)
-        else:
-            not_signed_files_list.append(item["file_to_sign"])
 
-    return render_template("upload.html", filenames=signed_files_list,
-                           errornames=not_signed_files_list)
-
-
-@server.route("/uploads/<filename>")
-def uploaded_file(filename):
-    return send_from_directory(SIGNED_FOLDER, filename)
+@server.route("/uploads/<job_id>/<filename>")
+def uploaded_file(job_id, filename):
+    return send_from_directory(path.join(SIGNED_FOLDER, secure_filename(job_id)), filename)
 
 
 @server.route("/easylog")
 def zip_and_download_logs():
+    ###################################
+    # optional query string filters, ISO dates or date times:
+    #     since: only the log files with records after since
+    #     until: only the log files with records before until
+    ###################################
+    try:
+        since = _timestamp(request.args.get("since"))
+        until = _timestamp(request.args.get("until"))
+    except ValueError as err:
+        return error_response_maker(str(err), INVALID_LOG_RANGE, 400)
+
     today = datetime.now().strftime("%Y%B%d")
     log_zip_name = f"{today}_log.zip"
 
-    # old zip cleanup
-    for _file in listdir(LOGS_FOLDER):
-        if fsdecode(_file).find(".zip") > 0:
-            remove(path.join(LOGS_FOLDER, _file))
-
-    # generate zip file
-    with ZipFile(path.join(LOGS_FOLDER, log_zip_name), "w") as zip:
-        for _file in listdir(LOGS_FOLDER):
-            # keep only .log files
-            if fsdecode(_file).find(".log") > 0:
-                zip.write(path.join(LOGS_FOLDER, _file), arcname=_file)
-
-    # zip download
-    return send_from_directory(LOGS_FOLDER, log_zip_name)
+    # zip streamed from the compressed log files, nothing written to disk
+    return Response(zip_stream(LogArchive().members(since, until)), mimetype="application/zip",
+                    headers={"Content-Disposition": f'attachment; filename="{log_zip_name}"'})
 
 
 ####################################################################
@@ -161,6 +167,8 @@ def zip_and_download_logs():
 ####################################################################
 @server.route("/api/sign", methods=["POST"])
 @cross_origin()
+@profiled_request
+@traced_request
 def sign():
     ###################################
     # request JSON structure:
@@ -181,232 +189,276 @@ def sign():
     #     output_path: output_folder_path
     # }
     ###################################
-    MyLogger().my_logger().info("/api/sign request")
+    logger.info("/api/sign request")
 
-    # check for well formed request JSON
-    invalid_json_request = "Richiesta al server non valida, contatta l'amministratore di sistema"
+    try:
+        signed_files_list = sign_service().sign_request(request.json)
+    except SignRequestError as err:
+        return error_response_maker(err.error_message, err.user_tip, err.status)
+    except AdmissionRejected as err:
+        return busy_response(error_response_maker(str(err), SERVER_BUSY, 503), err)
 
-    if not request.json:
-        error_message = "Missing json request structure"
-        return error_response_maker(error_message, invalid_json_request, 404)
+    ###################################
+    # response JSON structure:
+    # { signed_file_list: [
+    #     {
+    #         file_to_sign: ***,
+    #         signed: yes|no,
+    #         signed_file: ***
+    #     },
+    #     {
+    #         file_to_sign: ***,
+    #         signed: yes|no,
+    #         signed_file: ***
+    #     },
+    #     ...
+    # ]}
+    ###################################
+    res = make_response(jsonify({"signed_file_list": signed_files_list}))
+    return res
 
-    if not "user_id" in request.json:
-        error_message = "missing user_id field"
-        return error_response_maker(error_message, invalid_json_request, 404)
-    user_id = request.json["user_id"]
 
-    if not "file_list" in request.json:
-        error_message = "missing file_list field"
-        return error_response_maker(error_message, invalid_json_request, 404)
-    file_list = request.json["file_list"]
+@server.route("/api/sign/stream", methods=["POST"])
+@cross_origin()
+@profiled_request
+@traced_request
+def sign_stream():
+    ###################################
+    # multipart/form-data request:
+    #     user_id: codice_fiscale // "X"*15 to skip check
+    #     signed_file_type: p7m|pdf
+    #     sig_attributes: JSON string (optional)
+    #     one or more file parts
+    # any other request body is a single document, the same fields
+    # are given in the query string together with filename
+    ###################################
+    logger.info("/api/sign/stream request")
 
-    if not isinstance(file_list, (list,)) or len(file_list) < 1:
-        error_message = "Empty file_list"
-        return error_response_maker(error_message, invalid_json_request, 404)
+    # uploads are streamed to the job workspace in chunks, never whole in memory
+    workspace = Workspace()
+    try:
+        fields, documents = _receive_documents(workspace)
+        user_id, sig_type, sig_attributes = SignService.check_documents_request(fields)
+        if not documents or not all(path.getsize(part_path) for _, part_path in documents):
+            raise SignRequestError("missing documents to sign", "Nessun file da firmare", 404)
+        file_paths = [_unique_path(workspace.upload_folder,
+                                   secure_filename(file_name) or _default_file_name(sig_type),
+                                   part_path)
+                      for file_name, part_path in documents]
+        signed_documents = sign_service().sign_documents(
+            user_id, [(file_path, sig_type, sig_attributes) for file_path in file_paths], workspace)
+    except SignRequestError as err:
+        workspace.cleanup()
+        return error_response_maker(err.error_message, err.user_tip, err.status)
+    except AdmissionRejected as err:
+        workspace.cleanup()
+        return busy_response(error_response_maker(str(err), SERVER_BUSY, 503), err)
+    except:
+        workspace.cleanup()
+        raise
 
-    for json_file in file_list:
-        if not "file" in json_file:
-            error_message = "missing file field"
-            return error_response_maker(error_message, invalid_json_request, 404)
+    ###################################
+    # response:
+    #     one document: the signed document
+    #     more documents: a ZIP streamed while they are signed, with the
+    #     signed documents and signed_file_list.json, the /api/sign
+    #     response structure (signed_file is the name in the ZIP)
+    ###################################
+    if len(documents) == 1:
+        job = next(signed_documents)
+        if job.output_item["signed"] != "yes":
+            workspace.cleanup()
+            return error_response_maker(f"{job.file_path} not signed: {job.error}",
+                                        "Impossibile firmare il file", 500)
+        # not send_file: its responses skip call_on_close
+        response = Response(_file_chunks(job.signed_file_path), mimetype=_signed_mimetype(job),
+                            headers={"Content-Disposition": "attachment; filename=\"%s\""
+                                     % path.basename(job.signed_file_path),
+                                     "Content-Length": str(path.getsize(job.signed_file_path))})
+    else:
+        response = Response(zip_stream(_zip_members(signed_documents)), mimetype="application/zip",
+                            headers={"Content-Disposition": 'attachment; filename="signed.zip"'})
+    # the workspace goes when the response is sent, or the client left
+    response.call_on_close(workspace.cleanup)
+    return response
 
-        if not "signed_file_type" in json_file:
-            error_message = "missing signed_file_type field"
-            return error_response_maker(error_message, invalid_json_request, 404)
-        sig_type = json_file["signed_file_type"]
 
-        if not allowed_signature(sig_type):
-            error_message = f"{sig_type} not allowed in signed_file_type field"
-            return error_response_maker(error_message, invalid_json_request, 404)
+@server.route("/api/jobs", methods=["POST"])
+@cross_origin()
+@profiled_request
+@traced_request
+def start_job():
+    ###################################
+    # request JSON structure: same as /api/sign
+    ###################################
+    logger.info("/api/jobs request")
 
-        if "sig_attributes" in json_file:
-            sig_attributes = json_file["sig_attributes"]
-        else:
-            MyLogger().my_logger().error(f"missing sig_attributes field for file {json_file['file']}")
-            continue
+    try:
+        user_id, file_list, path_for_signed_files = SignService.check_request(request.json)
+    except SignRequestError as err:
+        return error_response_maker(err.error_message, err.user_tip, err.status)
+    batch_id = start_batch(user_id, file_list, path_for_signed_files)
 
-		# TODO check altri campi
+    ###################################
+    # response JSON structure:
+    # {
+    #     job_id: ***,
+    #     status: url of the job status,
+    #     events: url of the job Server-Sent Events stream
+    # }
+    ###################################
+    res = make_response(jsonify({"job_id": batch_id,
+                                 "status": url_for("job_status", job_id=batch_id),
+                                 "events": url_for("job_events", job_id=batch_id)}), 202)
+    res.headers["Location"] = url_for("job_status", job_id=batch_id)
+    return res
 
-    if not "output_path" in request.json:
-        error_message = "missing output_path field"
-        return error_response_maker(error_message, invalid_json_request, 404)
-    path_for_signed_files = request.json["output_path"]
 
-    output_to_url = False
-    if path_for_signed_files.startswith("http://"):
-        output_to_url = True
-    else:
-        if not path.exists(path_for_signed_files) or not path.isdir(path_for_signed_files):
-            error_message = f"{path_for_signed_files} field is not a valid directory"
-            return error_response_maker(error_message, invalid_json_request, 404)
+@server.route("/api/jobs/<job_id>")
+@cross_origin()
+def job_status(job_id):
+    ###################################
+    # response JSON structure:
+    # {
+    #     job_id: ***,
+    #     done: true|false,
+    #     error_message: *** // null unless the whole batch failed
+    #     files: [ last event of every file, see jobs.BatchRegistry ],
+    #     signed_file_list: *** // /api/sign response, once done
+    # }
+    ###################################
+    try:
+        return jsonify(batch_registry().status(job_id))
+    except KeyError:
+        return error_response_maker(f"unknown job {job_id}", INVALID_JOB, 404)
 
-    # folder cleanup
-    for _file in listdir(SIGNED_FOLDER):
-        remove(path.join(SIGNED_FOLDER, _file))
 
-    # getting smart cards connected
+@server.route("/api/jobs/<job_id>/events")
+@cross_origin()
+def job_events(job_id):
+    ###################################
+    # text/event-stream, one event per file stage:
+    #     id: progressive number
+    #     event: downloaded|prepared|signed|verified|delivered|failed
+    #     (verified only for the files checked after signing)
+    #     data: JSON, see jobs.BatchRegistry
+    # the last event is done (data.signed_file_list is the /api/sign
+    # response) or error. Reconnecting clients send Last-Event-ID
+    ###################################
+    registry = batch_registry()
     try:
-        sessions = DigiSignLib().get_smart_cards_sessions()
-    except Exception as err:
-        _, value, tb = sys.exc_info()
-        MyLogger().my_logger().error(value)
-        MyLogger().my_logger().error(
-            '\n\t'.join(f"{i}" for i in extract_tb(tb)))
-        clear_pin(user_id)
-        return error_response_maker(str(err),
-                                    "Controllare che la smart card sia inserita correttamente",
-                                    500)
-
-    # attempt to login
+        registry.status(job_id)
+    except KeyError:
+        return error_response_maker(f"unknown job {job_id}", INVALID_JOB, 404)
+
     try:
-        get_pin(user_id)
-        session = DigiSignLib().session_login(sessions, memorized_pin[user_id]["pin"])
-    except Exception as err:
-        _, value, tb = sys.exc_info()
-        MyLogger().my_logger().error(value)
-        MyLogger().my_logger().error(
-            '\n\t'.join(f"{i}" for i in extract_tb(tb)))
-        clear_pin(user_id)
-        return error_response_maker(str(err),
-                                    "Controllare che il pin sia valido e corretto",
-                                    500)
-
-    # loop on given files
-    signed_files_list = []
-    for index, file_to_sign in enumerate(file_list):
-        # already checked
-        signature_type = file_to_sign["signed_file_type"]
-        file_path_to_sign = file_to_sign["file"]
-
-        # initialize response structure
-        output_item = {"file_to_sign": file_path_to_sign,
-                       "signed": "",
-                       "signed_file": ""}
-        signed_files_list.append(output_item)
-
-        # handle url file paths
-        if file_path_to_sign.startswith("http://"):
-            try:
-                local_file_path = downoad_file(file_path_to_sign)
-            except:
-                MyLogger().my_logger().error(f"Impossibile reperire il file: {file_path_to_sign}")
-                _, value, tb = sys.exc_info()
-                MyLogger().my_logger().error(value)
-                MyLogger().my_logger().error(
-                    '\n\t'.join(f"{i}" for i in extract_tb(tb)))
-                signed_files_list[index]["signed"] = "no"
-                continue
-        else:
-            local_file_path = file_path_to_sign
+        last_event_id = int(request.headers.get("Last-Event-ID", -1))
+    except ValueError:
+        last_event_id = -1
 
-        try:
-            if signature_type == P7M:
-                # p7m signature
-                temp_file_path = DigiSignLib().sign_p7m(local_file_path, session, user_id, sig_attributes)
-            elif signature_type == PDF:
-                # pdf signature
-                mime = MimeTypes().guess_type(local_file_path)[0]
-                if mime == 'application/pdf':
-                    temp_file_path = DigiSignLib().sign_pdf(local_file_path, session, user_id, sig_attributes)
-                else:
-                    MyLogger().my_logger().info(f"the file {local_file_path} is not a pdf will be ignored")
-                    signed_files_list[index]["signed"] = "no"
-                    continue
-
-            signed_files_list[index]["signed"] = "yes"
-        except CertificateOwnerException as err:
-            user_tip = "Codice fiscale dell'utente non corrispondente a quello della smart card. Impossibile procedere."
-            DigiSignLib().session_logout(session)
-            DigiSignLib().session_close(session)
-            return error_response_maker(str(err), user_tip, 500)
-        except:
-            _, value, tb = sys.exc_info()
-            MyLogger().my_logger().error(value)
-            MyLogger().my_logger().error(
-                '\n\t'.join(f"{i}" for i in extract_tb(tb)))
-            signed_files_list[index]["signed"] = "no"
-            continue
-
-        # moving signed file to given destination
-        if output_to_url:
-            with open(temp_file_path, "rb") as _file:
-                files = {'file': _file}
-                try:
-                    MyLogger().my_logger().info(path_for_signed_files)
-                    res = post(path_for_signed_files, files=files)
-                except:
-                    _, value, tb = sys.exc_info()
-                    MyLogger().my_logger().error(value)
-                    MyLogger().my_logger().error(
-                        '\n\t'.join(f"{i}" for i in extract_tb(tb)))
-                    signed_files_list[index]["signed_file"] = "EXCEPTION!!"
-                    continue
-                if res.status_code != 200:
-                    error_message = res.json()["error_message"]
-                    MyLogger().my_logger().error(error_message)
-                    signed_files_list[index]["signed_file"] = "ERROR!!"
-                    continue
-                else:
-                    signed_files_list[index]["signed"] = "yes - [remote]"
-                    uploaded_path = res.json()["Ok"]
-                    signed_files_list[index]["signed_file"] = f"{uploaded_path}"
-                    continue
-        else:
-            temp_file_name = path.basename(temp_file_path)
-            signed_file_path = path.join(
-                path_for_signed_files, temp_file_name)
+    def stream(after):
+        while True:
             try:
-                move(temp_file_path, signed_file_path)
-                signed_files_list[index]["signed_file"] = signed_file_path
-            except:
-                _, value, tb = sys.exc_info()
-                MyLogger().my_logger().error(value)
-                MyLogger().my_logger().error(
-                    '\n\t'.join(f"{i}" for i in extract_tb(tb)))
-                signed_files_list[index]["signed_file"] = "LOST"
+                events, done = registry.events(job_id, after, timeout=EVENTS_KEEPALIVE)
+            except KeyError:
+                # expired while streaming
+                return
+            if not events and not done:
+                # keeps proxies and browsers from closing an idle stream
+                yield ": keepalive\n\n"
                 continue
+            for event in events:
+                after = event["id"]
+                yield f"id: {after}\nevent: {event['event']}\ndata: {dumps(event)}\n\n"
+            if done:
+                return
+
+    return Response(stream(last_event_id), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@server.route("/metrics")
+def metrics():
+    # Prometheus text exposition format
+    files, nbytes, waiting = admission_controller().in_flight()
+    Metrics().set("digisign_in_flight", files, kind="files")
+    Metrics().set("digisign_in_flight", nbytes, kind="bytes")
+    Metrics().set("digisign_in_flight", waiting, kind="waiting")
+    owner = token_owner()
+    if owner is None:
+        text = Metrics().render()
+    else:
+        # production: HTTP workers push their values to the token owner
+        # in the background (`MetricsPusher`), the scraped one right now
+        owner.merge_metrics(Metrics().drain())
+        text = owner.render_metrics()
+    return Response(text, mimetype="text/plain; version=0.0.4")
 
-    # Folder cleanup
-    for _file in listdir(UPLOAD_FOLDER):
-        remove(path.join(UPLOAD_FOLDER, _file))
 
-    # logout
-    try:
-        DigiSignLib().session_logout(session)
-    except:
-        MyLogger().my_logger().error("logout failed")
-    # session close
+@server.before_request
+def count_request():
+    Metrics().inc("digisign_requests_total", endpoint=request.endpoint or "unknown")
+
+
+@server.route("/api/verify", methods=["POST"])
+@cross_origin()
+@profiled_request
+@traced_request
+def verify():
+    ###################################
+    # request, one of:
+    #     JSON { file_list: [ { file: file_path }, ... ] }, server files
+    #     multipart/form-data, one or more file parts
+    #     any other body, a single document, filename in the query string
+    ###################################
+    logger.info("/api/verify request")
+
     try:
-        DigiSignLib().session_close(session)
-    except:
-        MyLogger().my_logger().error("session close failed")
+        if request.mimetype == "application/json":
+            verified_files = VerifyService.verify_files(VerifyService.check_request(request.json))
+        else:
+            # uploads are streamed to a workspace in chunks, the
+            # verification processes read them from disk
+            with Workspace() as workspace:
+                _, documents = _receive_documents(workspace)
+                if not documents or not all(path.getsize(part_path) for _, part_path in documents):
+                    raise VerifyRequestError("missing documents to verify", NOTHING_TO_VERIFY, 404)
+                verified_files = VerifyService.verify_documents(
+                    [(secure_filename(file_name) or "document", part_path)
+                     for file_name, part_path in documents])
+    except VerifyRequestError as err:
+        return error_response_maker(err.error_message, err.user_tip, err.status)
+
     ###################################
     # response JSON structure:
-    # { signed_file_list: [
-    #     {
-    #         file_to_sign: ***,
-    #         signed: yes|no,
-    #         signed_file: ***
-    #     },
+    # { verified_file_list: [
     #     {
-    #         file_to_sign: ***,
-    #         signed: yes|no,
-    #         signed_file: ***
+    #         file: file path or uploaded file name,
+    #         type: pdf|p7m,
+    #         bytes: ***,
+    #         valid: true when every check of every signature passed,
+    #             an unknown revocation status is not a failure,
+    #         signatures: [
+    #             {
+    #                 hashok?: true|false,
+    #                 signatureok?: true|false,
+    #                 certok?: true|false,
+    #                 revocationok?: true|false|null (no up to date CRL)
+    #             },
+    #             ...
+    #         ],
+    #         error: null or why the file could not be verified,
+    #         seconds: ***
     #     },
     #     ...
     # ]}
     ###################################
-    res = make_response(jsonify({"signed_file_list": signed_files_list}))
-    return res
+    return make_response(jsonify({"verified_file_list": verified_files}))
 
 
 ####################################################################
 #       UTILITIES                                                  #
 ####################################################################
-def allowed_signature(signature_type):
-    ''' Returns if `signature_type` is allowed '''
-    return signature_type.lower() in ALLOWED_SIGNATURE_TYPES
-
-
 def error_response_maker(error_message, user_tip, status):
     ''' Returns an HTTP error response with HTTP_status = `status`.
 
@@ -418,111 +470,179 @@ def error_response_maker(error_message, user_tip, status):
             }
     '''
 
-    MyLogger().my_logger().error(error_message)
+    logger.error(error_message)
     return make_response(jsonify({"error_message": error_message, "user_tip": user_tip}), status)
 
 
-def clear_pin(user_id):
-    MyLogger().my_logger().info("Clearing PIN")
-    if user_id in memorized_pin:
-        if "timestamp" in memorized_pin[user_id]:
-            memorized_pin[user_id].pop("timestamp")
-        if "pin" in memorized_pin[user_id]:
-            memorized_pin[user_id].pop("pin")
+def _timestamp(value):
+    ''' Seconds since the epoch of an ISO date or date time, None when missing. Raise a `ValueError` '''
 
+    if not value:
+        return None
+    return datetime.fromisoformat(value).timestamp()
 
-def get_pin(user_id):
-    ''' Gets you the `PIN` '''
 
-    if user_id not in memorized_pin:
-        memorized_pin[user_id] = {}
+def busy_response(response, err):
+    ''' Add the Retry-After hint of a refused request to `response` '''
 
-    if "pin" not in memorized_pin[user_id]:
-        _get_pin_popup(user_id)
-    elif not _is_pin_valid(user_id):
-        MyLogger().my_logger().info("Invalidating PIN")
-        clear_pin(user_id)
-        _get_pin_popup(user_id)
-    else:
-        MyLogger().my_logger().info("Refreshing PIN")
-        memorized_pin[user_id]["timestamp"] = datetime.now()
+    count_error(err)
+    response.headers["Retry-After"] = str(err.retry_after)
+    return response
 
-    # check for mishapening
-    if "pin" not in memorized_pin[user_id]:
-        raise ValueError("No pin inserted")
 
+def _receive_documents(workspace):
+    ''' Stream the uploaded documents into the `workspace` upload folder,
+        up to `MAX_CONTENT_LENGTH` bytes (RequestEntityTooLarge)
 
-def _is_pin_valid(user_id):
-    ''' Check if `PIN` is expired '''
+        Returns:
+            the request fields, and (file name, part path) of every document
+    '''
 
-    return datetime.now() < memorized_pin[user_id]["timestamp"] + timedelta(seconds=PIN_TIMEOUT)
+    if request.mimetype == "multipart/form-data":
+        def part_stream(total_content_length, content_type, filename, content_length=None):
+            return open(path.join(workspace.upload_folder, f"{uuid4().hex}.part"), "wb+")
+
+        _, fields, files = parse_form_data(request.environ, stream_factory=part_stream,
+                                           max_content_length=request.max_content_length)
+        documents = []
+        for uploaded_file in files.values():
+            uploaded_file.close()
+            if uploaded_file.filename:
+                documents.append((uploaded_file.filename, uploaded_file.stream.name))
+        return fields, documents
+
+    fields = request.args
+    part_path = path.join(workspace.upload_folder, f"{uuid4().hex}.part")
+    with open(part_path, "wb") as _file:
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            _file.write(chunk)
+    return fields, [(fields.get("filename", ""), part_path)]
+
+
+def _unique_path(folder, file_name, part_path):
+    ''' Move the uploaded `part_path` to `file_name` in `folder`, renamed when taken
+
+        Returns:
+            the new path
+    '''
 
+    name, extension = path.splitext(file_name)
+    file_path = path.join(folder, file_name)
+    counter = 0
+    while path.exists(file_path):
+        counter += 1
+        file_path = path.join(folder, f"{name}_{counter}{extension}")
+    os.replace(part_path, file_path)
+    return file_path
 
-def _get_pin_popup(user_id):
-    ''' Little popup to input Smart Card PIN '''
 
-    MyLogger().my_logger().info("User PIN input")
-    widget = Tk()
-    row = Frame(widget)
-    label = Label(row, width=10, text="Insert PIN")
-    pinbox = Entry(row, width=15, show='*')
-    row.pack(side="top", padx=60, pady=20)
-    label.pack(side="left")
-    pinbox.pack(side="right")
+def _default_file_name(sig_type):
+    return "document.pdf" if sig_type == "pdf" else "document"
 
-    def on_enter(evt):
-        on_click()
 
-    def on_click():
-        memorized_pin[user_id]["pin"] = pinbox.get()
-        memorized_pin[user_id]["timestamp"] = datetime.now()
-        widget.destroy()
+def _signed_mimetype(job):
+    if job.signed_file_path.endswith(".p7m"):
+        return "application/pkcs7-mime"
+    return MimeTypes().guess_type(job.signed_file_path)[0] or "application/octet-stream"
 
-    pinbox.bind("<Return>", on_enter)
-    button = Button(widget, command=on_click, text="OK")
-    button.pack(side="top", fill="x", padx=80)
-    filler = Label(widget, height=1, text="")
-    filler.pack(side="top")
 
-    widget.title("Smart Card PIN")
-    widget.attributes("-topmost", True)
-    widget.update()
-    _center(widget)
-    widget.mainloop()
+def _file_chunks(file_path):
+    with open(file_path, "rb") as _file:
+        while True:
+            chunk = _file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
 
 
-def _center(widget):
-    ''' Center `widget` on the screen '''
-    screen_width = widget.winfo_screenwidth()
-    screen_height = widget.winfo_screenheight()
+def _zip_members(signed_documents):
+    ''' (name, content) of the signed documents as they come, then signed_file_list.json '''
 
-    x = screen_width / 2 - widget.winfo_width() / 2
-    # Little higher than center
-    y = screen_height / 2 - widget.winfo_height()
+    signed_files_list = []
+    names = set()
+    for job in signed_documents:
+        if job.output_item["signed"] == "yes":
+            # same name uploaded twice
+            name, extension = path.splitext(path.basename(job.signed_file_path))
+            file_name = f"{name}{extension}"
+            counter = 0
+            while file_name in names:
+                counter += 1
+                file_name = f"{name}_{counter}{extension}"
+            names.add(file_name)
+            job.output_item["signed_file"] = file_name
+            # one signed document in memory at a time
+            with open(job.signed_file_path, "rb") as _file:
+                content = _file.read()
+            yield file_name, content
+        signed_files_list.append(job.output_item)
+    yield "signed_file_list.json", dumps({"signed_file_list": signed_files_list})
+
+
+def start_batch(user_id, file_list, path_for_signed_files, workspace=None):
+    ''' Sign in a background thread, the progress goes to the batch registry
+
+        Param:
+            workspace: job `Workspace`, cleaned up when the batch is over
+
+        Returns:
+            the batch id
+    '''
 
-    widget.geometry(f"+{int(x)}+{int(y)}")
+    registry = batch_registry()
+    batch_id = registry.create()
+    service = sign_service()
 
+    def on_event(event, job):
+        fields = dict(job.output_item)
+        if event == "failed" and job.error is not None:
+            fields["error_message"] = str(job.error)
+        registry.publish(batch_id, event, index=job.index, **fields)
 
-def downoad_file(file_url):
-    # get file name
-    file_name = file_url.rsplit('/', 1)[1]
-    # get file content
-    url_content = urlfile.urlopen(file_url).read()
-    # create file locally
-    if not path.exists(UPLOAD_FOLDER) or not path.isdir(UPLOAD_FOLDER):
-        makedirs(UPLOAD_FOLDER)
-    file_path = path.join(UPLOAD_FOLDER, file_name)
-    with open(file_path, "wb") as _file:
-        _file.write(url_content)
+    def run():
+        with background_trace("batch"):
+            sign_batch()
 
-    return file_path
+    def sign_batch():
+        try:
+            signed_file_list = service.sign(user_id, file_list, path_for_signed_files,
+                                            workspace, on_event)
+            registry.finish(batch_id, signed_file_list)
+        except SignRequestError as err:
+            logger.error(err.error_message)
+            registry.finish(batch_id, error_message=err.error_message,
+                            user_tip=err.user_tip, status=err.status)
+        except AdmissionRejected as err:
+            logger.error(str(err))
+            registry.finish(batch_id, error_message=str(err), user_tip=SERVER_BUSY,
+                            status=503, retry_after=err.retry_after)
+        except Exception as err:
+            count_error(err)
+            logger.error(f"batch {batch_id}: {err.__class__.__name__} {err}")
+            registry.finish(batch_id, error_message=str(err), user_tip=SIGN_FAILED, status=500)
+        finally:
+            if workspace is not None:
+                workspace.cleanup()
+
+    # the request context (profiling, tracing) goes on in the batch thread
+    Thread(target=copy_context().run, args=(run,), name=f"batch-{batch_id[:8]}",
+           daemon=True).start()
+    return batch_id
+
+
+def sign_service():
+    ''' Returns the signing service asking the PIN to the user '''
+    return SignService(get_user_pin, clear_pin, token_owner(), has_valid_pin)
 
 
 ####################################################################
 #       SERVER STARTUP                                             #
 ####################################################################
 def server_start():
-    MyLogger().my_logger().info("Server started!")
+    logger.info("Server started!")
 
     # Check for upload and signed folder
     if not path.exists(UPLOAD_FOLDER) or not path.isdir(UPLOAD_FOLDER):
@@ -530,19 +650,102 @@ def server_start():
     if not path.exists(SIGNED_FOLDER) or not path.isdir(SIGNED_FOLDER):
         makedirs(SIGNED_FOLDER)
 
+    if SERVER_MODE == "production":
+        production_server_start()
+        return
+
     try:
-        server.run(
-            host=HOST,
-            port=PORT,
-            debug=False
-        )
+        http_server = make_server(HOST, PORT, server, threaded=True)
     except:
-        MyLogger().my_logger().error("Impossible to start Server")
-        pass
+        logger.error("Impossible to start Server")
+        return
+    # orphan job folders cleanup
+    WorkspaceReaper().start()
+    # the port answers while libraries and drivers load
+    start_warm_up()
+    http_server.serve_forever()
+
+
+def production_server_start():
+    ''' Pre-forked HTTP workers sharing one listening socket, smart card
+        calls are forwarded to a single token-owner process
+
+        The parent only starts the token-owner process, forks the workers
+        and waits for them. Everything running threads is started by each
+        worker after the fork (workspace reaper, metrics pusher, pipeline
+        and verification pools, warm-up), the token owner is reached
+        through proxies opened by each worker, and the log files are
+        written by the parent alone (`my_logger`): no child inherits a
+        running thread or a lock held by one.
+
+        Without fork (Windows) a single threaded HTTP process serves every
+        request, next to the token-owner process: `http_workers` is
+        ignored, the pipeline and verification process pools still use
+        every core.
+    '''
+
+    # no popup in the workers nor in the token owner: a missing PIN or
+    # policy decision fails the request instead of holding it
+    pin_manager.HEADLESS = certificate_policy.HEADLESS = True
+    manager = start_token_owner()
+    if not hasattr(os, "fork"):
+        logger.warning("fork not available, starting a single HTTP worker")
+        try:
+            http_server = make_server(HOST, PORT, server, threaded=True)
+            WorkspaceReaper().start()
+            start_warm_up(token_owner())
+            http_server.serve_forever()
+        finally:
+            manager.shutdown()
+        return
+
+    # CPU stages are split among the HTTP workers
+    if not MyConfigLoader().get_pipeline_config()["cpu_workers"]:
+        StagePools().set_cpu_workers(max(1, os.cpu_count() // HTTP_WORKERS))
+
+    listener = socket.create_server((HOST, PORT))
+    logger.info(f"starting {HTTP_WORKERS} HTTP workers on {HOST}:{PORT}")
+    workers = []
+    for _ in range(HTTP_WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, _stop_worker)
+            worker = make_server(HOST, PORT, server, threaded=True, fd=listener.fileno())
+            # each worker keeps its own live workspaces and reaps the orphans
+            WorkspaceReaper().start()
+            MetricsPusher().start(lambda values: token_owner().merge_metrics(values))
+            start_warm_up(token_owner())
+            try:
+                worker.serve_forever()
+            finally:
+                MetricsPusher().stop()
+                StagePools().shutdown()
+                VerifyPool().shutdown()
+                os._exit(0)
+        workers.append(pid)
+
+    try:
+        for pid in workers:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in workers:
+            os.waitpid(pid, 0)
+    finally:
+        listener.close()
+        manager.shutdown()
+
+
+def _stop_worker(signum, frame):
+    # unwinds serve_forever() so the worker can stop its process pool
+    raise SystemExit(0)
 
 
 ####################################################################
 #       MAIN                                                       #
 ####################################################################
 if __name__ == "__main__":
+    # needed by the pipeline process pool in frozen executables
+    freeze_support()
     server_start()
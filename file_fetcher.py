@@ -0,0 +1,115 @@
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import path, makedirs, remove, replace
+from singleton_type import SingletonType
+from threading import Lock
+from time import sleep
+from urllib.parse import urlparse, unquote
+from werkzeug.utils import secure_filename
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+TIMEOUT = MyConfigLoader().get_fetcher_config()["timeout"]
+RETRIES = MyConfigLoader().get_fetcher_config()["retries"]
+BACKOFF = MyConfigLoader().get_fetcher_config()["backoff"]
+CHUNK_SIZE = MyConfigLoader().get_fetcher_config()["chunk_size"]
+# one keep-alive connection per pipeline I/O thread
+POOL_SIZE = MyConfigLoader().get_pipeline_config()["io_workers"]
+# HTTP status worth a retry
+RETRY_STATUS = set([429, 500, 502, 503, 504])
+####################################################################
+
+
+logger = get_logger("file_fetcher")
+
+
+# custom exceptions
+class FileFetchError(Exception):
+    ''' Raised when a remote file can not be downloaded '''
+    pass
+
+
+class _RetryableStatus(Exception):
+    pass
+
+
+class FileFetcher(object, metaclass=SingletonType):
+    ''' Downloads remote files to sign over a pooled keep-alive HTTP session '''
+
+    def __init__(self):
+        # imported here, requests is slow to load and only http:// files need it
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+
+        self._session = Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._lock = Lock()
+        self._reserved = set()
+
+    def fetch(self, file_url, folder):
+        ''' Stream `file_url` into `folder` retrying with exponential backoff
+
+            Returns:
+                the local file path
+        '''
+
+        from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
+
+        if not path.exists(folder) or not path.isdir(folder):
+            makedirs(folder, exist_ok=True)
+        file_path = self._reserve_path(file_url, folder)
+        try:
+            for attempt in range(RETRIES + 1):
+                try:
+                    self._download(file_url, file_path)
+                    return file_path
+                except (ConnectionError, Timeout, ChunkedEncodingError, _RetryableStatus) as err:
+                    if attempt == RETRIES:
+                        raise FileFetchError(f"{file_url}: {err}")
+                    delay = BACKOFF * 2 ** attempt
+                    logger.warning(
+                        f"download of {file_url} failed ({err}), retry in {delay}s")
+                    sleep(delay)
+        finally:
+            with self._lock:
+                self._reserved.discard(file_path)
+
+    def _download(self, file_url, file_path):
+        part_path = f"{file_path}.part"
+        logger.info(f"downloading {file_url}")
+        with self._session.get(file_url, stream=True, timeout=TIMEOUT) as res:
+            if res.status_code in RETRY_STATUS:
+                raise _RetryableStatus(f"HTTP {res.status_code}")
+            if res.status_code != 200:
+                raise FileFetchError(f"{file_url}: HTTP {res.status_code}")
+            try:
+                with open(part_path, "wb") as _file:
+                    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                        _file.write(chunk)
+            except:
+                if path.exists(part_path):
+                    remove(part_path)
+                raise
+        replace(part_path, file_path)
+
+    def _reserve_path(self, file_url, folder):
+        ''' Return a local path not used by other downloads '''
+
+        # get file name
+        file_name = secure_filename(unquote(path.basename(urlparse(file_url).path)))
+        if not file_name:
+            file_name = "download"
+        name, extension = path.splitext(file_name)
+        with self._lock:
+            file_path = path.join(folder, file_name)
+            counter = 0
+            while file_path in self._reserved or path.exists(file_path):
+                counter += 1
+                file_path = path.join(folder, f"{name}_{counter}{extension}")
+            self._reserved.add(file_path)
+        return file_path
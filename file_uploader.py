@@ -0,0 +1,153 @@
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import path
+from singleton_type import SingletonType
+from threading import BoundedSemaphore
+from time import sleep
+from uuid import uuid4
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+MAX_CONCURRENCY = MyConfigLoader().get_uploader_config()["max_concurrency"]
+TIMEOUT = MyConfigLoader().get_uploader_config()["timeout"]
+RETRIES = MyConfigLoader().get_uploader_config()["retries"]
+BACKOFF = MyConfigLoader().get_uploader_config()["backoff"]
+CHUNK_SIZE = MyConfigLoader().get_uploader_config()["chunk_size"]
+# HTTP status telling the signed file was not processed: a POST is not
+# idempotent, it is sent again only when the receiver surely did not get it
+NOT_PROCESSED_STATUS = set([429, 503])
+####################################################################
+
+
+logger = get_logger("file_uploader")
+
+
+# custom exceptions
+class FileUploadError(Exception):
+    ''' Raised when the remote receiver refuses a signed file '''
+    pass
+
+
+class _RetryableStatus(Exception):
+    pass
+
+
+class MultipartFileStream:
+    ''' File-like multipart/form-data body read lazily from disk
+
+        It has a known length, so the request is sent with a Content-Length
+        header and the file is never loaded whole in memory.
+    '''
+
+    def __init__(self, file_path, field_name="file"):
+        self.boundary = uuid4().hex
+        file_name = path.basename(file_path).replace('"', '')
+        self._head = (f"--{self.boundary}\r\n"
+                      f'Content-Disposition: form-data; name="{field_name}"; filename="{file_name}"\r\n'
+                      "Content-Type: application/octet-stream\r\n\r\n").encode()
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._file_path = file_path
+        self._file_size = path.getsize(file_path)
+        self._file = None
+        self._parts = None
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def __enter__(self):
+        self._file = open(self._file_path, "rb")
+        self._parts = [self._head, self._file, self._tail]
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        chunk = b''
+        while self._parts and len(chunk) < size:
+            part = self._parts[0]
+            if isinstance(part, bytes):
+                taken = size - len(chunk)
+                chunk += part[:taken]
+                if len(part) > taken:
+                    self._parts[0] = part[taken:]
+                else:
+                    self._parts.pop(0)
+            else:
+                data = part.read(size - len(chunk))
+                if not data:
+                    self._parts.pop(0)
+                chunk += data
+        return chunk
+
+
+class FileUploader(object, metaclass=SingletonType):
+    ''' Sends signed files to `output_path` URLs over a pooled keep-alive session '''
+
+    def __init__(self):
+        # imported here, requests is slow to load and only http:// outputs need it
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+
+        self._session = Session()
+        adapter = HTTPAdapter(pool_connections=MAX_CONCURRENCY, pool_maxsize=MAX_CONCURRENCY)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._slots = BoundedSemaphore(MAX_CONCURRENCY)
+
+    def upload(self, file_path, url):
+        ''' Stream `file_path` to `url` retrying the failures that prove
+            the receiver did not process it: connection not opened, or
+            `NOT_PROCESSED_STATUS`. A read timeout is not retried, the
+            file could be uploaded twice
+
+            Returns:
+                the remote path given back by the receiver
+        '''
+
+        with self._slots:
+            for attempt in range(RETRIES + 1):
+                try:
+                    return self._post(file_path, url)
+                except Exception as err:
+                    if attempt == RETRIES or not _not_processed(err):
+                        raise
+                    delay = BACKOFF * 2 ** attempt
+                    logger.warning(
+                        f"upload of {file_path} to {url} failed ({err}), retry in {delay}s")
+                    sleep(delay)
+
+    def _post(self, file_path, url):
+        logger.info(f"uploading {file_path} to {url}")
+        with MultipartFileStream(file_path) as body:
+            res = self._session.post(url, data=body, timeout=TIMEOUT,
+                                     headers={"Content-Type": body.content_type,
+                                              "Content-Length": str(len(body))})
+        if res.status_code in NOT_PROCESSED_STATUS:
+            raise _RetryableStatus(f"HTTP {res.status_code}")
+        if res.status_code != 200:
+            raise FileUploadError(res.json()["error_message"])
+        return res.json()["Ok"]
+
+
+def _not_processed(err):
+    ''' True when the upload failed with `err` never reached the receiver '''
+
+    from requests.exceptions import ConnectionError, ConnectTimeout
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(err, (_RetryableStatus, ConnectTimeout)):
+        return True
+    # refused or not resolved, the connection was never opened
+    if isinstance(err, ConnectionError) and err.args:
+        return isinstance(getattr(err.args[0], "reason", None), NewConnectionError)
+    return False
@@ -0,0 +1,63 @@
+from argparse import ArgumentParser
+from json import loads
+from os import path
+from subprocess import run
+import sys
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# seconds allowed to import the server module in a fresh interpreter
+BUDGET = 0.5
+# heavy libraries the first request or the warm-up load, not the import
+DEFERRED_MODULES = ("tkinter", "requests", "pdfminer", "OpenSSL", "cryptography",
+                    "asn1crypto", "PyKCS11", "digiSign_lib", "pdf_builder", "verifier")
+####################################################################
+
+
+# run in a fresh interpreter, prints the import time and the deferred modules loaded
+_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = [name for name in {deferred!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "loaded": loaded}}))
+'''
+
+
+def measure(module="digiSign_server", runs=3):
+    ''' Best import time of `module` over `runs` fresh interpreters
+
+        Returns:
+            the seconds and the `DEFERRED_MODULES` loaded by the import
+    '''
+
+    best = None
+    for _ in range(runs):
+        result = run([sys.executable, "-c", _PROBE.format(module=module, deferred=DEFERRED_MODULES)],
+                     capture_output=True, text=True, check=True,
+                     cwd=path.dirname(path.abspath(__file__)))
+        probe = loads(result.stdout.strip().splitlines()[-1])
+        if best is None or probe["seconds"] < best["seconds"]:
+            best = probe
+    return best["seconds"], best["loaded"]
+
+
+####################################################################
+#       CLI                                                        #
+####################################################################
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Check the import time budget of the server startup")
+    parser.add_argument("--module", default="digiSign_server")
+    parser.add_argument("--budget", type=float, default=BUDGET, help="seconds")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    seconds, loaded = measure(args.module, args.runs)
+    print(f"import {args.module}: {seconds:.3f}s (budget {args.budget:.3f}s)")
+    if loaded:
+        print(f"loaded at import time: {', '.join(loaded)}")
+    sys.exit(1 if seconds > args.budget or loaded else 0)
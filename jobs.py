@@ -0,0 +1,112 @@
+from my_config_loader import MyConfigLoader
+from singleton_type import SingletonType
+from threading import Condition
+from time import time
+from uuid import uuid4
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# seconds a finished batch and its events are kept
+BATCH_TTL = MyConfigLoader().get_server_config()["workspace_ttl"]
+####################################################################
+
+
+class _Batch:
+    def __init__(self):
+        self.events = []
+        self.signed_file_list = None
+        self.error = None
+        self.done = False
+        self.finished_at = None
+
+
+class BatchRegistry(object, metaclass=SingletonType):
+    ''' Progress events of the signing batches running in background
+
+        Every call takes and returns plain data, so the registry can be
+        shared by the HTTP workers through the token-owner process.
+
+        Event structure:
+
+            {
+                id: progressive number in the batch,
+                event: downloaded|prepared|signed|verified|delivered|failed|done|error,
+                index: file position in file_list (file events),
+                file_to_sign, signed, signed_file (file events),
+                error_message (failed and error events)
+            }
+    '''
+
+    def __init__(self):
+        self._condition = Condition()
+        self._batches = {}
+
+    def create(self):
+        ''' Returns a new batch id '''
+
+        with self._condition:
+            self._expire()
+            batch_id = uuid4().hex
+            self._batches[batch_id] = _Batch()
+            return batch_id
+
+    def publish(self, batch_id, event, **fields):
+        with self._condition:
+            self._append(self._batches[batch_id], event, fields)
+
+    def finish(self, batch_id, signed_file_list=None, error_message=None, **fields):
+        ''' Last event of a batch: done with the whole response list, or error '''
+
+        with self._condition:
+            batch = self._batches[batch_id]
+            batch.signed_file_list = signed_file_list
+            batch.error = error_message
+            batch.finished_at = time()
+            if error_message is None:
+                self._append(batch, "done", {"signed_file_list": signed_file_list})
+            else:
+                fields["error_message"] = error_message
+                self._append(batch, "error", fields)
+            batch.done = True
+
+    def events(self, batch_id, after=-1, timeout=None):
+        ''' Wait up to `timeout` seconds for the events following `after`. Raise a `KeyError`
+
+            Returns:
+                the new events and whether the batch is over
+        '''
+
+        with self._condition:
+            batch = self._batches[batch_id]
+            self._condition.wait_for(
+                lambda: len(batch.events) > after + 1 or batch.done, timeout)
+            return batch.events[after + 1:], batch.done
+
+    def status(self, batch_id):
+        ''' Returns the per-file state reached so far. Raise a `KeyError` '''
+
+        with self._condition:
+            batch = self._batches[batch_id]
+            files = {}
+            for event in batch.events:
+                if "index" in event:
+                    files[event["index"]] = event
+            return {"job_id": batch_id,
+                    "done": batch.done,
+                    "error_message": batch.error,
+                    "files": [files[index] for index in sorted(files)],
+                    "signed_file_list": batch.signed_file_list}
+
+    def _append(self, batch, event, fields):
+        fields.update({"id": len(batch.events), "event": event})
+        batch.events.append(fields)
+        self._condition.notify_all()
+
+    def _expire(self):
+        expired = time() - BATCH_TTL
+        for batch_id in [batch_id for batch_id, batch in self._batches.items()
+                         if batch.done and batch.finished_at < expired]:
+            del self._batches[batch_id]
@@ -0,0 +1,25 @@
+from importlib import import_module
+
+
+
+class LazyModule:
+    ''' Stands for module `name`, imported on the first access to one of its attributes
+
+        Keeps smart card, pdf and crypto libraries out of the server
+        startup, they are loaded by the first request or by the warm-up.
+    '''
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            # thread safe, import_module holds the import lock of the module
+            self._module = import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_import(name):
+    ''' Return a `LazyModule` for module `name` '''
+    return LazyModule(name)
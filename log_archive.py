@@ -0,0 +1,92 @@
+from my_config_loader import MyConfigLoader
+from os import path, listdir, fstat, stat
+from singleton_type import SingletonType
+from threading import Lock
+from zip_stream import compress
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+LOGS_FOLDER = MyConfigLoader().get_logger_config()["log_folder"]
+####################################################################
+
+
+class LogArchive(object, metaclass=SingletonType):
+    ''' Members of the /easylog archive
+
+        Log files are deflated once: the compressed data is kept until the
+        file changes, rotated files are renamed but keep inode, size and
+        modification time, so they are never compressed again.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        # (device, inode, mtime, size): CompressedMember
+        self._members = {}
+
+    def members(self, since=None, until=None):
+        ''' Log files with records between `since` and `until`, timestamps in seconds
+
+            Returns:
+                a generator of (archive name, `CompressedMember`), the
+                files are read only when the archive gets to them
+        '''
+
+        for file_name, file_path in self._select(since, until):
+            member = self._compressed(file_path)
+            if member is not None:
+                yield file_name, member
+
+    def _select(self, since, until):
+        log_files = []
+        for file_name in listdir(LOGS_FOLDER):
+            # digiSign.log and the rotated digiSign.log.N
+            if ".log" not in file_name or file_name.endswith(".zip"):
+                continue
+            file_path = path.join(LOGS_FOLDER, file_name)
+            try:
+                file_stat = stat(file_path)
+            except OSError:
+                continue
+            log_files.append((file_stat.st_mtime, file_name, file_path, _key(file_stat)))
+        log_files.sort()
+
+        with self._lock:
+            # forget the files changed or deleted by the rotation
+            keys = set(key for _, _, _, key in log_files)
+            for key in [key for key in self._members if key not in keys]:
+                del self._members[key]
+
+        # a file holds the records written after the previous one was rotated
+        selected = []
+        started = 0
+        for mtime, file_name, file_path, _ in log_files:
+            if (since is None or mtime >= since) and (until is None or started <= until):
+                selected.append((file_name, file_path))
+            started = mtime
+        return selected
+
+    def _compressed(self, file_path):
+        try:
+            with open(file_path, "rb") as _file:
+                key = _key(fstat(_file.fileno()))
+                with self._lock:
+                    member = self._members.get(key)
+                if member is not None:
+                    return member
+                data = _file.read()
+        except OSError:
+            return None
+
+        member = compress(data, key[2] / 1e9)
+        # the active log may grow while it is read
+        if len(data) == key[3]:
+            with self._lock:
+                self._members[key] = member
+        return member
+
+
+def _key(file_stat):
+    return file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
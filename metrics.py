@@ -0,0 +1,194 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from my_logger import get_logger
+from singleton_type import SingletonType
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# histogram upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# name: (type, help)
+METRICS = {
+    "digisign_stage_seconds": ("histogram", "Duration of the signing stages"),
+    "digisign_requests_total": ("counter", "Served requests by endpoint"),
+    "digisign_files_total": ("counter", "Files through the signing pipeline by signature type and result"),
+    "digisign_errors_total": ("counter", "Errors by exception class"),
+    "digisign_queue_depth": ("gauge", "Items waiting in the pipeline queues"),
+    "digisign_in_flight": ("gauge", "Files and bytes admitted, requests waiting for admission"),
+}
+# seconds between two pushes of a process values to the one serving /metrics
+PUSH_INTERVAL = 5.0
+####################################################################
+
+
+logger = get_logger("metrics")
+
+
+class Metrics(object, metaclass=SingletonType):
+    ''' Process-wide counters, gauges and latency histograms
+
+        Updates only touch a dictionary, the text exposition is built when
+        /metrics is scraped. Processes without an endpoint (pipeline
+        workers, HTTP workers) `drain()` their values, and the process
+        serving /metrics `merge()`s them.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (name, labels): [bucket counts..., +Inf bucket count, sum, count]
+            self._histograms = {}
+            # (name, labels): value
+            self._counters = {}
+            self._gauges = {}
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 3)
+            histogram[bisect_left(BUCKETS, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def drain(self):
+        ''' Return the values collected since last drain, and forget them (gauges are kept) '''
+
+        with self._lock:
+            values = (self._histograms, self._counters, dict(self._gauges))
+            self._histograms = {}
+            self._counters = {}
+        return values
+
+    def merge(self, values):
+        ''' Add the values drained by another process '''
+
+        if not values:
+            return
+        histograms, counters, gauges = values
+        with self._lock:
+            for key, other in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    self._histograms[key] = list(other)
+                else:
+                    for i, value in enumerate(other):
+                        histogram[i] += value
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            self._gauges.update(gauges)
+
+    def render(self):
+        ''' Prometheus text exposition format '''
+
+        with self._lock:
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "histogram":
+                for (_name, labels), histogram in sorted(histograms.items()):
+                    if _name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ("+Inf",), histogram):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {histogram[-2]}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram[-1]}")
+            else:
+                values = counters if metric_type == "counter" else gauges
+                for (_name, labels), value in sorted(values.items()):
+                    if _name == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsPusher(object, metaclass=SingletonType):
+    ''' Background push of the values of a process not serving /metrics
+
+        Requests only update the in-process `Metrics`, the values gathered
+        are sent every `PUSH_INTERVAL` seconds in one call, not one call
+        per request.
+    '''
+
+    def __init__(self):
+        self._stop = Event()
+        self._thread = None
+        self._send = None
+
+    def start(self, send):
+        ''' `send`: callable(values) handing drained values to the process serving /metrics '''
+        if self._thread is None:
+            self._send = send
+            self._thread = Thread(target=self._run, name="metrics-pusher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        ''' Stop pushing, the values gathered so far are sent '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.push()
+
+    def push(self):
+        values = Metrics().drain()
+        try:
+            self._send(values)
+        except:
+            # kept for the next push
+            Metrics().merge(values)
+            logger.warning("metrics not sent")
+
+    def _run(self):
+        while not self._stop.wait(PUSH_INTERVAL):
+            self.push()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+@contextmanager
+def timed(stage):
+    ''' Observe the duration of the block in digisign_stage_seconds '''
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        Metrics().observe("digisign_stage_seconds", perf_counter() - start, stage=stage)
+
+
+def count_error(err):
+    Metrics().inc("digisign_errors_total", exception=err.__class__.__name__)
+
+
+def worker_init():
+    ''' Pipeline process initializer, values inherited from the parent are not counted twice '''
+    Metrics().reset()
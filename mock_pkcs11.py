@@ -0,0 +1,83 @@
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from hashlib import sha256
+from PyKCS11 import LowLevel
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# holder of the software token certificate
+COMMON_NAME = "Mario Rossi"
+CODICE_FISCALE = "RSSMRA80A01H501U"
+SERIAL_NUMBER = 1234567
+KEY_SIZE = 2048
+####################################################################
+
+
+@lru_cache(maxsize=None)
+def token_identity():
+    ''' Private key and self signed DER certificate of the software token, made once per process '''
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=KEY_SIZE)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, COMMON_NAME),
+                      x509.NameAttribute(NameOID.SERIAL_NUMBER, f"TINIT-{CODICE_FISCALE}")])
+    now = datetime.now(timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                   .public_key(key.public_key()).serial_number(SERIAL_NUMBER)
+                   .not_valid_before(now - timedelta(days=1))
+                   .not_valid_after(now + timedelta(days=365))
+                   .sign(key, hashes.SHA256()))
+    return key, certificate
+
+
+class MockSession:
+    ''' Pure Python stand-in of a logged in `PyKCS11.Session`, with the
+        calls `SignatureUtils` makes: certificates, key references,
+        digests and SHA256-RSA-PKCS signatures made in software
+    '''
+
+    def __init__(self):
+        self._key, self._certificate = token_identity()
+        self._certificate_value = self._certificate.public_bytes(serialization.Encoding.DER)
+        self.sign_calls = 0
+
+    def login(self, pin):
+        pass
+
+    def logout(self):
+        pass
+
+    def closeSession(self):
+        pass
+
+    def findObjects(self, template):
+        object_class = dict(template)[LowLevel.CKA_CLASS]
+        if object_class == LowLevel.CKO_CERTIFICATE:
+            # smart cards hold two certificates, the signature one is the second
+            return ["authentication certificate", "signature certificate"]
+        return ["key"]
+
+    def getAttributeValue(self, token_object, attributes):
+        attribute = attributes[0]
+        if attribute == LowLevel.CKA_VALUE:
+            return [list(self._certificate_value)]
+        if attribute == LowLevel.CKA_ISSUER:
+            return [list(self._certificate.issuer.public_bytes())]
+        if attribute == LowLevel.CKA_SERIAL_NUMBER:
+            return [list(SERIAL_NUMBER.to_bytes((SERIAL_NUMBER.bit_length() + 8) // 8, "big"))]
+        if attribute == LowLevel.CKA_ID:
+            return [[1]]
+        raise ValueError(f"attribute {attribute} not available")
+
+    def digest(self, data, mechanism):
+        return list(sha256(bytes(data)).digest())
+
+    def sign(self, key, data, mechanism):
+        self.sign_calls += 1
+        return list(self._key.sign(bytes(data), padding.PKCS1v15(), hashes.SHA256()))
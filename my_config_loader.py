@@ -41,3 +41,39 @@ class MyConfigLoader(object, metaclass=SingletonType):
 
     def get_pdf_config(self):
         return self._config["pdf_conf"]
+
+    def get_pipeline_config(self):
+        return self._config["pipeline"]
+
+    def get_fetcher_config(self):
+        return self._config["fetcher"]
+
+    def get_uploader_config(self):
+        return self._config["uploader"]
+
+    def get_sign_cache_config(self):
+        return self._config["sign_cache"]
+
+    def get_profiling_config(self):
+        return self._config["profiling"]
+
+    def get_admission_config(self):
+        return self._config["admission"]
+
+    def get_tracing_config(self):
+        return self._config["tracing"]
+
+    def get_credentials_config(self):
+        return self._config["credentials"]
+
+    def get_trust_store_config(self):
+        return self._config["trust_store"]
+
+    def get_verify_config(self):
+        return self._config["verify"]
+
+    def get_crl_config(self):
+        return self._config["crl"]
+
+    def get_verify_cache_config(self):
+        return self._config["verify_cache"]
@@ -1,7 +1,14 @@
-from logging import getLogger, INFO, Formatter
-from logging.handlers import RotatingFileHandler
+from atexit import register
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from json import dumps
+from logging import getLogger, Filter, Formatter, Handler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from multiprocessing import SimpleQueue as ProcessSimpleQueue
 from my_config_loader import MyConfigLoader
-from os import path, mkdir
+from os import path, mkdir, register_at_fork
+from queue import SimpleQueue
 from singleton_type import SingletonType
 
 
@@ -15,28 +22,211 @@ LOGGING_FILE = MyConfigLoader().get_logger_config()["log_file_name"]
 LOGGING_FILE_PATH = path.join(LOGGING_FOLDER, LOGGING_FILE)
 FILE_SIZE = MyConfigLoader().get_logger_config()["file_byte_size"]
 LOG_FILE_COUNT = MyConfigLoader().get_logger_config()["log_files_count"]
+# default level, and the level of single modules: {module: level}
+LEVEL = MyConfigLoader().get_logger_config()["level"]
+MODULE_LEVELS = MyConfigLoader().get_logger_config()["module_levels"]
+# one JSON object per line, or plain text
+JSON_RECORDS = MyConfigLoader().get_logger_config()["json"]
+# fields of the job being served, added to every record
+CONTEXT_FIELDS = ("job", "file", "stage")
 ####################################################################
 
 
+# job, file and stage of the calling thread
+log_fields = ContextVar("log_fields", default={})
+# queue of the records of a child process, read by the writer process
+_writer_queue = None
+
+
 class MyLogger(object, metaclass=SingletonType):
+    ''' Application logger
+
+        Callers only put records in a queue, a listener thread formats and
+        writes them to the rotating log files: the signing threads never
+        wait for the disk.
+
+        Only the process that started the application opens the log files.
+        Its child processes, forked or spawned (HTTP workers, token owner,
+        process pools), put their records on an inter-process queue read
+        by a second listener of the writer: the files are never written
+        nor rotated by two processes, and a child has no listener thread
+        nor file handler.
+    '''
+
     _logger = None
 
     def __init__(self):
-        if not path.isdir(LOGGING_FOLDER):
-            mkdir(LOGGING_FOLDER)
-
         self._logger = getLogger(LOGGER_NAME)
-        self._logger.setLevel(INFO)
+        self._logger.removeHandler(_deferred_handler)
+        self._file_handler = None
+        self._listeners = []
+        self._process_queue = None
 
-        handler = RotatingFileHandler(
-            LOGGING_FILE_PATH, maxBytes=FILE_SIZE, backupCount=LOG_FILE_COUNT)
-        formatter = Formatter(
-            '%(asctime)s - [%(levelname)s | %(filename)s:%(lineno)s] > %(message)s')
-        handler.setFormatter(formatter)
-        self._logger.addHandler(handler)
+        if _writer_queue is not None:
+            self._queue_handler = QueueHandler(_writer_queue)
+        else:
+            if not path.isdir(LOGGING_FOLDER):
+                mkdir(LOGGING_FOLDER)
+            self._file_handler = RotatingFileHandler(
+                LOGGING_FILE_PATH, maxBytes=FILE_SIZE, backupCount=LOG_FILE_COUNT, delay=True)
+            if JSON_RECORDS:
+                self._file_handler.setFormatter(JsonFormatter())
+            else:
+                self._file_handler.setFormatter(Formatter(
+                    '%(asctime)s - [%(levelname)s | %(filename)s:%(lineno)s] > %(message)s'))
+            self._queue_handler = QueueHandler(SimpleQueue())
+            self._start_listener(self._queue_handler.queue)
+            register(self.stop)
 
-        self._logger.info("  ---  Started logger  ---")
+        # context fields are read in the calling thread, before queueing
+        self._queue_handler.addFilter(ContextFilter())
+        self._logger.addHandler(self._queue_handler)
 
+        if self._file_handler is not None:
+            self._logger.info("  ---  Started logger  ---")
 
     def my_logger(self):
         return self._logger
+
+    def stop(self):
+        ''' Write the queued records and stop the listeners '''
+
+        while self._listeners:
+            self._listeners.pop().stop()
+
+    def process_queue(self):
+        ''' Queue where child processes put their records, read by the writer '''
+
+        if _writer_queue is not None:
+            return _writer_queue
+        if self._process_queue is None:
+            self._process_queue = _ProcessQueue()
+            self._start_listener(self._process_queue)
+        return self._process_queue
+
+    def _start_listener(self, queue):
+        listener = QueueListener(queue, self._file_handler)
+        listener.start()
+        self._listeners.append(listener)
+
+    def _forward(self):
+        # child process: the listeners of the writer do not run here, and
+        # its file handler is never used
+        self._queue_handler.queue = _writer_queue
+        self._listeners = []
+        self._process_queue = None
+        self._file_handler = None
+
+
+class _ProcessQueue:
+    ''' Inter-process queue with the interface of `QueueHandler` and `QueueListener`
+
+        No feeder thread: a record is written to the pipe by the calling
+        thread, nothing is left behind when a child process exits.
+    '''
+
+    def __init__(self):
+        self._queue = ProcessSimpleQueue()
+
+    def put_nowait(self, record):
+        self._queue.put(record)
+
+    def get(self, block=True):
+        return self._queue.get()
+
+
+class ContextFilter(Filter):
+    ''' Add the `log_fields` of the calling thread to the record, `extra` fields win '''
+
+    def filter(self, record):
+        for field, value in log_fields.get().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+
+class JsonFormatter(Formatter):
+    ''' One JSON object per record: time, level, logger, module, line, message and context fields '''
+
+    def format(self, record):
+        item = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "line": record.lineno,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                item[field] = value
+        return dumps(item, default=str)
+
+
+class _DeferredHandler(Handler):
+    ''' Builds `MyLogger` with the first record, so importing a module opens no file and starts no thread '''
+
+    def handle(self, record):
+        return MyLogger()._queue_handler.handle(record)
+
+
+_deferred_handler = _DeferredHandler()
+_application_logger = getLogger(LOGGER_NAME)
+_application_logger.setLevel(LEVEL)
+_application_logger.propagate = False
+_application_logger.addHandler(_deferred_handler)
+
+
+def log_queue():
+    ''' Queue of the records of the child processes, to give to spawned ones '''
+    return MyLogger().process_queue()
+
+
+def use_log_queue(queue):
+    ''' Send the records of this child process to the writer reading `queue`,
+        called by the initializers of the spawned processes
+    '''
+
+    global _writer_queue
+    _writer_queue = queue
+    if MyLogger in SingletonType._instances:
+        MyLogger()._forward()
+
+
+def _before_fork():
+    # the child will need the queue of the writer
+    if _writer_queue is None:
+        log_queue()
+
+
+def _after_fork_in_child():
+    global _writer_queue
+    if _writer_queue is None:
+        _writer_queue = MyLogger().process_queue()
+        MyLogger()._forward()
+
+
+register_at_fork(before=_before_fork, after_in_child=_after_fork_in_child)
+
+
+def get_logger(module):
+    ''' Logger of `module`, a child of the application logger with the level of `MODULE_LEVELS` '''
+
+    logger = getLogger(f"{LOGGER_NAME}.{module}")
+    if module in MODULE_LEVELS:
+        logger.setLevel(MODULE_LEVELS[module])
+    return logger
+
+
+@contextmanager
+def log_context(**fields):
+    ''' Add `fields` (job, file, stage) to the records logged inside the block '''
+
+    token = log_fields.set({**log_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        log_fields.reset(token)
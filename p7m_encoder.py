@@ -1,6 +1,7 @@
 from asn1 import Encoder, Numbers, Classes
 from datetime import datetime
-from my_logger import MyLogger
+from my_logger import get_logger
+from tracing import traced
 
 
 
@@ -23,6 +24,9 @@ SIGNING_CERTIFICATE_V2 = "1.2.840.113549.1.9.16.2.47"
 ####################################################################
 
 
+logger = get_logger("p7m_encoder")
+
+
 class P7mAttributes:
     def __init__(self, algos, certificates, signer_infos):
         self.algos = algos
@@ -33,6 +37,7 @@ class P7mAttributes:
 class P7mEncoder:
 
     @staticmethod
+    @traced("p7m_encoder.make_a_p7m")
     def make_a_p7m(content, certificate_value, signer_info, p7m_sig_attrs: P7mAttributes):
         '''
             Return a well formed complete p7m
@@ -47,7 +52,7 @@ class P7mEncoder:
         p7m = Encoder()
         p7m.start()
 
-        MyLogger().my_logger().info("encoding p7m")
+        logger.info("encoding p7m")
         p7m.enter(Numbers.Sequence)  # 1
         p7m.write(PKCS7_SIGNED_DATA, Numbers.ObjectIdentifier)
         p7m.enter(ZERO_TAG, Classes.Context)  # 2
@@ -69,6 +74,7 @@ class P7mEncoder:
 
 
     @staticmethod
+    @traced("p7m_encoder.encode_signer_info")
     def encode_signer_info(issuer, serial_number,
                            signed_attributes, signed_bytes, existing_sig_infos):
         ''' Return a well formed signer info p7m field
@@ -83,7 +89,7 @@ class P7mEncoder:
         signer_info = Encoder()
         signer_info.start()
 
-        MyLogger().my_logger().info("encoding signer info")
+        logger.info("encoding signer info")
         signer_info.enter(Numbers.Set)  # 1
         signer_info.enter(Numbers.Sequence)  # 2
         signer_info._emit(P7mEncoder._version_number())
@@ -116,6 +122,7 @@ class P7mEncoder:
 
 
     @staticmethod
+    @traced("p7m_encoder.encode_signed_attributes")
     def encode_signed_attributes(content_hash, certificate_hash):
         ''' Return a well formed signed attributes p7m field
 
@@ -127,7 +134,7 @@ class P7mEncoder:
         signed_attributes = Encoder()
         signed_attributes.start()
 
-        MyLogger().my_logger().info("encoding signed attributes")
+        logger.info("encoding signed attributes")
         signed_attributes.enter(ZERO_TAG, Classes.Context)
         signed_attributes._emit(P7mEncoder._get_signed_attributes(
             content_hash, certificate_hash))
@@ -137,6 +144,7 @@ class P7mEncoder:
 
 
     @staticmethod
+    @traced("p7m_encoder.bytes_to_sign")
     def bytes_to_sign(content_hash, certificate_hash):
         ''' Return the p7m part that needs to be signed
 
@@ -148,7 +156,7 @@ class P7mEncoder:
         signed_attributes = Encoder()
         signed_attributes.start()
 
-        MyLogger().my_logger().info("building bytes to sign")
+        logger.info("building bytes to sign")
         signed_attributes.enter(Numbers.Set)
         signed_attributes._emit(P7mEncoder._get_signed_attributes(
             content_hash, certificate_hash))
@@ -1,20 +1,30 @@
+import hashlib
 import pdf_signer
 from io import BytesIO
 from zlib import compress
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfparser import PDFParser
 from datetime import datetime, timezone
-from PyKCS11 import Mechanism, LowLevel
 from asn1crypto.x509 import Certificate
 
-from my_config_loader import MyConfigLoader
-from my_logger import MyLogger
+from functools import lru_cache
+from my_config_loader import MyConfigLoader, BASE_PATH
+from os import path
+from my_logger import get_logger
+from metrics import timed
+from tracing import traced
+
+
+
+logger = get_logger("pdf_builder")
 
 FRM_STREAM = b'q 1 0 0 1 0 0 cm /FRM Do Q\n'
 N0_N2_STREAM = b'q 1 0 0 1 0 0 cm /n0 Do Q\nq 1 0 0 1 0 0 cm /n2 Do Q\n'
 DSBLANK_STREAM = b'% DSBlank\n'
 STREAM_WITH_NAME = b'BT\n1 0 0 1 2 28 Tm\n/F1 12 Tf\n()Tj\n1 0 0 1 2 16 Tm\n(%s)Tj\nET\n'
 sig_names = {}
+# ArialMT of the visible signatures
+FONT_FILE = path.join(BASE_PATH, "encoded_font.bin")
 
 
 # Custom exceptions:
@@ -79,6 +89,8 @@ class SignedData(object):
         return sig_names
 
     def get_signature_names(self, document):
+        # names are collected per document
+        sig_names.clear()
         sorter = []
         try:
             acrofields = document.catalog['AcroForm']['Fields']
@@ -177,7 +189,7 @@ class SignedData(object):
             self.makeobj_stream(no + 8, b'/Subtype/Form/Filter/FlateDecode/Type/XObject/Matrix [1 0 0 1 0 0]/FormType 1/Resources<</ProcSet [/PDF /Text /ImageB /ImageC /ImageI]/Font<</F1 %d 0 R>>>>/BBox[0 0 200 60]/Length %d' % (no + 9, len(stream_name)), stream_name),
             self.makeobj(no + 9, b'/Subtype/TrueType/FirstChar 32/Type/Font/BaseFont/ArialMT/FontDescriptor %d 0 R/Encoding/WinAnsiEncoding/LastChar 126/Widths[277 277 354 556 556 889 666 190 333 333 389 583 277 333 277 277 556 556 556 556 556 556 556 556 556 556 277 277 583 583 583 556 1015 666 666 722 722 666 610 777 722 277 500 666 556 833 722 777 666 777 722 666 610 722 666 943 666 666 610 277 277 277 469 556 333 556 556 500 556 556 277 556 556 222 222 500 222 833 556 556 556 556 333 500 277 556 500 722 500 500 500 333 259 333 583]' % (no + 10)),
             self.makeobj(no + 10, b'/Descent -210/CapHeight 716/StemV 80/Type/FontDescriptor/FontFile2 %d 0 R/Flags 32/FontBBox[-664 -324 2000 1039]/FontName/ArialMT/ItalicAngle 0/Ascent 728' % (no + 11)),
-            self.makeobj_font_stream(no + 11, b'/Length1 96488/Filter/FlateDecode/Length 44982', open('encoded_font.bin', 'rb').read().decode('unicode-escape').encode('ISO-8859-1')),
+            self.makeobj_font_stream(no + 11, b'/Length1 96488/Filter/FlateDecode/Length 44982', font_stream()),
             self.makeobj(no + 12, b'/Name/ZaDb/Subtype/Type1/Type/Font/BaseFont/ZapfDingbats'),
             self.makeobj(no + 13, b'/Name/Helv/Subtype/Type1/Type/Font/BaseFont/Helvetica/Encoding/WinAnsiEncoding'),
         ]
@@ -207,7 +219,7 @@ class SignedData(object):
             self.makeobj_stream(no + 7, b'/Subtype/Form/Filter/FlateDecode/Type/XObject/Matrix [1 0 0 1 0 0]/FormType 1/Resources<</ProcSet [/PDF /Text /ImageB /ImageC /ImageI]/Font<</F1 %d 0 R>>>>/BBox[0 0 200 60]/Length %d' % (no + 8, len(stream_name)), stream_name),
             self.makeobj(no + 8, b'/Subtype/TrueType/FirstChar 32/Type/Font/BaseFont/ArialMT/FontDescriptor %d 0 R/Encoding/WinAnsiEncoding/LastChar 126/Widths[277 277 354 556 556 889 666 190 333 333 389 583 277 333 277 277 556 556 556 556 556 556 556 556 556 556 277 277 583 583 583 556 1015 666 666 722 722 666 610 777 722 277 500 666 556 833 722 777 666 777 722 666 610 722 666 943 666 666 610 277 277 277 469 556 333 556 556 500 556 556 277 556 556 222 222 500 222 833 556 556 556 556 333 500 277 556 500 722 500 500 500 333 259 333 583]' % (no + 9)),
             self.makeobj(no + 9, b'/Descent -210/CapHeight 716/StemV 80/Type/FontDescriptor/FontFile2 %d 0 R/Flags 32/FontBBox[-664 -324 2000 1039]/FontName/ArialMT/ItalicAngle 0/Ascent 728' % (no + 10)),
-            self.makeobj_font_stream(no + 10, b'/Length1 96488/Filter/FlateDecode/Length 44982', open('encoded_font.bin', 'rb').read().decode('unicode-escape').encode('ISO-8859-1')),
+            self.makeobj_font_stream(no + 10, b'/Length1 96488/Filter/FlateDecode/Length 44982', font_stream()),
         ])
         return objs
 
@@ -312,10 +324,11 @@ xref\n\
 %(n4)010d 00000 n \n\
 '''
 
+    @traced("pdf_builder.makepdf")
     def makepdf(self, pdfdata1, udct, zeros, sig_attributes):
         parser = PDFParser(BytesIO(pdfdata1))
         document = PDFDocument(parser, fallback=False)
-        MyLogger().my_logger().info('get datas from pdf')
+        logger.info('get datas from pdf')
         prev = document.find_xref(parser)
         info = document.xrefs[0].trailer['Info'].objid
         root = document.xrefs[0].trailer['Root'].objid
@@ -323,7 +336,7 @@ xref\n\
         page_objid = document.catalog['Pages'].objid
         page = None
 
-        MyLogger().my_logger().info('check attributes...')
+        logger.info('check attributes...')
         if not sig_attributes:
             visibility = MyConfigLoader().get_pdf_config()['visibility']
             position = MyConfigLoader().get_pdf_config()['position']
@@ -341,7 +354,7 @@ xref\n\
             try:
                 page = document.getobj(page_objid)['Kids'][int(page_pos) - 1].objid
             except Exception:
-                MyLogger().my_logger().error('page not found...take the latest')
+                logger.error('page not found...take the latest')
                 pages_count = document.getobj(page_objid)['Count']
                 page = document.getobj(page_objid)['Kids'][pages_count - 1].objid
 
@@ -355,7 +368,7 @@ xref\n\
         if signatures.__len__() > 0:
             multiple_signs = True
 
-        MyLogger().my_logger().info(f'visibility is {visibility}')
+        logger.info(f'visibility is {visibility}')
         if visibility == 'visible':
             rect_array = self.get_rect_array(pagedata, position)
             stream_name = compress(STREAM_WITH_NAME % udct[b'name'])
@@ -407,8 +420,14 @@ startxref\n\
 
         return pdfdata2
 
-    def sign(self, datau, session, cert, cert_value, algomd, sig_attributes):
-        MyLogger().my_logger().info('get certificate in format x509 to build signer attributes')
+    @traced("pdf_builder.prepare")
+    def prepare(self, datau, cert_value, algomd, sig_attributes):
+        ''' Build the incremental update, it does not need the smart card
+
+            Returns:
+                the incremental update, the signature placeholder and the digest to sign
+        '''
+        logger.info('get certificate in format x509 to build signer attributes')
         x509 = Certificate.load(cert_value)
         time_stamp = self.get_timestamp()
         dct = {
@@ -419,14 +438,15 @@ startxref\n\
 
         zeros = self.aligned(b'\0')
 
-        MyLogger().my_logger().info('start building the new pdf')
+        logger.info('start building the new pdf')
         try:
-            pdfdata2 = self.makepdf(datau, dct, zeros, sig_attributes)
-            MyLogger().my_logger().info('pdf generated correctly')
+            with timed("makepdf"):
+                pdfdata2 = self.makepdf(datau, dct, zeros, sig_attributes)
+            logger.info('pdf generated correctly')
         except Exception:
             raise PDFCreationError('Exception on creating pdf')
 
-        MyLogger().my_logger().info('preparing data to be signed')
+        logger.info('preparing data to be signed')
         startxref = len(datau)
         pdfbr1 = pdfdata2.find(zeros)
         pdfbr2 = pdfbr1 + len(zeros)
@@ -437,23 +457,50 @@ startxref\n\
 
         b1 = pdfdata2[:br[1] - startxref]
         b2 = pdfdata2[br[2] - startxref:]
-        md = session.digestSession(Mechanism(LowLevel.CKM_SHA256))
-        md.update(datau)
-        md.update(b1)
-        md.update(b2)
-        md = bytes(md.final())
-        MyLogger().my_logger().info('start pdf signing')
+        with timed("hashing"):
+            md = getattr(hashlib, algomd)()
+            md.update(datau)
+            md.update(b1)
+            md.update(b2)
+        return pdfdata2, zeros, md.digest()
+
+    @traced("pdf_builder.finalize")
+    def finalize(self, pdfdata2, zeros, contents):
+        ''' Replace the signature placeholder with the signed `contents` '''
+        contents = self.aligned(contents)
+        return pdfdata2.replace(zeros, contents, 1)
+
+    @traced("pdf_builder.sign")
+    def sign(self, datau, session, cert, cert_value, algomd, sig_attributes):
+        pdfdata2, zeros, md = self.prepare(datau, cert_value, algomd, sig_attributes)
+        logger.info('start pdf signing')
         try:
             contents = pdf_signer.sign(None, session, cert, cert_value, algomd, True, md)
-            contents = self.aligned(contents)
-            pdfdata2 = pdfdata2.replace(zeros, contents, 1)
-            MyLogger().my_logger().info('pdf signed')
+            pdfdata2 = self.finalize(pdfdata2, zeros, contents)
+            logger.info('pdf signed')
         except Exception:
             raise PDFSigningError('error in the sign procedure')
 
         return pdfdata2
 
 
+def prepare(datau, cert_value, algomd, sig_attributes):
+        cls = SignedData()
+        return cls.prepare(datau, cert_value, algomd, sig_attributes)
+
+
+def finalize(pdfdata2, zeros, contents):
+        cls = SignedData()
+        return cls.finalize(pdfdata2, zeros, contents)
+
+
 def sign(datau, session, cert, cert_value, algomd, sig_attributes):
         cls = SignedData()
         return cls.sign(datau, session, cert, cert_value, algomd, sig_attributes)
+
+
+@lru_cache(maxsize=None)
+def font_stream():
+    ''' Font file stream of the visible signatures, read and decoded once per process '''
+    with open(FONT_FILE, 'rb') as _file:
+        return _file.read().decode('unicode-escape').encode('ISO-8859-1')
@@ -6,9 +6,15 @@ from asn1crypto import cms, algos, core, tsp
 from signature_util import SignatureUtils
 from asn1crypto.x509 import Certificate
 from PyKCS11 import Mechanism, LowLevel
-from my_logger import MyLogger
+from my_logger import get_logger
+from tracing import traced
 
 
+
+logger = get_logger("pdf_signer")
+
+
+@traced("pdf_signer.sign")
 def sign(datau, session, cert, cert_value, hashalgo, attrs=True, signed_value=None):
     if signed_value is None:
         signed_value = getattr(hashlib, hashalgo)(datau).digest()
@@ -19,7 +25,7 @@ def sign(datau, session, cert, cert_value, hashalgo, attrs=True, signed_value=No
     certificates.append(x509)
 
     cert_value_digest = bytes(session.digest(cert_value, Mechanism(LowLevel.CKM_SHA256)))
-    MyLogger().my_logger().info('building signed attributes...')
+    logger.info('building signed attributes...')
     signer = {
         'version': 'v1',
         'sid': cms.SignerIdentifier({
@@ -80,11 +86,11 @@ def sign(datau, session, cert, cert_value, hashalgo, attrs=True, signed_value=No
     else:
         tosign = datau
 
-    MyLogger().my_logger().info('signed attributes ready')
+    logger.info('signed attributes ready')
     # fetching private key from smart card
     priv_key = SignatureUtils.fetch_private_key(session, cert)
     mechanism = Mechanism(LowLevel.CKM_SHA256_RSA_PKCS, None)
-    MyLogger().my_logger().info('signing...')
+    logger.info('signing...')
     # signing bytes to be signed
     signature = session.sign(priv_key, tosign, mechanism)
 
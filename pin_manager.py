@@ -0,0 +1,215 @@
+from datetime import datetime, timedelta
+from hashlib import sha256
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import environ
+from re import sub
+from threading import Lock
+import sys
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# Memorized pin
+memorized_pin = {}
+PIN_TIMEOUT = MyConfigLoader().get_server_config()["pin_validity_time"]
+# never open a window: unattended batch signing and servers. Always set
+# by the production server, a popup would hold a request for GUI_TIMEOUT
+HEADLESS = MyConfigLoader().get_credentials_config()["headless"]
+# asked in order, the first PIN found is used: env, keyring, stdin, gui.
+# None found fails the login at once
+PIN_PROVIDERS = MyConfigLoader().get_credentials_config()["pin_providers"]
+# DIGISIGN_PIN_<USER_ID>, else DIGISIGN_PIN
+PIN_ENV = MyConfigLoader().get_credentials_config()["pin_env"]
+KEYRING_SERVICE = MyConfigLoader().get_credentials_config()["keyring_service"]
+# seconds before an unanswered popup is closed
+GUI_TIMEOUT = MyConfigLoader().get_credentials_config()["gui_timeout"]
+####################################################################
+
+
+logger = get_logger("pin_manager")
+
+# {user_id: {provider: digest}} of the stored PINs the smart card refused,
+# not given again: retrying them would lock the card
+_rejected_pins = {}
+# one console prompt at a time
+_stdin_lock = Lock()
+
+
+def clear_pin(user_id, rejected=False):
+    ''' Forget the memorized `PIN`, `rejected` when the smart card refused it '''
+
+    logger.info("Clearing PIN")
+    if user_id in memorized_pin:
+        if rejected and "pin" in memorized_pin[user_id] and "provider" in memorized_pin[user_id]:
+            _rejected_pins.setdefault(user_id, {})[memorized_pin[user_id]["provider"]] = \
+                _digest(memorized_pin[user_id]["pin"])
+        for item in ("timestamp", "pin", "provider"):
+            memorized_pin[user_id].pop(item, None)
+
+
+def get_user_pin(user_id):
+    ''' Returns the memorized `PIN`, asking it when needed '''
+    get_pin(user_id)
+    return memorized_pin[user_id]["pin"]
+
+
+def get_pin(user_id):
+    ''' Gets you the `PIN` '''
+
+    if user_id not in memorized_pin:
+        memorized_pin[user_id] = {}
+
+    if "pin" not in memorized_pin[user_id]:
+        _ask_pin(user_id)
+    elif not _is_pin_valid(user_id):
+        logger.info("Invalidating PIN")
+        clear_pin(user_id)
+        _ask_pin(user_id)
+    else:
+        logger.info("Refreshing PIN")
+        memorized_pin[user_id]["timestamp"] = datetime.now()
+
+    # check for mishapening
+    if "pin" not in memorized_pin[user_id]:
+        raise ValueError("No pin inserted")
+
+
+def _ask_pin(user_id):
+    ''' Memorize the `PIN` of the first of `PIN_PROVIDERS` giving one '''
+
+    for name in PIN_PROVIDERS:
+        if name not in _PROVIDERS:
+            logger.warning(f"unknown PIN provider {name}")
+            continue
+        try:
+            pin = _PROVIDERS[name](user_id)
+        except Exception as err:
+            logger.warning(f"PIN provider {name} failed: {err.__class__.__name__} {err}")
+            continue
+        if not pin:
+            continue
+        if _rejected_pins.get(user_id, {}).get(name) == _digest(pin):
+            logger.warning(f"PIN from {name} already refused by the smart card, skipped")
+            continue
+        logger.info(f"PIN given by {name}")
+        memorized_pin[user_id].update(pin=pin, provider=name, timestamp=datetime.now())
+        return
+
+
+def _env_pin(user_id):
+    ''' `PIN` from the environment: DIGISIGN_PIN_<USER_ID>, else DIGISIGN_PIN '''
+
+    user_variable = f"{PIN_ENV}_{sub(r'[^0-9A-Za-z]', '_', user_id).upper()}"
+    return environ.get(user_variable) or environ.get(PIN_ENV)
+
+
+def _keyring_pin(user_id):
+    ''' `PIN` stored in the system keyring, service `KEYRING_SERVICE` and user `user_id` '''
+
+    # optional dependency
+    try:
+        import keyring
+    except ImportError:
+        return None
+    return keyring.get_password(KEYRING_SERVICE, user_id)
+
+
+def _stdin_pin(user_id):
+    ''' `PIN` typed on the console, only when attached to a terminal '''
+
+    if sys.stdin is None or not sys.stdin.isatty():
+        return None
+    from getpass import getpass
+    with _stdin_lock:
+        return getpass(f"Smart Card PIN ({user_id}): ")
+
+
+def _gui_pin(user_id):
+    ''' `PIN` typed in a popup, never in `HEADLESS` mode '''
+
+    if HEADLESS:
+        return None
+    return _get_pin_popup(user_id)
+
+
+def _digest(pin):
+    return sha256(pin.encode()).hexdigest()
+
+
+_PROVIDERS = {
+    "env": _env_pin,
+    "keyring": _keyring_pin,
+    "stdin": _stdin_pin,
+    "gui": _gui_pin,
+}
+
+
+def has_valid_pin(user_id):
+    ''' Check if a `PIN` is memorized and not expired, the user is still authenticated '''
+
+    return "pin" in memorized_pin.get(user_id, {}) and _is_pin_valid(user_id)
+
+
+def _is_pin_valid(user_id):
+    ''' Check if `PIN` is expired '''
+
+    return datetime.now() < memorized_pin[user_id]["timestamp"] + timedelta(seconds=PIN_TIMEOUT)
+
+
+def _get_pin_popup(user_id):
+    ''' Little popup to input Smart Card PIN, closed after `GUI_TIMEOUT` seconds
+
+        Returns:
+            the PIN, None when the popup is closed
+    '''
+
+    # imported here, the popup is only needed when no PIN is memorized
+    from tkinter import Tk, Entry, Label, Button, Frame
+
+    logger.info("User PIN input")
+    widget = Tk()
+    row = Frame(widget)
+    label = Label(row, width=10, text="Insert PIN")
+    pinbox = Entry(row, width=15, show='*')
+    row.pack(side="top", padx=60, pady=20)
+    label.pack(side="left")
+    pinbox.pack(side="right")
+
+    def on_enter(evt):
+        on_click()
+
+    pin = None
+
+    def on_click():
+        nonlocal pin
+        pin = pinbox.get()
+        widget.destroy()
+
+    pinbox.bind("<Return>", on_enter)
+    button = Button(widget, command=on_click, text="OK")
+    button.pack(side="top", fill="x", padx=80)
+    filler = Label(widget, height=1, text="")
+    filler.pack(side="top")
+
+    widget.title("Smart Card PIN")
+    widget.attributes("-topmost", True)
+    widget.update()
+    _center(widget)
+    widget.after(GUI_TIMEOUT * 1000, widget.destroy)
+    widget.mainloop()
+    return pin
+
+
+def _center(widget):
+    ''' Center `widget` on the screen '''
+    screen_width = widget.winfo_screenwidth()
+    screen_height = widget.winfo_screenheight()
+
+    x = screen_width / 2 - widget.winfo_width() / 2
+    # Little higher than center
+    y = screen_height / 2 - widget.winfo_height()
+
+    widget.geometry(f"+{int(x)}+{int(y)}")
@@ -0,0 +1,198 @@
+from argparse import ArgumentParser
+from cProfile import Profile
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import request, make_response
+from functools import wraps
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import path, makedirs, listdir, getpid
+from pstats import Stats
+from threading import Event, Thread, get_ident
+from uuid import uuid4
+import sys
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# profile every /api/sign and /upload request
+ENABLED = MyConfigLoader().get_profiling_config()["enabled"]
+# or only the requests carrying this header
+HEADER = MyConfigLoader().get_profiling_config()["header"]
+# cprofile (deterministic, pstats files) | sample (collapsed stacks)
+MODE = MyConfigLoader().get_profiling_config()["mode"]
+# seconds between two stack samples
+SAMPLE_INTERVAL = MyConfigLoader().get_profiling_config()["sample_interval"]
+PROFILES_FOLDER = MyConfigLoader().get_profiling_config()["profiles_folder"]
+# modules summarised by the CLI
+HOT_MODULES = ("pdf_builder", "pdf_signer", "signature_util", "verifier")
+####################################################################
+
+
+logger = get_logger("profiling")
+
+
+# id of the request being profiled, read by the pipeline to tag its jobs
+current_profile = ContextVar("current_profile", default=None)
+
+
+def wanted(headers):
+    ''' Returns if a request with `headers` must be profiled '''
+    return ENABLED or bool(headers.get(HEADER))
+
+
+def profiled_request(view):
+    ''' Flask view decorator profiling the request when `wanted()`,
+        the request id is given back in the X-Request-Id header
+    '''
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not wanted(request.headers):
+            return view(*args, **kwargs)
+        with request_profile() as request_id:
+            response = make_response(view(*args, **kwargs))
+        response.headers["X-Request-Id"] = request_id
+        return response
+
+    return wrapper
+
+
+@contextmanager
+def request_profile():
+    ''' Profile the calling thread for the whole block
+
+        Pipeline jobs started inside the block are profiled in their
+        worker processes too, every file is tagged with the request id.
+
+        Returns:
+            the request id
+    '''
+
+    request_id = uuid4().hex
+    token = current_profile.set(request_id)
+    try:
+        with profiled(request_id, "request"):
+            yield request_id
+    finally:
+        current_profile.reset(token)
+        logger.info(f"request {request_id} profiled in {PROFILES_FOLDER}")
+
+
+@contextmanager
+def profiled(request_id, stage):
+    ''' Profile the calling thread, nothing is done when `request_id` is None '''
+
+    if request_id is None:
+        yield
+        return
+
+    makedirs(PROFILES_FOLDER, exist_ok=True)
+    file_name = path.join(PROFILES_FOLDER, f"{request_id}.{stage}.{getpid()}.{uuid4().hex[:8]}")
+    if MODE == "sample":
+        sampler = StackSampler(get_ident())
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.dump(f"{file_name}.collapsed")
+    else:
+        profile = Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(f"{file_name}.prof")
+
+
+class StackSampler:
+    ''' Samples the stack of a thread, in collapsed stack format (flamegraph.pl, speedscope) '''
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, file_name):
+        with open(file_name, "w") as _file:
+            for stack, count in self.stacks.items():
+                _file.write(f"{stack} {count}\n")
+
+
+####################################################################
+#       CLI                                                        #
+####################################################################
+def summary(folder, request_id=None, top=20):
+    ''' Print the hottest functions of `HOT_MODULES` in the profiles of `folder` '''
+
+    names = [name for name in listdir(folder)
+             if request_id is None or name.startswith(f"{request_id}.")]
+    prof_files = [path.join(folder, name) for name in names if name.endswith(".prof")]
+    collapsed_files = [path.join(folder, name) for name in names if name.endswith(".collapsed")]
+
+    if prof_files:
+        stats = Stats(*prof_files)
+        rows = []
+        for (file_name, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            module = path.splitext(path.basename(file_name))[0]
+            if module in HOT_MODULES:
+                rows.append((tottime, cumtime, calls, f"{module}.py:{line}({function})"))
+        print(f"{len(prof_files)} pstats files")
+        print(f"{'tottime':>10} {'cumtime':>10} {'calls':>8}  function")
+        for tottime, cumtime, calls, function in sorted(rows, reverse=True)[:top]:
+            print(f"{tottime:10.4f} {cumtime:10.4f} {calls:8d}  {function}")
+
+    if collapsed_files:
+        own = Counter()
+        total = Counter()
+        samples = 0
+        for file_name in collapsed_files:
+            with open(file_name) as _file:
+                for line in _file:
+                    stack, count = line.rsplit(" ", 1)
+                    count = int(count)
+                    samples += count
+                    frames = stack.split(";")
+                    own[frames[-1]] += count
+                    for frame in set(frames):
+                        total[frame] += count
+        print(f"{len(collapsed_files)} collapsed stack files, {samples} samples")
+        print(f"{'own':>8} {'total':>8}  function")
+        hot = [frame for frame in total
+               if path.splitext(frame.split(":")[0])[0] in HOT_MODULES]
+        for frame in sorted(hot, key=lambda frame: (own[frame], total[frame]), reverse=True)[:top]:
+            print(f"{own[frame]:8d} {total[frame]:8d}  {frame}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Hottest functions of the profiled sign requests")
+    parser.add_argument("folder", nargs="?", default=PROFILES_FOLDER)
+    parser.add_argument("--request", help="only the files of this request id")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+    summary(args.folder, args.request, args.top)
@@ -0,0 +1,138 @@
+from hashlib import sha256
+from json import dumps
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import path, makedirs, listdir, remove, replace, stat
+from singleton_type import SingletonType
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+ENABLED = MyConfigLoader().get_sign_cache_config()["enabled"]
+# on disk, shared by every HTTP worker and pipeline process
+CACHE_FOLDER = MyConfigLoader().get_sign_cache_config()["cache_folder"]
+# seconds a signed artifact is given back for a repeated request
+TTL = MyConfigLoader().get_sign_cache_config()["ttl"]
+MAX_ENTRIES = MyConfigLoader().get_sign_cache_config()["max_entries"]
+MAX_BYTES = MyConfigLoader().get_sign_cache_config()["max_bytes"]
+####################################################################
+
+
+logger = get_logger("sign_cache")
+
+
+class SignCache(object, metaclass=SingletonType):
+    ''' Content addressed cache of signed artifacts
+
+        A retried request for the same file, signature type, sig_attributes
+        and signer certificate gets back the artifact signed the first
+        time, without using the smart card again.
+
+        The certificate of each user is kept too, so a fully cached batch
+        does not even need a login.
+    '''
+
+    def __init__(self):
+        self.enabled = ENABLED
+        self._lock = Lock()
+        self._artifacts = path.join(CACHE_FOLDER, "artifacts")
+        self._certificates = path.join(CACHE_FOLDER, "certificates")
+        if self.enabled:
+            makedirs(self._artifacts, exist_ok=True)
+            makedirs(self._certificates, exist_ok=True)
+
+    @staticmethod
+    def key(content, signature_type, sig_attributes, certificate_value):
+        ''' Cache key of a signature request for `content` '''
+
+        request = dumps([signature_type, sig_attributes], sort_keys=True)
+        key = sha256(sha256(content).digest())
+        key.update(sha256(certificate_value).digest())
+        key.update(request.encode())
+        return key.hexdigest()
+
+    def get(self, key):
+        ''' Return the signed artifact of `key`, None when missing or expired '''
+
+        if not self.enabled:
+            return None
+        return self._read(path.join(self._artifacts, key))
+
+    def put(self, key, signed_content):
+        if not self.enabled:
+            return
+        self._write(path.join(self._artifacts, key), signed_content)
+        self._evict()
+
+    def certificate(self, user_id):
+        ''' Return the certificate value last used by `user_id`, None when unknown or expired '''
+
+        if not self.enabled:
+            return None
+        return self._read(path.join(self._certificates, _user_key(user_id)))
+
+    def remember_certificate(self, user_id, certificate_value):
+        if not self.enabled:
+            return
+        self._write(path.join(self._certificates, _user_key(user_id)), certificate_value)
+
+    @staticmethod
+    def _read(file_path):
+        try:
+            if time() - stat(file_path).st_mtime > TTL:
+                return None
+            with open(file_path, "rb") as _file:
+                return _file.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _write(file_path, content):
+        # atomic, other processes never read a partial entry
+        temp_path = f"{file_path}.{uuid4().hex}.part"
+        try:
+            with open(temp_path, "wb") as _file:
+                _file.write(content)
+            replace(temp_path, file_path)
+        except OSError:
+            logger.warning(f"can not write cache entry {file_path}")
+            if path.exists(temp_path):
+                remove(temp_path)
+
+    def _evict(self):
+        ''' Remove expired entries, then the oldest ones above the size limits '''
+
+        with self._lock:
+            now = time()
+            entries = []
+            for name in listdir(self._artifacts):
+                if name.endswith(".part"):
+                    continue
+                entry_path = path.join(self._artifacts, name)
+                try:
+                    entry = stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((entry.st_mtime, entry.st_size, entry_path))
+
+            entries.sort()
+            total_bytes = sum(size for _, size, _ in entries)
+            count = len(entries)
+            for mtime, size, entry_path in entries:
+                if now - mtime <= TTL and count <= MAX_ENTRIES and total_bytes <= MAX_BYTES:
+                    break
+                try:
+                    remove(entry_path)
+                except OSError:
+                    pass
+                count -= 1
+                total_bytes -= size
+
+
+def _user_key(user_id):
+    return sha256(user_id.encode()).hexdigest()
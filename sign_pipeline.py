@@ -0,0 +1,536 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from lazy_import import lazy_import
+from metrics import Metrics, count_error, timed, worker_init
+from mimetypes import MimeTypes
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger, log_context, log_queue, use_log_queue
+from os import cpu_count, path
+from profiling import current_profile, profiled
+from queue import Queue
+from sign_cache import SignCache
+from singleton_type import SingletonType
+from threading import BoundedSemaphore, Condition, Lock, Thread
+from tracing import Tracer, current_trace, span, trace_context
+from uuid import uuid4
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# process pool size for CPU-bound stages (0 = one per core)
+CPU_WORKERS = MyConfigLoader().get_pipeline_config()["cpu_workers"] or cpu_count()
+# thread pool size for I/O-bound stages
+IO_WORKERS = MyConfigLoader().get_pipeline_config()["io_workers"]
+# prepared files waiting for the smart card
+TOKEN_QUEUE_SIZE = MyConfigLoader().get_pipeline_config()["token_queue_size"]
+# Allowed signature types
+P7M = "p7m"
+PDF = "pdf"
+####################################################################
+
+
+logger = get_logger("sign_pipeline")
+# smart card, pdf and crypto libraries are loaded on first use
+digiSign_lib = lazy_import("digiSign_lib")
+pdf_builder = lazy_import("pdf_builder")
+pdf_signer = lazy_import("pdf_signer")
+signature_util = lazy_import("signature_util")
+
+
+class StagePools(object, metaclass=SingletonType):
+    ''' Process and thread pools shared by every pipeline run '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._cpu_workers = CPU_WORKERS
+        self._cpu_pool = None
+        self._io_pool = None
+        self._deliver_pool = None
+
+    def set_cpu_workers(self, cpu_workers):
+        ''' Size of the process pool, before its first use '''
+        self._cpu_workers = cpu_workers
+
+    def cpu_pool(self):
+        with self._lock:
+            if self._cpu_pool is None:
+                logger.info(f"starting {self._cpu_workers} pipeline processes")
+                self._cpu_pool = ProcessPoolExecutor(max_workers=self._cpu_workers,
+                                                     initializer=_worker_init,
+                                                     initargs=(log_queue(),))
+            return self._cpu_pool
+
+    def cpu_workers(self):
+        return self._cpu_workers
+
+    def start_cpu_workers(self):
+        ''' Start every pipeline process now instead of on the first requests '''
+
+        cpu_pool = self.cpu_pool()
+        for future in [cpu_pool.submit(_ping) for _ in range(self._cpu_workers)]:
+            future.result()
+
+    def io_pool(self):
+        with self._lock:
+            if self._io_pool is None:
+                self._io_pool = ThreadPoolExecutor(
+                    max_workers=IO_WORKERS, thread_name_prefix="pipeline-io")
+            return self._io_pool
+
+    def deliver_pool(self):
+        with self._lock:
+            if self._deliver_pool is None:
+                self._deliver_pool = ThreadPoolExecutor(
+                    max_workers=IO_WORKERS, thread_name_prefix="pipeline-deliver")
+            return self._deliver_pool
+
+    def shutdown(self):
+        ''' Stop every pool and its worker processes '''
+        with self._lock:
+            for pool in (self._cpu_pool, self._io_pool, self._deliver_pool):
+                if pool is not None:
+                    pool.shutdown(wait=True, cancel_futures=True)
+            self._cpu_pool = self._io_pool = self._deliver_pool = None
+
+    def reset_cpu_pool(self, cpu_pool):
+        ''' Drop `cpu_pool` when broken, a new one is started on next use '''
+        with self._lock:
+            if self._cpu_pool is cpu_pool:
+                logger.warning("pipeline process pool broken, restarting it")
+                self._cpu_pool.shutdown(wait=False)
+                self._cpu_pool = None
+
+    def submit_cpu(self, fn, *args):
+        ''' Submit `fn` to the process pool, restarted once when a worker died '''
+
+        cpu_pool = self.cpu_pool()
+        try:
+            return cpu_pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self.reset_cpu_pool(cpu_pool)
+            return self.cpu_pool().submit(fn, *args)
+
+
+class SignJob:
+    ''' A single file travelling through the pipeline '''
+
+    def __init__(self, index, file_path, signature_type, sig_attributes, certificate_value,
+                 output_folder=None):
+        self.index = index
+        self.file_path = file_path
+        self.signature_type = signature_type
+        self.sig_attributes = sig_attributes
+        self.certificate_value = certificate_value
+        # signed files are saved next to the input when missing
+        self.output_folder = output_folder
+        # set along the stages
+        self.local_file_path = file_path
+        self.prepared = None
+        self.to_sign = None
+        self.signature = None
+        self.issuer = None
+        self.serial_number = None
+        self.signed_file_path = None
+        # the post-sign verification ran on the signed document
+        self.verified = False
+        # served by the SignCache, no smart card needed
+        self.cache_key = None
+        self.cached = False
+        # metrics collected in the worker processes
+        self.metrics = None
+        # request id when the request is being profiled
+        self.profile_id = None
+        # pipeline run and index, the job field of the log records
+        self.job_id = None
+        # tracing context, and the spans collected in the worker processes
+        self.trace = None
+        self.spans = None
+        self.error = None
+        # response structure
+        self.output_item = {"file_to_sign": file_path,
+                            "signed": "",
+                            "signed_file": ""}
+
+
+class TokenSigner:
+    ''' Owns the logged in session: the only stage touching the smart card '''
+
+    def __init__(self, session):
+        self.session = session
+        with timed("certificate_fetch"):
+            # fetching smart card certificate
+            self.certificate = signature_util.SignatureUtils.fetch_certificate(session)
+            # getting certificate value
+            self.certificate_value = signature_util.SignatureUtils.get_certificate_value(
+                session, self.certificate)
+        self._private_key = None
+        self._issuer = None
+        self._serial_number = None
+
+    def sign_pdf_digest(self, digest):
+        ''' Return the CMS signature of a pdf given its byte ranges `digest` '''
+        try:
+            return pdf_signer.sign(None, self.session, self.certificate,
+                                   self.certificate_value, 'sha256', True, digest)
+        except Exception:
+            raise pdf_builder.PDFSigningError('error in the sign procedure')
+
+    def sign_bytes(self, bytes_to_sign):
+        ''' Return the raw signature of `bytes_to_sign` '''
+        if self._private_key is None:
+            self._private_key = signature_util.SignatureUtils.fetch_private_key(
+                self.session, self.certificate)
+        return signature_util.SignatureUtils.signature(self.session, self._private_key, bytes_to_sign)
+
+    def close(self):
+        ''' Logout and close the session '''
+        TokenSigner.close_session(self.session)
+
+    @staticmethod
+    def close_session(session):
+        # logout
+        try:
+            digiSign_lib.DigiSignLib.session_logout(session)
+        except:
+            logger.error("logout failed")
+        # session close
+        try:
+            digiSign_lib.DigiSignLib.session_close(session)
+        except:
+            logger.error("session close failed")
+
+    def issuer_and_serial_number(self):
+        if self._issuer is None:
+            self._issuer = signature_util.SignatureUtils.get_certificate_issuer(
+                self.session, self.certificate)
+            self._serial_number = signature_util.SignatureUtils.get_certificate_serial_number(
+                self.session, self.certificate)
+        return self._issuer, self._serial_number
+
+
+class SignPipeline:
+    ''' Staged signature of a batch of files
+
+            fetch (threads) -> prepare (processes) -> sign (smart card, caller thread)
+            -> finalize and verify (processes) -> deliver (threads)
+
+        Each file is delivered as soon as it is finalized, while the smart
+        card keeps signing the next ones.
+
+        Up to one file per pipeline process is prepared at once, and the
+        prepared files wait for the smart card in a bounded queue: only
+        `TOKEN_QUEUE_SIZE` of them are handed to the smart card stage ahead
+        of the one being signed.
+
+        Files already signed with the same request are taken from the
+        `SignCache` while preparing, they skip the smart card.
+
+        Param:
+            signer: a `TokenSigner`
+            fetch: callable(job) returning the local path of `job.file_path`
+            deliver: callable(job) moving `job.signed_file_path` to its destination,
+                raising when it fails
+            on_event: callable(event, job) told of the progress of every file:
+                downloaded, prepared, signed, verified (only when the post-sign
+                verification ran), delivered or failed
+    '''
+
+    def __init__(self, signer, fetch=None, deliver=None, on_event=None):
+        self.signer = signer
+        self.fetch = fetch
+        self.deliver = deliver
+        self.on_event = on_event
+
+    def run(self, jobs):
+        ''' Sign every job, return them in the given order '''
+
+        run_id = uuid4().hex[:8]
+        logger.info(f"pipeline {run_id} started for {len(jobs)} files")
+        for job in jobs:
+            job.profile_id = current_profile.get()
+            job.trace = current_trace.get()
+            job.job_id = f"{run_id}-{job.index}"
+        io_pool = StagePools().io_pool()
+        deliver_pool = StagePools().deliver_pool()
+        # a slot is taken by a file from its preparation to its hand-off
+        # to the smart card stage, so every pipeline process can be busy
+        slots = BoundedSemaphore(StagePools().cpu_workers())
+        handoff = Queue()
+        ready = Queue(maxsize=TOKEN_QUEUE_SIZE)
+
+        def on_prepared(future, job):
+            try:
+                prepared_job = future.result()
+                Metrics().merge(prepared_job.metrics)
+                Tracer().merge(prepared_job.spans)
+                self._emit("prepared", prepared_job)
+            except Exception as err:
+                self._failed(job, err)
+                prepared_job = job
+            handoff.put(prepared_job)
+
+        def on_fetched(future, job):
+            try:
+                future.result()
+                self._emit("downloaded", job)
+                StagePools().submit_cpu(prepare_job, job).add_done_callback(
+                    lambda f: on_prepared(f, job))
+            except Exception as err:
+                self._failed(job, err)
+                handoff.put(job)
+
+        def feed():
+            # downloads run ahead, only preparation waits for a slot
+            fetches = [(job, io_pool.submit(self._fetch_stage, job)) for job in jobs]
+            for job, fetched in fetches:
+                slots.acquire()
+                fetched.add_done_callback(lambda f, job=job: on_fetched(f, job))
+
+        def hand_off():
+            # blocks here, not in the pool callbacks, while the token queue is full
+            for _ in range(len(jobs)):
+                ready.put(handoff.get())
+                slots.release()
+                Metrics().set("digisign_queue_depth", ready.qsize(), queue="token")
+
+        feeder = Thread(target=feed, name="pipeline-feeder", daemon=True)
+        feeder.start()
+        handler = Thread(target=hand_off, name="pipeline-handoff", daemon=True)
+        handler.start()
+
+        # finalize and deliver, signing goes on while they are running
+        results = {}
+        finished = Condition()
+        outstanding = [0]
+
+        def done(job):
+            results[job.index] = job
+            with finished:
+                outstanding[0] -= 1
+                Metrics().set("digisign_queue_depth", outstanding[0], queue="finalize")
+                finished.notify_all()
+
+        def on_signed(job):
+            job.output_item["signed"] = "yes"
+            if job.verified:
+                self._emit("verified", job)
+            if self.deliver is None:
+                done(job)
+                return
+            deliver_pool.submit(self._deliver_stage, job).add_done_callback(
+                lambda f: done(job))
+
+        def on_finalized(future, job):
+            try:
+                # the worker returns an updated copy of the job
+                job = future.result()
+                Metrics().merge(job.metrics)
+                Tracer().merge(job.spans)
+            except Exception as err:
+                self._failed(job, err)
+                done(job)
+                return
+            on_signed(job)
+
+        # token stage
+        for _ in range(len(jobs)):
+            job = ready.get()
+            Metrics().set("digisign_queue_depth", ready.qsize(), queue="token")
+            results[job.index] = job
+            if job.error is not None:
+                continue
+            if job.cached:
+                with finished:
+                    outstanding[0] += 1
+                self._emit("signed", job)
+                on_signed(job)
+                continue
+            try:
+                self._sign_stage(job)
+            except Exception as err:
+                self._failed(job, err)
+                continue
+            self._emit("signed", job)
+            with finished:
+                outstanding[0] += 1
+            try:
+                finalized = StagePools().submit_cpu(finalize_job, job)
+            except Exception as err:
+                self._failed(job, err)
+                done(job)
+                continue
+            finalized.add_done_callback(lambda f, job=job: on_finalized(f, job))
+
+        feeder.join()
+        handler.join()
+        with finished:
+            finished.wait_for(lambda: outstanding[0] == 0)
+
+        for job in results.values():
+            result = "signed" if job.output_item["signed"].startswith("yes") else "failed"
+            Metrics().inc("digisign_files_total", signature_type=job.signature_type, result=result)
+
+        logger.info(f"pipeline {run_id} completed")
+        return [results[job.index] for job in jobs]
+
+    def _fetch_stage(self, job):
+        with job_log_context(job, "fetch"), trace_context(job.trace), span("fetch"):
+            if self.fetch is not None:
+                job.local_file_path = self.fetch(job)
+            if job.signature_type == PDF:
+                mime = MimeTypes().guess_type(job.local_file_path)[0]
+                if mime != 'application/pdf':
+                    raise ValueError(f"the file {job.local_file_path} is not a pdf will be ignored")
+
+    def _sign_stage(self, job):
+        with job_log_context(job, "token_sign"), span("token_sign"), timed("token_sign"):
+            logger.debug("signing %d bytes", len(job.to_sign))
+            if job.signature_type == PDF:
+                job.signature = self.signer.sign_pdf_digest(job.to_sign)
+            else:
+                job.signature = self.signer.sign_bytes(job.to_sign)
+                job.issuer, job.serial_number = self.signer.issuer_and_serial_number()
+        job.to_sign = None
+
+    def _deliver_stage(self, job):
+        with job_log_context(job, "deliver"), trace_context(job.trace), span("deliver"):
+            try:
+                self.deliver(job)
+            except Exception as err:
+                self._failed(job, err)
+                return
+        self._emit("delivered", job)
+
+    def _failed(self, job, err):
+        self._log_error(job, err)
+        job.error = err
+        job.output_item["signed"] = "no"
+        self._emit("failed", job)
+
+    def _emit(self, event, job):
+        if self.on_event is None:
+            return
+        try:
+            self.on_event(event, job)
+        except Exception as err:
+            logger.warning(f"{event} event of {job.file_path} not sent: {err}")
+
+    @staticmethod
+    def _log_error(job, err):
+        count_error(err)
+        logger.error(f"{job.file_path}: {err.__class__.__name__} {err}",
+                     extra={"job": job.job_id, "file": job.file_path})
+
+
+####################################################################
+#       PROCESS POOL STAGES                                        #
+####################################################################
+def prepare_job(job):
+    ''' CPU-bound preparation, runs in a worker process '''
+
+    with job_log_context(job, "prepare"), profiled(job.profile_id, "prepare"), \
+            trace_context(job.trace), span("prepare", file=job.file_path):
+        job = _prepare_job(job)
+    job.spans = _drain_spans(job)
+    return job
+
+
+def _prepare_job(job):
+    content = _input_content(job)
+    if SignCache().enabled:
+        job.cache_key = SignCache.key(content, job.signature_type, job.sig_attributes,
+                                      job.certificate_value)
+        signed_content = SignCache().get(job.cache_key)
+        if signed_content is not None:
+            logger.info(f"{job.file_path} signed artifact found in cache")
+            job.cached = True
+            _save_output(job, signed_content)
+            job.metrics = Metrics().drain()
+            return job
+    if job.signature_type == PDF:
+        pdfdata2, zeros, digest = pdf_builder.prepare(
+            content, job.certificate_value, 'sha256', job.sig_attributes)
+        job.prepared = (pdfdata2, zeros, digest)
+        job.to_sign = digest
+    else:
+        signed_attributes, bytes_to_sign = digiSign_lib.DigiSignLib.prepare_p7m(
+            job.local_file_path, content, job.certificate_value, job.sig_attributes)
+        job.prepared = signed_attributes
+        job.to_sign = bytes_to_sign
+    job.metrics = Metrics().drain()
+    return job
+
+
+def finalize_job(job):
+    ''' Signature embedding, saving and post-sign verification, runs in a worker process '''
+
+    with job_log_context(job, "finalize"), profiled(job.profile_id, "finalize"), \
+            trace_context(job.trace), span("finalize", file=job.file_path):
+        job = _finalize_job(job)
+    job.spans = _drain_spans(job)
+    return job
+
+
+def _finalize_job(job):
+    content = _input_content(job)
+    if job.signature_type == PDF:
+        pdfdata2, zeros, digest = job.prepared
+        try:
+            datas = pdf_builder.finalize(pdfdata2, zeros, job.signature)
+        except Exception:
+            raise pdf_builder.PDFSigningError('error in the sign procedure')
+        output_content = content + datas
+        digiSign_lib.DigiSignLib.check_signed_pdf(output_content, job.signature, digest,
+                                                  job.certificate_value)
+        job.verified = True
+    else:
+        output_content = digiSign_lib.DigiSignLib.finalize_p7m(
+            job.local_file_path, content, job.certificate_value, job.sig_attributes,
+            job.prepared, job.signature, job.issuer, job.serial_number)
+    _save_output(job, output_content)
+    if job.cache_key is not None:
+        SignCache().put(job.cache_key, output_content)
+    job.prepared = None
+    job.signature = None
+    job.metrics = Metrics().drain()
+    return job
+
+
+def job_log_context(job, stage):
+    ''' Job, file and stage fields of the records logged for `job` '''
+    return log_context(job=job.job_id, file=job.file_path, stage=stage)
+
+
+def _worker_init(log_queue):
+    use_log_queue(log_queue)
+    # nothing inherited from the parent is sent back to it
+    worker_init()
+    Tracer().reset()
+
+
+def _ping():
+    pass
+
+
+def _drain_spans(job):
+    if job.trace is None:
+        return None
+    return Tracer().drain(job.trace[0])
+
+
+def _input_content(job):
+    return digiSign_lib.DigiSignLib.get_file_content(job.local_file_path)
+
+
+def _save_output(job, output_content):
+    if job.signature_type == PDF:
+        signed_file_path = digiSign_lib.DigiSignLib.get_signed_files_path(job.local_file_path, 'pdf')
+    else:
+        signed_file_path = digiSign_lib.DigiSignLib.get_signed_files_path(
+            job.local_file_path, 'p7m', job.sig_attributes['p7m_sig_type'])
+    if job.output_folder is not None:
+        signed_file_path = path.join(job.output_folder, path.basename(signed_file_path))
+    job.signed_file_path = signed_file_path
+    digiSign_lib.DigiSignLib.save_file_content(job.signed_file_path, output_content)
@@ -0,0 +1,533 @@
+from admission import MAX_WAIT, chunks, file_bytes
+from contextlib import nullcontext
+from file_fetcher import FileFetcher
+from file_uploader import FileUploader, FileUploadError
+from functools import partial
+from json import loads
+from lazy_import import lazy_import
+from metrics import count_error, timed
+from my_logger import get_logger
+from os import path, sys
+from queue import Queue
+from shutil import move
+from sign_cache import SignCache
+from sign_pipeline import SignJob, SignPipeline, TokenSigner
+from threading import Thread
+from token_owner import RemoteTokenSigner, admission_controller
+from traceback import extract_tb
+from tracing import span
+from workspace import Workspace
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# Allowed signature types
+P7M = "p7m"
+PDF = "pdf"
+ALLOWED_SIGNATURE_TYPES = set([P7M, PDF])
+# user tips
+INVALID_JSON_REQUEST = "Richiesta al server non valida, contatta l'amministratore di sistema"
+####################################################################
+
+
+logger = get_logger("sign_service")
+# smart card, pdf and crypto libraries are loaded on first use
+digiSign_lib = lazy_import("digiSign_lib")
+
+
+# custom exceptions
+class SignRequestError(Exception):
+    ''' Raised when a sign request can not be served, carries the HTTP error response fields '''
+
+    def __init__(self, error_message, user_tip, status):
+        # all the fields in args, so it survives pickling to other processes
+        super().__init__(error_message, user_tip, status)
+        self.error_message = error_message
+        self.user_tip = user_tip
+        self.status = status
+
+    def __str__(self):
+        return self.error_message
+
+
+class SignService:
+    ''' Signature of a batch of files, shared by /api/sign, /api/sign/stream and /upload
+
+        Param:
+            get_pin: callable(user_id) returning the user PIN
+            clear_pin: callable(user_id, rejected=False) forgetting the user PIN,
+                `rejected` when the smart card refused it
+            token_owner: proxy of the token-owner process, the smart card
+                is used from this process when missing
+            has_valid_pin: callable(user_id) telling if the user PIN is
+                memorized and not expired, used without a token owner
+    '''
+
+    def __init__(self, get_pin, clear_pin, token_owner=None, has_valid_pin=None):
+        self.get_pin = get_pin
+        self.clear_pin = clear_pin
+        self.token_owner = token_owner
+        self.has_valid_pin = has_valid_pin
+
+    def sign_request(self, json_request):
+        ''' Check and serve a /api/sign request structure
+
+            Returns:
+                the signed file list of the response
+        '''
+
+        user_id, file_list, path_for_signed_files = self.check_request(json_request)
+        return self.sign(user_id, file_list, path_for_signed_files)
+
+    @staticmethod
+    def check_request(json_request):
+        ''' Check for well formed request JSON. Raise a `SignRequestError` '''
+
+        if not json_request:
+            error_message = "Missing json request structure"
+            raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+
+        if not "user_id" in json_request:
+            error_message = "missing user_id field"
+            raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+        user_id = json_request["user_id"]
+
+        if not "file_list" in json_request:
+            error_message = "missing file_list field"
+            raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+        file_list = json_request["file_list"]
+
+        if not isinstance(file_list, (list,)) or len(file_list) < 1:
+            error_message = "Empty file_list"
+            raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+
+        for json_file in file_list:
+            if not "file" in json_file:
+                error_message = "missing file field"
+                raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+
+            if not "signed_file_type" in json_file:
+                error_message = "missing signed_file_type field"
+                raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+            sig_type = json_file["signed_file_type"]
+
+            if not allowed_signature(sig_type):
+                error_message = f"{sig_type} not allowed in signed_file_type field"
+                raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+
+            if not "sig_attributes" in json_file:
+                logger.error(f"missing sig_attributes field for file {json_file['file']}")
+                continue
+
+            # TODO check altri campi
+
+        if not "output_path" in json_request:
+            error_message = "missing output_path field"
+            raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+        path_for_signed_files = json_request["output_path"]
+
+        if not path_for_signed_files.startswith("http://"):
+            if not path.exists(path_for_signed_files) or not path.isdir(path_for_signed_files):
+                error_message = f"{path_for_signed_files} field is not a valid directory"
+                raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+
+        return user_id, file_list, path_for_signed_files
+
+    @staticmethod
+    def check_documents_request(fields):
+        ''' Check the fields of a /api/sign/stream request. Raise a `SignRequestError`
+
+            Returns:
+                user_id, signed_file_type and sig_attributes
+        '''
+
+        if not fields.get("user_id"):
+            error_message = "missing user_id field"
+            raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+        user_id = fields["user_id"]
+
+        if not fields.get("signed_file_type"):
+            error_message = "missing signed_file_type field"
+            raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+        sig_type = fields["signed_file_type"].lower()
+
+        if not allowed_signature(sig_type):
+            error_message = f"{sig_type} not allowed in signed_file_type field"
+            raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+
+        sig_attributes = None
+        if fields.get("sig_attributes"):
+            try:
+                sig_attributes = loads(fields["sig_attributes"])
+            except ValueError:
+                error_message = "sig_attributes field is not valid JSON"
+                raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+        elif sig_type == P7M:
+            # new p7m envelope
+            sig_attributes = {"p7m_sig_type": ""}
+        else:
+            sig_attributes = {"visibility": "invisible", "position": {"page": "n"}}
+
+        return user_id, sig_type, sig_attributes
+
+    def sign(self, user_id, file_list, path_for_signed_files, workspace=None, on_event=None):
+        ''' Sign every file of `file_list` and deliver it to `path_for_signed_files`
+
+            Param:
+                workspace: job `Workspace`, a new one is used when missing
+                on_event: callable(event, job) told of the progress of every
+                    file, see `SignPipeline`
+
+            Returns:
+                a list of {file_to_sign, signed, signed_file}
+        '''
+
+        if not file_list:
+            # nothing to admit, /upload may start a batch without files
+            error_message = "Empty file_list"
+            raise SignRequestError(error_message, INVALID_JSON_REQUEST, 404)
+
+        if workspace is None:
+            with Workspace() as workspace:
+                return self.sign(user_id, file_list, path_for_signed_files, workspace, on_event)
+
+        # a new request may be refused (AdmissionRejected), once its first
+        # part is admitted the following ones only wait for their turn
+        parts = chunks(file_list)
+        part_bytes = [sum(file_bytes(json_file["file"]) for json_file in part) for part in parts]
+        admission = admission_controller()
+        admission.acquire(user_id, len(parts[0]), part_bytes[0], timeout=MAX_WAIT)
+        try:
+            signer = self._open_signer(user_id)
+        except:
+            admission.release(len(parts[0]), part_bytes[0])
+            raise
+        try:
+            return self._sign_batch(signer, user_id, parts, part_bytes,
+                                    path_for_signed_files, workspace, admission, on_event)
+        finally:
+            # logout and session close
+            signer.close()
+
+    def sign_documents(self, user_id, documents, workspace):
+        ''' Sign documents uploaded to `workspace`, the signed ones are saved
+            in its signed folder
+
+            Login and certificate checks are done before returning.
+
+            Param:
+                documents: list of (file path, signed_file_type, sig_attributes)
+
+            Returns:
+                a generator of the `SignJob`s, the signed ones as soon as
+                they are ready (`signed_file_path`), then the failed ones
+        '''
+
+        # documents are already uploaded, they are admitted all together
+        files = len(documents)
+        nbytes = sum(file_bytes(file_path) for file_path, _, _ in documents)
+        admission = admission_controller()
+        admission.acquire(user_id, files, nbytes, timeout=MAX_WAIT)
+        try:
+            signer = self._open_signer(user_id)
+            try:
+                certificate_ok = self._check_certificate(signer, user_id)
+            except:
+                signer.close()
+                raise
+        except:
+            admission.release(files, nbytes)
+            raise
+
+        jobs = [SignJob(index, file_path, signed_file_type, sig_attributes,
+                        signer.certificate_value, workspace.signed_folder)
+                for index, (file_path, signed_file_type, sig_attributes)
+                in enumerate(documents)]
+        for job in jobs:
+            # the uploaded name, server paths are not shown
+            job.output_item["file_to_sign"] = path.basename(job.file_path)
+        if not certificate_ok:
+            signer.close()
+            admission.release(files, nbytes)
+            for job in jobs:
+                job.output_item["signed"] = "no"
+            return iter(jobs)
+
+        signed = Queue()
+
+        def run():
+            # the whole batch is queued last, for the failed jobs
+            results = jobs
+            try:
+                results = SignPipeline(signer, deliver=signed.put).run(jobs)
+            except:
+                _log_exception()
+            finally:
+                signer.close()
+                admission.release(files, nbytes)
+                signed.put(results)
+
+        Thread(target=run, name="sign-documents", daemon=True).start()
+        return _signed_documents(signed)
+
+    def _open_signer(self, user_id):
+        # a known certificate is enough until a file really needs the card,
+        # but it is no proof of identity: the user must still hold a valid
+        # PIN, else the batch logs in before any cached file is returned
+        certificate_value = SignCache().certificate(user_id)
+        if certificate_value is not None and self._authenticated(user_id):
+            return LazyTokenSigner(self._login, user_id, certificate_value)
+        return self._login(user_id)
+
+    def _authenticated(self, user_id):
+        # the PIN is memorized where the smart card is used
+        if self.token_owner is not None:
+            return self.token_owner.has_valid_pin(user_id)
+        return self.has_valid_pin is not None and self.has_valid_pin(user_id)
+
+    def _login(self, user_id):
+        with span("login"):
+            if self.token_owner is not None:
+                signer = RemoteTokenSigner(self.token_owner, user_id)
+            else:
+                signer = open_token_signer(user_id, self.get_pin, self.clear_pin)
+        SignCache().remember_certificate(user_id, signer.certificate_value)
+        return signer
+
+    @staticmethod
+    def _check_certificate(signer, user_id):
+        ''' Certificate checks, once for the whole batch. Raise a `SignRequestError`
+
+            Returns:
+                False when the files must not be signed
+        '''
+
+        try:
+            digiSign_lib.DigiSignLib().check_certificate(signer.certificate_value, user_id)
+        except digiSign_lib.CertificateOwnerException as err:
+            user_tip = "Codice fiscale dell'utente non corrispondente a quello della smart card. Impossibile procedere."
+            raise SignRequestError(str(err), user_tip, 500)
+        except:
+            _log_exception()
+            return False
+        return True
+
+    def _sign_batch(self, signer, user_id, parts, part_bytes, path_for_signed_files,
+                    workspace, admission, on_event=None):
+        ''' Sign the batch one part after the other, the first part is already admitted '''
+
+        output_to_url = path_for_signed_files.startswith("http://")
+
+        def on_stage(event, job):
+            # a running job is never reaped, however long it takes
+            workspace.touch()
+            if on_event is not None:
+                on_event(event, job)
+        try:
+            certificate_ok = self._check_certificate(signer, user_id)
+        except:
+            admission.release(len(parts[0]), part_bytes[0])
+            raise
+        if not certificate_ok:
+            admission.release(len(parts[0]), part_bytes[0])
+
+        # signing pipeline on given files
+        pipeline = SignPipeline(signer,
+                                fetch=partial(fetch_file_to_sign,
+                                              folder=workspace.upload_folder),
+                                deliver=partial(deliver_signed_file,
+                                                path_for_signed_files=path_for_signed_files,
+                                                output_to_url=output_to_url),
+                                on_event=on_stage)
+        output_items = []
+        for number, (part, nbytes) in enumerate(zip(parts, part_bytes)):
+            jobs = [SignJob(len(output_items) + index, file_to_sign["file"],
+                            file_to_sign["signed_file_type"], file_to_sign.get("sig_attributes"),
+                            signer.certificate_value, workspace.signed_folder)
+                    for index, file_to_sign in enumerate(part)]
+            if not certificate_ok:
+                for job in jobs:
+                    job.output_item["signed"] = "no"
+                    if on_event is not None:
+                        on_event("failed", job)
+            else:
+                # other users requests go first when waiting
+                if number > 0:
+                    admission.acquire(user_id, len(part), nbytes)
+                try:
+                    jobs = pipeline.run(jobs)
+                finally:
+                    admission.release(len(part), nbytes)
+            output_items += [job.output_item for job in jobs]
+
+        return output_items
+
+
+class LazyTokenSigner:
+    ''' `TokenSigner` interface logging in on the first signature
+
+        Batches fully served by the `SignCache` never touch the smart card,
+        only users with a valid memorized PIN get one.
+    '''
+
+    def __init__(self, login, user_id, certificate_value):
+        self._login = login
+        self._user_id = user_id
+        self._signer = None
+        self.certificate_value = certificate_value
+
+    def sign_pdf_digest(self, digest):
+        return self._open().sign_pdf_digest(digest)
+
+    def sign_bytes(self, bytes_to_sign):
+        return self._open().sign_bytes(bytes_to_sign)
+
+    def issuer_and_serial_number(self):
+        return self._open().issuer_and_serial_number()
+
+    def close(self):
+        if self._signer is not None:
+            self._signer.close()
+
+    def _open(self):
+        if self._signer is None:
+            self._signer = self._login(self._user_id)
+        if self._signer.certificate_value != self.certificate_value:
+            # the smart card has been changed, files of this batch were
+            # prepared with the old certificate, the new one is used next time
+            raise SignRequestError("smart card certificate changed",
+                                   "Riprovare la firma", 500)
+        return self._signer
+
+
+####################################################################
+#       SMART CARD                                                 #
+####################################################################
+def open_token_signer(user_id, get_pin, clear_pin, card_lock=None):
+    ''' Login on the connected smart card. Raise a `SignRequestError`
+
+        Param:
+            card_lock: held around the smart card calls, not while the
+                PIN is asked: a prompt does not stop the other users
+
+        Returns:
+            a `TokenSigner` on the logged in session
+    '''
+
+    if card_lock is None:
+        card_lock = nullcontext()
+
+    # getting smart cards connected
+    try:
+        with card_lock:
+            sessions = digiSign_lib.DigiSignLib().get_smart_cards_sessions()
+    except Exception as err:
+        _log_exception()
+        clear_pin(user_id)
+        raise SignRequestError(str(err),
+                               "Controllare che la smart card sia inserita correttamente",
+                               500)
+
+    # attempt to login
+    try:
+        pin = get_pin(user_id)
+        with card_lock:
+            session = digiSign_lib.DigiSignLib().session_login(sessions, pin)
+    except Exception as err:
+        _log_exception()
+        clear_pin(user_id, rejected=True)
+        raise SignRequestError(str(err),
+                               "Controllare che il pin sia valido e corretto",
+                               500)
+
+    # fetching smart card certificate
+    try:
+        with card_lock:
+            return TokenSigner(session)
+    except Exception as err:
+        _log_exception()
+        with card_lock:
+            TokenSigner.close_session(session)
+        raise SignRequestError(str(err),
+                               "Controllare che la smart card sia inserita correttamente",
+                               500)
+
+
+####################################################################
+#       PIPELINE STAGES                                            #
+####################################################################
+def fetch_file_to_sign(job, folder):
+    ''' Pipeline fetch stage: return a local path for `job.file_path`, downloads go in `folder` '''
+
+    # handle url file paths
+    if job.file_path.startswith("http://"):
+        try:
+            with timed("fetch"):
+                return FileFetcher().fetch(job.file_path, folder)
+        except:
+            logger.error(f"Impossibile reperire il file: {job.file_path}")
+            raise
+    return job.file_path
+
+
+def deliver_signed_file(job, path_for_signed_files, output_to_url):
+    ''' Pipeline deliver stage: moving signed file to given destination. A failure
+        is marked in `signed_file` and raised, the pipeline logs it
+    '''
+
+    temp_file_path = job.signed_file_path
+    if output_to_url:
+        try:
+            with timed("upload"):
+                uploaded_path = FileUploader().upload(temp_file_path, path_for_signed_files)
+        except FileUploadError:
+            job.output_item["signed_file"] = "ERROR!!"
+            raise
+        except Exception:
+            job.output_item["signed_file"] = "EXCEPTION!!"
+            raise
+        job.output_item["signed"] = "yes - [remote]"
+        job.output_item["signed_file"] = f"{uploaded_path}"
+    else:
+        temp_file_name = path.basename(temp_file_path)
+        signed_file_path = path.join(
+            path_for_signed_files, temp_file_name)
+        try:
+            with timed("move"):
+                move(temp_file_path, signed_file_path)
+        except Exception:
+            job.output_item["signed_file"] = "LOST"
+            raise
+        job.output_item["signed_file"] = signed_file_path
+
+
+def _signed_documents(signed):
+    delivered = set()
+    item = signed.get()
+    while isinstance(item, SignJob):
+        delivered.add(item.index)
+        yield item
+        item = signed.get()
+    for job in item:
+        if job.index not in delivered:
+            job.output_item["signed"] = "no"
+            yield job
+
+
+####################################################################
+#       UTILITIES                                                  #
+####################################################################
+def allowed_signature(signature_type):
+    ''' Returns if `signature_type` is allowed '''
+    return signature_type.lower() in ALLOWED_SIGNATURE_TYPES
+
+
+def _log_exception():
+    ''' Log the exception being handled with its traceback '''
+    _, value, tb = sys.exc_info()
+    count_error(value)
+    logger.error(value)
+    logger.error(
+        '\n\t'.join(f"{i}" for i in extract_tb(tb)))
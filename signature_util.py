@@ -1,5 +1,7 @@
 from my_config_loader import MyConfigLoader
-from my_logger import MyLogger
+from metrics import timed
+from my_logger import get_logger
+from tracing import traced
 from os import listdir, devnull, fsdecode
 from PyKCS11 import PyKCS11Lib, Mechanism, LowLevel
 
@@ -13,39 +15,48 @@ DRIVER_FOLDER = MyConfigLoader().get_server_config()["driver_folder"]
 ####################################################################
 
 
+logger = get_logger("signature_util")
+
+
 # custom exceptions
 class SmartCardConnectionError(ConnectionError):
     ''' Raised when something goes wrong with the smart card '''
     pass
 
 
+# driver libraries kept loaded by `preload_drivers()`
+_preloaded_drivers = []
+
+
 class SignatureUtils:
 
     @staticmethod
+    @traced("pkcs11.fetch_smart_card_sessions")
     def fetch_smart_card_sessions():
         ''' Return a `session` list for the connected smart cards '''
 
-        MyLogger().my_logger().info("loading drivers")
+        logger.info("loading drivers")
         pkcs11 = PyKCS11Lib()
         driver_loaded = False
 
-        # try with default
-        try:
-            pkcs11.load()
-            driver_loaded = True
-        except:
-            MyLogger().my_logger().warning("no default driver")
-
-        # anyway load known drivers
-        for file in listdir(DRIVER_FOLDER):
+        with timed("driver_load"):
+            # try with default
             try:
-                pkcs11.load(file)
-                MyLogger().my_logger().info(f"driver {fsdecode(file)} loaded")
+                pkcs11.load()
                 driver_loaded = True
             except:
-                MyLogger().my_logger().warning(
-                    f"driver {fsdecode(file)} NOT loaded")
-                continue
+                logger.warning("no default driver")
+
+            # anyway load known drivers
+            for file in listdir(DRIVER_FOLDER):
+                try:
+                    pkcs11.load(file)
+                    logger.info(f"driver {fsdecode(file)} loaded")
+                    driver_loaded = True
+                except:
+                    logger.warning(
+                        f"driver {fsdecode(file)} NOT loaded")
+                    continue
 
         # cannot load any driver file
         if(not driver_loaded):
@@ -69,11 +80,26 @@ class SignatureUtils:
         return sessions
 
 
+    @staticmethod
+    def preload_drivers():
+        ''' Load the drivers once and keep them loaded, the sessions opened later reuse them '''
+
+        if _preloaded_drivers:
+            return
+        with timed("driver_load"):
+            for file in [None] + listdir(DRIVER_FOLDER):
+                try:
+                    _preloaded_drivers.append(PyKCS11Lib().load(file))
+                except:
+                    continue
+        logger.info(f"{len(_preloaded_drivers)} drivers preloaded")
+
+
     @staticmethod
     def _fetch_slots(pkcs11_lib):
         ''' Return a `slot list` (connected Smart Cards) '''
 
-        MyLogger().my_logger().info("getting slots")
+        logger.info("getting slots")
         try:
             slots = pkcs11_lib.getSlotList(tokenPresent=True)
             if(len(slots) < 1):
@@ -88,11 +114,12 @@ class SignatureUtils:
     def close_session(session):
         ''' Close smart card `session` '''
 
-        MyLogger().my_logger().info("Close smart card session")
+        logger.info("Close smart card session")
         session.closeSession()
 
 
     @staticmethod
+    @traced("pkcs11.user_login")
     def user_login(sessions, pin):
         ''' 
             User login on a `session` using `pin`
@@ -105,19 +132,21 @@ class SignatureUtils:
                 the logged in session
         '''
 
-        MyLogger().my_logger().info("user login")
-        for session in sessions:
-            try:
-                session.login(pin)
-                return session
-            except:
-                continue
+        logger.info("user login")
+        with timed("login"):
+            for session in sessions:
+                try:
+                    session.login(pin)
+                    return session
+                except:
+                    continue
 
         raise SmartCardConnectionError(
             "Can not login on any sessions provided")
 
 
     @staticmethod
+    @traced("pkcs11.user_logout")
     def user_logout(session):
         ''' 
             User logout from a `session`
@@ -126,11 +155,12 @@ class SignatureUtils:
                 session: smart card session
         '''
 
-        MyLogger().my_logger().info("user logout")
+        logger.info("user logout")
         session.logout()
 
 
     @staticmethod
+    @traced("pkcs11.fetch_certificate")
     def fetch_certificate(session):
         ''' 
             Return smart card certificate
@@ -139,7 +169,7 @@ class SignatureUtils:
                 session: smart card session
         '''
 
-        MyLogger().my_logger().info("fetching certificate")
+        logger.info("fetching certificate")
         try:
             certificates = session.findObjects(
                 [(LowLevel.CKA_CLASS, LowLevel.CKO_CERTIFICATE)])
@@ -152,6 +182,7 @@ class SignatureUtils:
 
 
     @staticmethod
+    @traced("pkcs11.get_certificate_value")
     def get_certificate_value(session, certificate):
         ''' 
             Return the value of `certificate`
@@ -161,7 +192,7 @@ class SignatureUtils:
                 certificate: smart card certificate
         '''
 
-        MyLogger().my_logger().info("fetching certificate value")
+        logger.info("fetching certificate value")
         try:
             certificate_value = session.getAttributeValue(
                 certificate, [LowLevel.CKA_VALUE])[0]
@@ -172,6 +203,7 @@ class SignatureUtils:
 
 
     @staticmethod
+    @traced("pkcs11.get_certificate_issuer")
     def get_certificate_issuer(session, certificate):
         ''' 
             Return the issuer of `certificate`
@@ -181,7 +213,7 @@ class SignatureUtils:
                 certificate: smart card certificate
         '''
 
-        MyLogger().my_logger().info("fetching certificate issuer")
+        logger.info("fetching certificate issuer")
         try:
             certificate_issuer = session.getAttributeValue(
                 certificate, [LowLevel.CKA_ISSUER])[0]
@@ -192,6 +224,7 @@ class SignatureUtils:
 
 
     @staticmethod
+    @traced("pkcs11.get_certificate_serial_number")
     def get_certificate_serial_number(session, certificate):
         ''' 
             Return the serial number of `certificate`
@@ -201,7 +234,7 @@ class SignatureUtils:
                 certificate: smart card certificate
         '''
 
-        MyLogger().my_logger().info("fetching certificate serial number")
+        logger.info("fetching certificate serial number")
         try:
             serial_number = session.getAttributeValue(
                 certificate, [LowLevel.CKA_SERIAL_NUMBER])[0]
@@ -219,6 +252,7 @@ class SignatureUtils:
 
 
     @staticmethod
+    @traced("pkcs11.fetch_private_key")
     def fetch_private_key(session, certificate):
         ''' 
             Return smart card private key reference
@@ -228,7 +262,7 @@ class SignatureUtils:
                 certificate: certificate connected to the key
         '''
 
-        MyLogger().my_logger().info("fetching private key")
+        logger.info("fetching private key")
         try:
             # getting the certificate id
             identifier = session.getAttributeValue(
@@ -246,6 +280,7 @@ class SignatureUtils:
 
 
     @staticmethod
+    @traced("pkcs11.fetch_public_key")
     def fetch_public_key(session, certificate):
         ''' 
             Return smart card public key reference
@@ -255,7 +290,7 @@ class SignatureUtils:
                 certificate: certificate connected to the key
         '''
 
-        MyLogger().my_logger().info("fetching public key")
+        logger.info("fetching public key")
         try:
             # getting the certificate id
             identifier = session.getAttributeValue(
@@ -271,6 +306,7 @@ class SignatureUtils:
 
 
     @staticmethod
+    @traced("pkcs11.digest")
     def digest(session, content):
         ''' 
             Return `content` hash
@@ -280,7 +316,7 @@ class SignatureUtils:
                 content: content to hash
         '''
 
-        MyLogger().my_logger().info("hashing content")
+        logger.info("hashing content")
         try:
             digest = session.digest(content, Mechanism(LowLevel.CKM_SHA256))
         except:
@@ -290,6 +326,7 @@ class SignatureUtils:
 
 
     @staticmethod
+    @traced("pkcs11.signature")
     def signature(session, privKey, content):
         ''' 
             Sign `content` with `privKey` reference
@@ -303,7 +340,7 @@ class SignatureUtils:
                 content: bytes to hash and sign
         '''
 
-        MyLogger().my_logger().info("signing content")
+        logger.info("signing content")
         try:
             signature = session.sign(privKey, content, Mechanism(
                 LowLevel.CKM_SHA256_RSA_PKCS, None))
@@ -0,0 +1,82 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from threading import Thread
+import my_logger
+import pytest
+
+
+@pytest.fixture(autouse=True, scope="session")
+def log_folder(tmp_path_factory):
+    ''' The records of the tests go to a temporary folder, not to the application log '''
+
+    folder = str(tmp_path_factory.mktemp("log"))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(my_logger, "LOGGING_FOLDER", folder)
+        monkeypatch.setattr(my_logger, "LOGGING_FILE_PATH", path.join(folder, my_logger.LOGGING_FILE))
+        yield folder
+
+
+class LocalServer:
+    ''' HTTP server of the tests on a free local port
+
+        `routes` maps a path to a callable(handler) writing the response,
+        `requests` lists (method, path, headers, body) of every request.
+    '''
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server._serve(self)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        self._httpd.daemon_threads = True
+        # clients of the timeout tests leave before the response
+        self._httpd.handle_error = lambda request, address: None
+        self._thread = Thread(target=self._httpd.serve_forever, kwargs={"poll_interval": 0.05},
+                              daemon=True)
+        self._thread.start()
+
+    def url(self, route):
+        return f"http://127.0.0.1:{self._httpd.server_port}{route}"
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _serve(self, handler):
+        length = int(handler.headers.get("Content-Length", 0))
+        body = handler.rfile.read(length) if length else b""
+        self.requests.append((handler.command, handler.path, handler.headers, body))
+        route = self.routes.get(handler.path)
+        if route is None:
+            reply(handler, 404)
+        else:
+            route(handler)
+
+
+def reply(handler, status, body=b"", content_type="application/octet-stream"):
+    ''' Write a complete response with its Content-Length '''
+
+    handler.send_response(status)
+    handler.send_header("Content-Type", content_type)
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+@pytest.fixture
+def http_server():
+    server = LocalServer()
+    yield server
+    server.close()
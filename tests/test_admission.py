@@ -0,0 +1,111 @@
+from admission import AdmissionController, AdmissionRejected
+from singleton_type import SingletonType
+from threading import Thread
+from time import monotonic, sleep
+import admission
+import digiSign_server
+import pytest
+import workspace
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    monkeypatch.setattr(SingletonType, "_instances", {})
+    monkeypatch.setattr(admission, "MAX_FILES", 1)
+    monkeypatch.setattr(admission, "MAX_BYTES", 1000)
+    monkeypatch.setattr(admission, "MAX_WAITING", 10)
+    return AdmissionController()
+
+
+def wait_for(predicate, timeout=5):
+    deadline = monotonic() + timeout
+    while not predicate():
+        assert monotonic() < deadline, "timed out"
+        sleep(0.005)
+
+
+def waiting(controller, user_id, name, admitted, files=1, nbytes=0):
+    ''' Queue a request of `user_id`, `name` goes to `admitted` once it gets in '''
+
+    before = controller.in_flight()[2]
+    Thread(target=lambda: controller.acquire(user_id, files, nbytes) or admitted.append(name),
+           daemon=True).start()
+    wait_for(lambda: controller.in_flight()[2] == before + 1)
+
+
+def test_users_served_round_robin(controller):
+    admitted = []
+    controller.acquire("running", 1, 0)
+    for name in ["a1", "a2", "a3"]:
+        waiting(controller, "a", name, admitted)
+    waiting(controller, "b", "b1", admitted)
+
+    for count in range(1, 5):
+        controller.release(1, 0)
+        wait_for(lambda: len(admitted) == count)
+
+    # b does not wait for the whole batch of a
+    assert admitted == ["a1", "b1", "a2", "a3"]
+
+
+def test_next_chunk_queues_behind_the_others(controller, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_FILES", 2)
+    admitted = []
+    controller.acquire("batch", 2, 0)
+    waiting(controller, "short", "short", admitted)
+
+    # first chunk done, the batch asks for the next one
+    controller.release(2, 0)
+    wait_for(lambda: admitted == ["short"])
+    waiting(controller, "batch", "chunk 2", admitted, files=2)
+    assert controller.in_flight() == (1, 0, 1)
+
+    controller.release(1, 0)
+    wait_for(lambda: admitted == ["short", "chunk 2"])
+
+
+def test_too_many_waiting_refused_at_once(controller, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_WAITING", 1)
+    controller.acquire("running", 1, 0)
+    waiting(controller, "a", "a", [])
+
+    start = monotonic()
+    with pytest.raises(AdmissionRejected) as err:
+        controller.acquire("b", 1, 0, timeout=5)
+    assert monotonic() - start < 1
+    assert err.value.retry_after == admission.RETRY_AFTER
+
+
+def test_not_admitted_within_max_wait(controller):
+    controller.acquire("running", 1, 0)
+
+    with pytest.raises(AdmissionRejected, match="not admitted within"):
+        controller.acquire("a", 1, 0, timeout=0.05)
+    # the refused request left the queue
+    assert controller.in_flight() == (1, 0, 0)
+    assert not controller._queues
+
+
+def test_oversized_request_runs_alone(controller):
+    controller.acquire("big", 1, 5000)
+
+    with pytest.raises(AdmissionRejected):
+        controller.acquire("small", 1, 1, timeout=0.05)
+    controller.release(1, 5000)
+    controller.acquire("small", 1, 1, timeout=0.05)
+
+
+def test_busy_server_answers_retry_after(controller, monkeypatch, tmp_path):
+    monkeypatch.setattr(admission, "MAX_WAITING", 0)
+    monkeypatch.setattr(workspace, "UPLOAD_FOLDER", str(tmp_path / "uploads"))
+    monkeypatch.setattr(workspace, "SIGNED_FOLDER", str(tmp_path / "signed"))
+    document = tmp_path / "a.pdf"
+    document.write_bytes(b"%PDF-1.4")
+    controller.acquire("running", 1, 0)
+
+    response = digiSign_server.server.test_client().post("/api/sign", json={
+        "user_id": "X" * 15, "output_path": str(tmp_path),
+        "file_list": [{"file": str(document), "signed_file_type": "pdf"}]})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(admission.RETRY_AFTER)
@@ -0,0 +1,116 @@
+from json import loads
+from test_verify import identity, p7m
+import bulk_verify
+import pytest
+import verify
+
+
+@pytest.fixture(scope="module")
+def signers():
+    return [identity("Mario Rossi")]
+
+
+@pytest.fixture
+def documents(tmp_path, signers):
+    ''' Signed and unsigned documents, listed in the order they are verified '''
+
+    folder = tmp_path / "documents"
+    (folder / "b").mkdir(parents=True)
+    files = []
+    for number in range(7):
+        file_path = folder / ("b" if number > 3 else "") / f"{number}.p7m"
+        file_path.write_bytes(p7m(signers, b"document %d" % number) if number != 2 else b"not signed")
+        files.append(str(file_path))
+    return folder, files
+
+
+@pytest.fixture(autouse=True)
+def one_file_at_a_time(monkeypatch):
+    # results written as soon as they come, a checkpoint every 2
+    monkeypatch.setattr(bulk_verify, "IN_FLIGHT_PER_WORKER", 1)
+    monkeypatch.setattr(bulk_verify, "CHECKPOINT_EVERY", 2)
+
+
+def trusted(signers):
+    return [certificate.dump() for _, certificate in signers]
+
+
+def results(output):
+    lines = [loads(line) for line in output.read_text().splitlines()]
+    for line in lines:
+        line.pop("seconds")
+    return lines
+
+
+def interrupted(paths, after):
+    ''' `paths`, then the run stops as if killed '''
+
+    for number, item in enumerate(paths):
+        if number == after:
+            raise KeyboardInterrupt
+        yield item
+
+
+def test_results_in_the_order_of_the_paths(documents, signers, tmp_path):
+    folder, files = documents
+    output = tmp_path / "results.jsonl"
+
+    stats = bulk_verify.bulk_verify([str(folder)], str(output), workers=2, trusted=trusted(signers))
+
+    assert [result["file"] for result in results(output)] == files
+    assert [result["valid"] for result in results(output)] == [True, True, False, True, True, True, True]
+    assert (stats["files"], stats["valid"], stats["errors"]) == (7, 6, 1)
+
+
+def test_resume_from_checkpoint(documents, signers, tmp_path):
+    _, files = documents
+    output, checkpoint = tmp_path / "results.jsonl", tmp_path / "checkpoint.json"
+    expected = tmp_path / "expected.jsonl"
+    bulk_verify.bulk_verify(files, str(expected), workers=1, trusted=trusted(signers))
+
+    with pytest.raises(KeyboardInterrupt):
+        bulk_verify.bulk_verify(interrupted(files, 5), str(output), str(checkpoint),
+                                workers=1, trusted=trusted(signers))
+    # 5 results written, the checkpoint has 4
+    assert len(results(output)) == 5
+    stats = bulk_verify.bulk_verify(files, str(output), str(checkpoint),
+                                    workers=1, trusted=trusted(signers))
+
+    assert (stats["skipped"], stats["files"]) == (4, 3)
+    assert results(output) == results(expected)
+
+
+def test_checkpoint_without_output_starts_over(documents, signers, tmp_path):
+    _, files = documents
+    output, checkpoint = tmp_path / "results.jsonl", tmp_path / "checkpoint.json"
+    with pytest.raises(KeyboardInterrupt):
+        bulk_verify.bulk_verify(interrupted(files, 5), str(output), str(checkpoint),
+                                workers=1, trusted=trusted(signers))
+    output.unlink()
+
+    stats = bulk_verify.bulk_verify(files, str(output), str(checkpoint),
+                                    workers=1, trusted=trusted(signers))
+
+    assert (stats["skipped"], stats["files"]) == (0, 7)
+    assert b"\0" not in output.read_bytes()
+    assert [result["file"] for result in results(output)] == files
+
+
+def test_unknown_revocation_is_not_invalid(monkeypatch):
+    checks = {"hashok?": True, "signatureok?": True, "certok?": True}
+    signatures = [dict(checks, **{"revocationok?": None}), dict(checks, **{"revocationok?": True})]
+    monkeypatch.setattr(verify, "verify_p7m", lambda content, trusted: signatures)
+    stats = bulk_verify.BulkVerifyStats()
+
+    result = bulk_verify._new_result("unknown.p7m")
+    bulk_verify._verify(result, b"\x30 cms")
+    stats.add(result)
+    assert result["valid"]
+
+    signatures[1]["revocationok?"] = False
+    result = bulk_verify._new_result("revoked.p7m")
+    bulk_verify._verify(result, b"\x30 cms")
+    stats.add(result)
+    assert not result["valid"]
+
+    assert (stats.valid, stats.invalid, stats.revocation_unknown) == (1, 1, 1)
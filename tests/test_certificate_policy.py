@@ -0,0 +1,50 @@
+from json import dumps
+from os import utime
+import certificate_policy
+import pytest
+
+
+USER_CF = "RSSMRA80A01H501U"
+
+
+class Certificate:
+    def get_serial_number(self):
+        return 0x0abc
+
+
+@pytest.fixture(autouse=True)
+def policy_file(tmp_path, monkeypatch):
+    file_path = tmp_path / "certificate_policy.json"
+    monkeypatch.setattr(certificate_policy, "POLICY_FILE", str(file_path))
+    monkeypatch.setattr(certificate_policy, "POLICY_PROVIDERS", ["file", "gui"])
+    monkeypatch.setattr(certificate_policy, "HEADLESS", True)
+    monkeypatch.setattr(certificate_policy, "_policy_file", (None, None))
+    return file_path
+
+
+def write(file_path, policy, mtime):
+    file_path.write_text(dumps(policy))
+    utime(file_path, ns=(mtime, mtime))
+
+
+def test_no_policy_file_is_refused_without_popup():
+    # headless: the gui provider gives no decision
+    assert certificate_policy.expired_certificate_allowed(Certificate(), USER_CF) is False
+
+
+def test_policy_file_serial_user_and_default(policy_file):
+    write(policy_file, {"allow_expired_serials": ["0ABC"]}, 10 ** 18)
+    assert certificate_policy.expired_certificate_allowed(Certificate(), "OTHER") is True
+
+    # read again when modified
+    write(policy_file, {"allow_expired_users": [USER_CF.lower()]}, 2 * 10 ** 18)
+    assert certificate_policy.expired_certificate_allowed(Certificate(), USER_CF) is True
+    assert certificate_policy.expired_certificate_allowed(Certificate(), "OTHER") is False
+
+    write(policy_file, {"allow_expired": True}, 3 * 10 ** 18)
+    assert certificate_policy.expired_certificate_allowed(Certificate(), "OTHER") is True
+
+
+def test_unreadable_policy_file_is_refused(policy_file):
+    policy_file.write_text("{not json")
+    assert certificate_policy.expired_certificate_allowed(Certificate(), USER_CF) is False
@@ -0,0 +1,176 @@
+from asn1crypto import x509 as asn1_x509
+from conftest import reply
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta, timezone
+from os import makedirs, path, utime
+from singleton_type import SingletonType
+import crl_cache
+import pytest
+import trust_store
+
+
+REVOKED_SERIAL = 1001
+VALID_SERIAL = 1002
+
+
+def name(common_name):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+
+
+class CertificateAuthority:
+    ''' Self signed CA issuing the certificates and the CRLs of the tests '''
+
+    def __init__(self, common_name="digiSign test CA"):
+        self.key = ec.generate_private_key(ec.SECP256R1())
+        self.name = name(common_name)
+        now = datetime.now(timezone.utc)
+        self.certificate = x509.CertificateBuilder().subject_name(self.name).issuer_name(self.name) \
+            .public_key(self.key.public_key()).serial_number(1) \
+            .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=365)) \
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True) \
+            .sign(self.key, hashes.SHA256())
+        self.der = self.certificate.public_bytes(Encoding.DER)
+
+    def issue(self, serial_number, crl_url):
+        ''' asn1crypto certificate, as the verifier gives them to the CRL cache '''
+
+        now = datetime.now(timezone.utc)
+        key = ec.generate_private_key(ec.SECP256R1())
+        certificate = x509.CertificateBuilder().subject_name(name(f"user {serial_number}")) \
+            .issuer_name(self.name).public_key(key.public_key()).serial_number(serial_number) \
+            .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=30)) \
+            .add_extension(x509.CRLDistributionPoints([x509.DistributionPoint(
+                [x509.UniformResourceIdentifier(crl_url)], None, None, None)]), critical=False) \
+            .sign(self.key, hashes.SHA256())
+        return asn1_x509.Certificate.load(certificate.public_bytes(Encoding.DER))
+
+    def crl(self, revoked=(REVOKED_SERIAL,), next_update=timedelta(days=1), signer=None):
+        ''' DER CRL of this CA, signed by `signer` key when given '''
+
+        now = datetime.now(timezone.utc)
+        builder = x509.CertificateRevocationListBuilder().issuer_name(self.name) \
+            .last_update(now - timedelta(hours=1)).next_update(now + next_update)
+        for serial_number in revoked:
+            builder = builder.add_revoked_certificate(
+                x509.RevokedCertificateBuilder().serial_number(serial_number)
+                .revocation_date(now - timedelta(hours=1)).build())
+        return builder.sign(signer or self.key, hashes.SHA256()).public_bytes(Encoding.DER)
+
+
+@pytest.fixture
+def ca():
+    return CertificateAuthority()
+
+
+@pytest.fixture
+def fetch(monkeypatch):
+    monkeypatch.setattr(crl_cache, "FETCH", True)
+
+
+@pytest.fixture(autouse=True)
+def folders(tmp_path, monkeypatch):
+    monkeypatch.setattr(crl_cache, "CRL_FOLDER", str(tmp_path / "crl"))
+    monkeypatch.setattr(crl_cache, "ENABLED", True)
+    monkeypatch.setattr(crl_cache, "FETCH", False)
+    monkeypatch.setattr(crl_cache, "FETCH_TIMEOUT", 2)
+    monkeypatch.setattr(trust_store, "CA_FOLDER", str(tmp_path / "ca"))
+    # new CrlCache and TrustStore on the patched folders
+    monkeypatch.setattr(SingletonType, "_instances", {})
+
+
+def serve(http_server, crl):
+    http_server.routes["/ca.crl"] = lambda handler: reply(handler, 200, crl, "application/pkix-crl")
+    return http_server.url("/ca.crl")
+
+
+def fetched(http_server, ca, crl, serial_number=VALID_SERIAL):
+    certificate = ca.issue(serial_number, serve(http_server, crl))
+    return crl_cache.CrlCache().check(certificate, [ca.der])
+
+
+def write(folder, file_name, content):
+    makedirs(folder, exist_ok=True)
+    with open(path.join(folder, file_name), "wb") as _file:
+        _file.write(content)
+
+
+def test_downloaded_crl_valid(http_server, ca, fetch):
+    assert fetched(http_server, ca, ca.crl()) is True
+    # stored and indexed, not downloaded again
+    assert fetched(http_server, ca, ca.crl(), REVOKED_SERIAL) is False
+    assert len(http_server.requests) == 1
+
+
+def test_downloaded_crl_revoked_serial(http_server, ca, fetch):
+    assert fetched(http_server, ca, ca.crl(), REVOKED_SERIAL) is False
+
+
+def test_downloaded_crl_bad_signature(http_server, ca, fetch):
+    other_key = ec.generate_private_key(ec.SECP256R1())
+
+    assert fetched(http_server, ca, ca.crl(signer=other_key), REVOKED_SERIAL) is None
+    assert not path.exists(crl_cache.CRL_FOLDER)
+
+
+def test_downloaded_crl_expired(http_server, ca, fetch):
+    assert fetched(http_server, ca, ca.crl(next_update=-timedelta(minutes=1)), REVOKED_SERIAL) is None
+
+
+def test_folder_crl_verified_with_trusted_ca(ca, tmp_path):
+    write(tmp_path / "ca", "ca.der", ca.der)
+    write(crl_cache.CRL_FOLDER, "ca.crl", ca.crl())
+    certificate = ca.issue(REVOKED_SERIAL, "http://127.0.0.1/unused.crl")
+
+    assert crl_cache.CrlCache().check(certificate) is False
+
+
+def test_folder_crl_bad_signature_skipped_at_load(ca, tmp_path):
+    write(tmp_path / "ca", "ca.der", ca.der)
+    write(crl_cache.CRL_FOLDER, "ca.crl", ca.crl(signer=ec.generate_private_key(ec.SECP256R1())))
+    certificate = ca.issue(REVOKED_SERIAL, "http://127.0.0.1/unused.crl")
+
+    crl_cache.CrlCache().load()
+    assert crl_cache.CrlCache()._index == {}
+    assert crl_cache.CrlCache().check(certificate, [ca.der]) is None
+
+
+def test_folder_crl_of_intermediate_verified_with_chain(ca):
+    # the issuer is not a trusted CA, the chain of the certificate has it
+    write(crl_cache.CRL_FOLDER, "ca.crl", ca.crl())
+    certificate = ca.issue(REVOKED_SERIAL, "http://127.0.0.1/unused.crl")
+
+    assert crl_cache.CrlCache().check(certificate) is None
+    assert crl_cache.CrlCache().check(certificate, [ca.der]) is False
+    # verified once
+    assert crl_cache.CrlCache().check(certificate) is False
+
+
+def test_folder_crl_of_intermediate_not_signed_by_chain_issuer(ca):
+    write(crl_cache.CRL_FOLDER, "ca.crl", ca.crl())
+    certificate = ca.issue(REVOKED_SERIAL, "http://127.0.0.1/unused.crl")
+    # same name, another key
+    impostor = CertificateAuthority()
+
+    assert crl_cache.CrlCache().check(certificate, [impostor.der]) is None
+    assert crl_cache.CrlCache()._index == {}
+
+
+def test_folder_crl_read_again_when_changed(ca, tmp_path):
+    write(tmp_path / "ca", "ca.der", ca.der)
+    crl_path = path.join(crl_cache.CRL_FOLDER, "ca.crl")
+    write(crl_cache.CRL_FOLDER, "ca.crl", ca.crl(next_update=-timedelta(minutes=1)))
+    certificate = ca.issue(REVOKED_SERIAL, "http://127.0.0.1/unused.crl")
+    assert crl_cache.CrlCache().check(certificate) is None
+
+    # the expired CRL replaced by the new one
+    write(crl_cache.CRL_FOLDER, "ca.crl", ca.crl())
+    utime(crl_path, ns=(0, 10 ** 18))
+    assert crl_cache.CrlCache().check(certificate) is False
+    write(crl_cache.CRL_FOLDER, "ca.crl", ca.crl(revoked=()))
+    utime(crl_path, ns=(0, 2 * 10 ** 18))
+    # still up to date, not read again
+    assert crl_cache.CrlCache().check(certificate) is False
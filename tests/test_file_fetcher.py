@@ -0,0 +1,118 @@
+from conftest import reply
+from os import listdir, path
+from time import sleep
+import file_fetcher
+import pytest
+
+
+CONTENT = bytes(range(256)) * 1024
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(file_fetcher, "TIMEOUT", 0.3)
+    monkeypatch.setattr(file_fetcher, "BACKOFF", 0)
+
+
+def fetch(http_server, folder, route="/file.pdf"):
+    return file_fetcher.FileFetcher().fetch(http_server.url(route), str(folder))
+
+
+def failing(statuses, then=CONTENT):
+    ''' Route answering with `statuses` first, then with `then` '''
+
+    statuses = list(statuses)
+
+    def route(handler):
+        if statuses:
+            reply(handler, statuses.pop(0))
+        else:
+            reply(handler, 200, then)
+    return route
+
+
+def test_fetch_streams_to_disk(http_server, tmp_path):
+    http_server.routes["/file.pdf"] = failing([])
+
+    file_path = fetch(http_server, tmp_path)
+
+    assert file_path == path.join(str(tmp_path), "file.pdf")
+    assert open(file_path, "rb").read() == CONTENT
+    assert listdir(tmp_path) == ["file.pdf"]
+
+
+def test_fetch_retries_server_errors(http_server, tmp_path):
+    http_server.routes["/file.pdf"] = failing([503, 500])
+
+    file_path = fetch(http_server, tmp_path)
+
+    assert open(file_path, "rb").read() == CONTENT
+    assert len(http_server.requests) == 3
+
+
+def test_fetch_gives_up_after_retries(http_server, tmp_path):
+    http_server.routes["/file.pdf"] = failing([502] * (file_fetcher.RETRIES + 1))
+
+    with pytest.raises(file_fetcher.FileFetchError):
+        fetch(http_server, tmp_path)
+    assert len(http_server.requests) == file_fetcher.RETRIES + 1
+    assert listdir(tmp_path) == []
+
+
+def test_fetch_does_not_retry_client_errors(http_server, tmp_path):
+    with pytest.raises(file_fetcher.FileFetchError):
+        fetch(http_server, tmp_path, "/missing.pdf")
+    assert len(http_server.requests) == 1
+
+
+def test_fetch_retries_timeouts(http_server, tmp_path):
+    calls = []
+
+    def slow_once(handler):
+        calls.append(handler.path)
+        if len(calls) == 1:
+            sleep(1)
+        reply(handler, 200, CONTENT)
+    http_server.routes["/file.pdf"] = slow_once
+
+    file_path = fetch(http_server, tmp_path)
+
+    assert open(file_path, "rb").read() == CONTENT
+    assert len(calls) == 2
+
+
+def test_fetch_chunked_response(http_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(file_fetcher, "CHUNK_SIZE", 1000)
+    attempts = []
+
+    def chunked(handler):
+        attempts.append(handler.path)
+        handler.send_response(200)
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        for start in range(0, len(CONTENT), 4096):
+            chunk = CONTENT[start:start + 4096]
+            handler.wfile.write(b"%x\r\n%b\r\n" % (len(chunk), chunk))
+            # the first response breaks halfway
+            if len(attempts) == 1 and start >= len(CONTENT) // 2:
+                handler.close_connection = True
+                return
+        handler.wfile.write(b"0\r\n\r\n")
+    http_server.routes["/file.pdf"] = chunked
+
+    file_path = fetch(http_server, tmp_path)
+
+    assert open(file_path, "rb").read() == CONTENT
+    assert len(attempts) == 2
+    # the broken download left no partial file
+    assert listdir(tmp_path) == ["file.pdf"]
+
+
+def test_fetch_concurrent_names_do_not_collide(http_server, tmp_path):
+    http_server.routes["/file.pdf"] = failing([])
+
+    first = fetch(http_server, tmp_path)
+    second = fetch(http_server, tmp_path)
+
+    assert first != second
+    assert sorted(listdir(tmp_path)) == ["file.pdf", "file_1.pdf"]
@@ -0,0 +1,95 @@
+from conftest import reply
+from json import dumps
+from requests.exceptions import ConnectionError, Timeout
+from socket import socket
+from time import sleep
+import file_uploader
+import pytest
+
+
+CONTENT = b"%PDF-1.4 signed" * 10000
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(file_uploader, "TIMEOUT", 0.3)
+    monkeypatch.setattr(file_uploader, "BACKOFF", 0)
+
+
+@pytest.fixture
+def signed_file(tmp_path):
+    file_path = tmp_path / "document(firmato).pdf"
+    file_path.write_bytes(CONTENT)
+    return str(file_path)
+
+
+def accepted(handler):
+    reply(handler, 200, dumps({"Ok": "remote/document(firmato).pdf"}).encode(), "application/json")
+
+
+def upload(http_server, signed_file):
+    return file_uploader.FileUploader().upload(signed_file, http_server.url("/upload"))
+
+
+def test_upload_multipart_content_length(http_server, signed_file):
+    http_server.routes["/upload"] = accepted
+
+    assert upload(http_server, signed_file) == "remote/document(firmato).pdf"
+
+    method, _, headers, body = http_server.requests[0]
+    assert method == "POST"
+    assert "Transfer-Encoding" not in headers
+    assert int(headers["Content-Length"]) == len(body)
+    boundary = headers["Content-Type"].split("boundary=")[1]
+    head, rest = body.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"--" + boundary.encode())
+    assert b'filename="document(firmato).pdf"' in head
+    assert rest == CONTENT + b"\r\n--" + boundary.encode() + b"--\r\n"
+
+
+def test_upload_retries_unprocessed_status(http_server, signed_file):
+    statuses = [503, 429]
+
+    def busy(handler):
+        if statuses:
+            reply(handler, statuses.pop(0))
+        else:
+            accepted(handler)
+    http_server.routes["/upload"] = busy
+
+    assert upload(http_server, signed_file) == "remote/document(firmato).pdf"
+    assert len(http_server.requests) == 3
+
+
+def test_upload_does_not_retry_server_errors(http_server, signed_file):
+    http_server.routes["/upload"] = lambda handler: reply(
+        handler, 500, dumps({"error_message": "disk full"}).encode(), "application/json")
+
+    with pytest.raises(file_uploader.FileUploadError):
+        upload(http_server, signed_file)
+    assert len(http_server.requests) == 1
+
+
+def test_upload_does_not_retry_timeouts(http_server, signed_file):
+    def slow(handler):
+        sleep(1)
+        accepted(handler)
+    http_server.routes["/upload"] = slow
+
+    with pytest.raises(Timeout):
+        upload(http_server, signed_file)
+    # the file may have been received, it is not sent twice
+    assert len(http_server.requests) == 1
+
+
+def test_upload_retries_refused_connections(signed_file, monkeypatch):
+    delays = []
+    monkeypatch.setattr(file_uploader, "sleep", delays.append)
+    # a port nobody listens to
+    with socket() as closed:
+        closed.bind(("127.0.0.1", 0))
+        url = f"http://127.0.0.1:{closed.getsockname()[1]}/upload"
+
+    with pytest.raises(ConnectionError):
+        file_uploader.FileUploader().upload(signed_file, url)
+    assert len(delays) == file_uploader.RETRIES
@@ -0,0 +1,9 @@
+from import_budget import BUDGET, measure
+
+
+def test_server_import_within_budget():
+    seconds, loaded = measure()
+
+    # heavy libraries are loaded by the first request or the warm-up
+    assert not loaded
+    assert seconds <= BUDGET
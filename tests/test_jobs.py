@@ -0,0 +1,111 @@
+from jobs import BatchRegistry
+from functools import partial
+from json import loads
+from sign_pipeline import SignJob, SignPipeline
+from sign_service import deliver_signed_file
+from singleton_type import SingletonType
+import digiSign_server
+import jobs
+import pytest
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(SingletonType, "_instances", {})
+    return BatchRegistry()
+
+
+@pytest.fixture
+def client(registry):
+    return digiSign_server.server.test_client()
+
+
+def sign_events(registry, batch_id):
+    registry.publish(batch_id, "signed", index=0, file_to_sign="a.pdf", signed="yes", signed_file="")
+    registry.publish(batch_id, "delivered", index=0, file_to_sign="a.pdf", signed="yes",
+                     signed_file="/out/a.pdf")
+    registry.publish(batch_id, "failed", index=1, file_to_sign="b.pdf", signed="no", signed_file="",
+                     error_message="not a pdf")
+
+
+def server_sent_events(response):
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if fields:
+            events.append((int(fields["id"]), fields["event"], loads(fields["data"])))
+    return events
+
+
+def test_events_after_id(registry):
+    batch_id = registry.create()
+    sign_events(registry, batch_id)
+
+    events, done = registry.events(batch_id, after=0, timeout=0)
+    assert [(event["id"], event["event"]) for event in events] == [(1, "delivered"), (2, "failed")]
+    assert not done
+    assert registry.events(batch_id, after=2, timeout=0) == ([], False)
+
+
+def test_status_last_event_of_every_file(registry):
+    batch_id = registry.create()
+    sign_events(registry, batch_id)
+    registry.finish(batch_id, [{"file_to_sign": "a.pdf"}, {"file_to_sign": "b.pdf"}])
+
+    status = registry.status(batch_id)
+    assert status["done"] and status["error_message"] is None
+    assert [(item["index"], item["event"]) for item in status["files"]] == [(0, "delivered"), (1, "failed")]
+    assert registry.events(batch_id, after=2, timeout=0)[0][0]["event"] == "done"
+
+
+def test_finished_batches_expire(registry, monkeypatch):
+    monkeypatch.setattr(jobs, "BATCH_TTL", -1)
+    finished, running = registry.create(), registry.create()
+    registry.finish(finished, [])
+
+    registry.create()
+    with pytest.raises(KeyError):
+        registry.status(finished)
+    assert not registry.status(running)["done"]
+
+
+def test_stream_until_done(client, registry):
+    batch_id = registry.create()
+    sign_events(registry, batch_id)
+    registry.finish(batch_id, [{"file_to_sign": "a.pdf"}])
+
+    events = server_sent_events(client.get(f"/api/jobs/{batch_id}/events"))
+    assert [(number, event) for number, event, _ in events] == \
+        [(0, "signed"), (1, "delivered"), (2, "failed"), (3, "done")]
+    assert events[2][2]["error_message"] == "not a pdf"
+    assert events[3][2]["signed_file_list"] == [{"file_to_sign": "a.pdf"}]
+
+
+def test_stream_resumes_after_last_event_id(client, registry):
+    batch_id = registry.create()
+    sign_events(registry, batch_id)
+    registry.finish(batch_id, error_message="token removed", status=500)
+
+    response = client.get(f"/api/jobs/{batch_id}/events", headers={"Last-Event-ID": "1"})
+    events = server_sent_events(response)
+    assert [(number, event) for number, event, _ in events] == [(2, "failed"), (3, "error")]
+    assert events[1][2]["error_message"] == "token removed" and events[1][2]["status"] == 500
+
+
+def test_stream_of_unknown_job(client):
+    assert client.get("/api/jobs/missing/events").status_code == 404
+
+
+def test_lost_file_is_not_delivered(tmp_path):
+    events = []
+    pipeline = SignPipeline(None, deliver=partial(deliver_signed_file, path_for_signed_files=str(tmp_path),
+                                                  output_to_url=False),
+                            on_event=lambda event, job: events.append(event))
+    job = SignJob(0, str(tmp_path / "a.pdf"), "pdf", None, b"")
+    job.signed_file_path = str(tmp_path / "gone" / "a_signed.pdf")
+
+    pipeline._deliver_stage(job)
+
+    assert events == ["failed"]
+    assert job.output_item["signed"] == "no" and job.output_item["signed_file"] == "LOST"
+    assert isinstance(job.error, OSError)
@@ -0,0 +1,90 @@
+from datetime import datetime
+from io import BytesIO
+from log_archive import LogArchive
+from os import rename, utime
+from singleton_type import SingletonType
+from zipfile import ZipFile
+import digiSign_server
+import log_archive
+import pytest
+
+
+@pytest.fixture
+def logs(tmp_path, monkeypatch):
+    ''' Log folder of the archive: the active log and two rotated ones, a day apart '''
+
+    monkeypatch.setattr(log_archive, "LOGS_FOLDER", str(tmp_path))
+    monkeypatch.setattr(SingletonType, "_instances", {})
+    for number, file_name in enumerate(["digiSign.log.2", "digiSign.log.1", "digiSign.log"]):
+        write(tmp_path / file_name, b"record %d\n" % number * 1000, mtime=86400 * (number + 1))
+    (tmp_path / "old.zip").write_bytes(b"not a log")
+    return tmp_path
+
+
+@pytest.fixture
+def compressions(monkeypatch):
+    compressed = []
+    compress = log_archive.compress
+    monkeypatch.setattr(log_archive, "compress", lambda data, date_time: compressed.append(data) or
+                        compress(data, date_time))
+    return compressed
+
+
+def write(file_path, content, mtime):
+    file_path.write_bytes(content)
+    utime(file_path, (mtime, mtime))
+
+
+def names(since=None, until=None):
+    return [file_name for file_name, _ in LogArchive().members(since, until)]
+
+
+def test_rotated_files_not_compressed_again(logs, compressions):
+    before = dict(LogArchive().members())
+    assert len(compressions) == 3
+
+    # rotation: every file renamed, a new active log
+    rename(logs / "digiSign.log.2", logs / "digiSign.log.3")
+    rename(logs / "digiSign.log.1", logs / "digiSign.log.2")
+    rename(logs / "digiSign.log", logs / "digiSign.log.1")
+    write(logs / "digiSign.log", b"new record\n", mtime=86400 * 4)
+    after = dict(LogArchive().members())
+
+    assert len(compressions) == 4
+    assert after["digiSign.log.3"] is before["digiSign.log.2"]
+    assert after["digiSign.log.1"] is before["digiSign.log"]
+
+
+def test_changed_file_compressed_again(logs, compressions):
+    list(LogArchive().members())
+    write(logs / "digiSign.log", b"one more record\n", mtime=86400 * 4)
+
+    list(LogArchive().members())
+    assert compressions[-1] == b"one more record\n"
+    assert len(compressions) == 4
+
+
+def test_since_until(logs):
+    # files in mtime order, each one holds the records after the previous one
+    assert names() == ["digiSign.log.2", "digiSign.log.1", "digiSign.log"]
+    assert names(since=86400 * 1.5) == ["digiSign.log.1", "digiSign.log"]
+    assert names(until=86400 * 1.5) == ["digiSign.log.2", "digiSign.log.1"]
+    assert names(since=86400 * 1.5, until=86400 * 1.5) == ["digiSign.log.1"]
+    assert names(since=86400 * 4) == []
+
+
+def test_easylog_zip(logs):
+    client = digiSign_server.server.test_client()
+    response = client.get("/easylog")
+
+    assert response.status_code == 200 and response.mimetype == "application/zip"
+    with ZipFile(BytesIO(response.data)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ["digiSign.log.2", "digiSign.log.1", "digiSign.log"]
+        assert archive.read("digiSign.log") == (logs / "digiSign.log").read_bytes()
+
+    since = datetime.fromtimestamp(86400 * 2.5).isoformat()
+    with ZipFile(BytesIO(client.get(f"/easylog?since={since}").data)) as archive:
+        assert archive.namelist() == ["digiSign.log"]
+
+    assert client.get("/easylog?until=yesterday").status_code == 400
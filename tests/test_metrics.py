@@ -0,0 +1,35 @@
+from singleton_type import SingletonType
+import metrics
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def fresh(monkeypatch):
+    monkeypatch.setattr(metrics, "PUSH_INTERVAL", 0.05)
+    monkeypatch.setattr(SingletonType, "_instances", {})
+
+
+def test_values_are_pushed_in_background_not_per_update():
+    sent = []
+    metrics.Metrics().inc("digisign_requests_total", endpoint="sign")
+    metrics.Metrics().inc("digisign_requests_total", endpoint="sign")
+    metrics.MetricsPusher().start(sent.append)
+    metrics.MetricsPusher().stop()
+
+    _, counters, _ = metrics.Metrics().drain()
+    assert counters == {}
+    total = metrics.Metrics()
+    for values in sent:
+        total.merge(values)
+    assert 'digisign_requests_total{endpoint="sign"} 2' in total.render()
+
+
+def test_values_are_kept_when_not_sent():
+    def unreachable(values):
+        raise ConnectionError
+
+    metrics.Metrics().inc("digisign_errors_total", exception="ValueError")
+    metrics.MetricsPusher().start(unreachable)
+    metrics.MetricsPusher().stop()
+
+    assert 'digisign_errors_total{exception="ValueError"} 1' in metrics.Metrics().render()
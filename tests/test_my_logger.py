@@ -0,0 +1,50 @@
+from json import loads
+from os import path
+import subprocess
+import sys
+
+
+# run in a new interpreter: the logger is a process-wide singleton
+SCRIPT = '''
+import os, sys
+import my_logger
+my_logger.LOGGING_FOLDER = sys.argv[1]
+my_logger.LOGGING_FILE_PATH = os.path.join(sys.argv[1], "digiSign.log")
+my_logger.FILE_SIZE = 20000
+logger = my_logger.get_logger("test")
+from concurrent.futures import ProcessPoolExecutor
+
+def work(n):
+    for i in range(100):
+        logger.info("pool %d record %d", n, i)
+    return my_logger.MyLogger()._file_handler is None
+
+if __name__ == "__main__":
+    logger.info("parent record")
+    children = []
+    for n in range(3):
+        pid = os.fork()
+        if pid == 0:
+            for i in range(100):
+                logger.info("child %d record %d", n, i)
+            os._exit(0 if my_logger.MyLogger()._file_handler is None else 1)
+        children.append(pid)
+    with ProcessPoolExecutor(2) as pool:
+        assert all(pool.map(work, range(2)))
+    for pid in children:
+        assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
+'''
+
+
+def test_one_writer_for_every_process(tmp_path):
+    root = path.dirname(path.dirname(path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", SCRIPT, str(tmp_path)], cwd=root, check=True, timeout=60)
+
+    records = []
+    for log_file in tmp_path.iterdir():
+        records += [loads(line) for line in log_file.read_text().splitlines()]
+    messages = [record["message"] for record in records]
+    # nothing lost nor garbled across the rotations
+    assert len(list(tmp_path.iterdir())) > 1
+    assert sum("record" in message for message in messages) == 501
+    assert len(set(record["process"] for record in records)) == 6
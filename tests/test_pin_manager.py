@@ -0,0 +1,77 @@
+from types import ModuleType, SimpleNamespace
+import pin_manager
+import pytest
+import sign_service
+import sys
+
+
+USER_ID = "RSSMRA80A01H501U"
+
+
+@pytest.fixture(autouse=True)
+def providers(monkeypatch):
+    monkeypatch.setattr(pin_manager, "memorized_pin", {})
+    monkeypatch.setattr(pin_manager, "_rejected_pins", {})
+    monkeypatch.setattr(pin_manager, "PIN_PROVIDERS", ["env", "keyring", "gui"])
+    monkeypatch.setattr(pin_manager, "HEADLESS", True)
+    monkeypatch.delenv(pin_manager.PIN_ENV, raising=False)
+    monkeypatch.delenv(f"{pin_manager.PIN_ENV}_{USER_ID}", raising=False)
+    # no keyring unless a test gives one
+    monkeypatch.setitem(sys.modules, "keyring", None)
+
+    def popup(user_id):
+        raise AssertionError("popup opened in headless mode")
+    monkeypatch.setattr(pin_manager, "_get_pin_popup", popup)
+
+
+def keyring(monkeypatch, passwords):
+    module = ModuleType("keyring")
+    module.get_password = lambda service, user_id: passwords.get((service, user_id))
+    monkeypatch.setitem(sys.modules, "keyring", module)
+
+
+def test_env_pin_of_the_user_first(monkeypatch):
+    monkeypatch.setenv(pin_manager.PIN_ENV, "1111")
+    assert pin_manager.get_user_pin(USER_ID) == "1111"
+
+    pin_manager.clear_pin(USER_ID)
+    monkeypatch.setenv(f"{pin_manager.PIN_ENV}_{USER_ID}", "2222")
+    assert pin_manager.get_user_pin(USER_ID) == "2222"
+    assert pin_manager.memorized_pin[USER_ID]["provider"] == "env"
+
+
+def test_keyring_pin(monkeypatch):
+    keyring(monkeypatch, {(pin_manager.KEYRING_SERVICE, USER_ID): "3333"})
+
+    assert pin_manager.get_user_pin(USER_ID) == "3333"
+    assert pin_manager.memorized_pin[USER_ID]["provider"] == "keyring"
+    assert pin_manager.has_valid_pin(USER_ID)
+
+
+def test_headless_without_pin_fails_at_once():
+    with pytest.raises(ValueError):
+        pin_manager.get_user_pin(USER_ID)
+    assert not pin_manager.has_valid_pin(USER_ID)
+
+
+def test_refused_pin_is_not_given_again(monkeypatch):
+    monkeypatch.setenv(pin_manager.PIN_ENV, "0000")
+    keyring(monkeypatch, {(pin_manager.KEYRING_SERVICE, USER_ID): "4444"})
+
+    def session_login(sessions, pin):
+        if pin != "4444":
+            raise Exception("CKR_PIN_INCORRECT")
+        return "session"
+    library = SimpleNamespace(get_smart_cards_sessions=lambda: ["slot"], session_login=session_login)
+    monkeypatch.setattr(sign_service, "digiSign_lib",
+                        SimpleNamespace(DigiSignLib=lambda: library))
+    monkeypatch.setattr(sign_service, "TokenSigner", lambda session: session)
+
+    with pytest.raises(sign_service.SignRequestError):
+        sign_service.open_token_signer(USER_ID, pin_manager.get_user_pin, pin_manager.clear_pin)
+    assert not pin_manager.has_valid_pin(USER_ID)
+
+    # the env PIN would lock the card, the keyring one is asked next
+    assert sign_service.open_token_signer(USER_ID, pin_manager.get_user_pin,
+                                          pin_manager.clear_pin) == "session"
+    assert pin_manager.memorized_pin[USER_ID]["provider"] == "keyring"
@@ -0,0 +1,73 @@
+from io import BytesIO
+from os import listdir
+from test_verify import identity, p7m
+import digiSign_server
+import pytest
+import verify_service
+import workspace
+
+
+@pytest.fixture(scope="module")
+def signed():
+    return p7m([identity("Mario Rossi"), identity("Anna Bianchi")])
+
+
+@pytest.fixture(scope="module", autouse=True)
+def verify_pool():
+    yield
+    verify_service.VerifyPool().shutdown()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(workspace, "UPLOAD_FOLDER", str(tmp_path / "uploads"))
+    monkeypatch.setattr(workspace, "SIGNED_FOLDER", str(tmp_path / "signed"))
+    return digiSign_server.server.test_client()
+
+
+def uploads_left():
+    return listdir(workspace.UPLOAD_FOLDER) + listdir(workspace.SIGNED_FOLDER)
+
+
+def test_verify_multipart_uploads(client, signed):
+    response = client.post("/api/verify", content_type="multipart/form-data", data={
+        "first": (BytesIO(signed), "contract.p7m"), "second": (BytesIO(b"not signed"), "notes.txt")})
+
+    assert response.status_code == 200
+    first, second = response.json["verified_file_list"]
+    assert (first["file"], first["type"], first["bytes"]) == ("contract.p7m", "p7m", len(signed))
+    # both parallel signatures, not trusted here
+    assert [signature["signatureok?"] for signature in first["signatures"]] == [True, True]
+    assert second["file"] == "notes.txt" and second["error"] and not second["valid"]
+    assert uploads_left() == []
+
+
+def test_verify_raw_body(client, signed):
+    response = client.post("/api/verify?filename=../contract.p7m", data=signed,
+                           content_type="application/pkcs7-mime")
+
+    assert response.status_code == 200
+    [result] = response.json["verified_file_list"]
+    assert result["file"] == "contract.p7m" and len(result["signatures"]) == 2
+    assert uploads_left() == []
+
+
+def test_verify_without_documents(client):
+    response = client.post("/api/verify", data=b"", content_type="application/pkcs7-mime")
+
+    assert response.status_code == 404
+    assert uploads_left() == []
+
+
+@pytest.mark.parametrize("multipart", [False, True])
+def test_verify_body_over_the_limit(client, signed, monkeypatch, multipart):
+    monkeypatch.setitem(digiSign_server.server.config, "MAX_CONTENT_LENGTH", len(signed) // 2)
+    if multipart:
+        response = client.post("/api/verify", content_type="multipart/form-data",
+                               data={"first": (BytesIO(signed), "contract.p7m")})
+    else:
+        response = client.post("/api/verify?filename=contract.p7m", data=signed,
+                               content_type="application/pkcs7-mime")
+
+    assert response.status_code == 413
+    assert uploads_left() == []
@@ -0,0 +1,147 @@
+from mock_pkcs11 import MockSession
+from os import kill, path
+from signal import SIGKILL
+from sign_pipeline import SignJob, SignPipeline, StagePools, TokenSigner
+from singleton_type import SingletonType
+from threading import Lock
+from time import monotonic, sleep
+import pytest
+import sign_pipeline
+import verify
+
+
+CPU_WORKERS = 2
+PDF_ATTRIBUTES = {"visibility": "invisible", "position": {"page": "n"}}
+P7M_ATTRIBUTES = {"p7m_sig_type": ""}
+
+
+def make_pdf(pages=1):
+    ''' Smallest PDF the signer accepts: catalog, pages, info and blank pages '''
+
+    objects = [b"<</Type/Catalog/Pages 2 0 R>>",
+               b"<</Type/Pages/Kids[%s]/Count %d>>" % (
+                   b" ".join(b"%d 0 R" % (4 + page) for page in range(pages)), pages),
+               b"<</Producer(test)>>"]
+    objects += [b"<</Type/Page/Parent 2 0 R/MediaBox [0 0 612 792]>>"] * pages
+    pdf, offsets = b"%PDF-1.4\n", []
+    for number, content in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, content)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    return pdf + b"trailer\n<</Size %d/Root 1 0 R/Info 3 0 R>>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, xref)
+
+
+class SlowSigner(TokenSigner):
+    ''' Software token taking its time, counting the files prepared ahead of it '''
+
+    def __init__(self, events):
+        super().__init__(MockSession())
+        self.events = events
+        self.ahead = []
+
+    def _signing(self):
+        prepared = sum(1 for event, _ in self.events if event == "prepared")
+        signed = sum(1 for event, _ in self.events if event == "signed")
+        # but the one being signed
+        self.ahead.append(prepared - signed - 1)
+        sleep(0.05)
+
+    def sign_pdf_digest(self, digest):
+        self._signing()
+        return super().sign_pdf_digest(digest)
+
+    def sign_bytes(self, bytes_to_sign):
+        self._signing()
+        return super().sign_bytes(bytes_to_sign)
+
+
+@pytest.fixture
+def pools(monkeypatch):
+    monkeypatch.setattr(SingletonType, "_instances", {})
+    monkeypatch.setattr(sign_pipeline, "TOKEN_QUEUE_SIZE", 1)
+    StagePools().set_cpu_workers(CPU_WORKERS)
+    yield StagePools()
+    StagePools().shutdown()
+
+
+@pytest.fixture
+def documents(tmp_path):
+    ''' (file, signature type) of the batch: pdf and p7m ones, then one that is not a pdf '''
+
+    (tmp_path / "signed").mkdir()
+    files = []
+    for number in range(4):
+        pdf = tmp_path / f"contract{number}.pdf"
+        pdf.write_bytes(make_pdf(number + 1))
+        text = tmp_path / f"notes{number}.txt"
+        text.write_bytes(b"notes %d\n" % number * 100)
+        files += [(str(pdf), "pdf"), (str(text), "p7m")]
+    return files + [(str(tmp_path / "notes0.txt"), "pdf")]
+
+
+def run(signer, documents, output_folder):
+    events, delivered, lock = signer.events, [], Lock()
+
+    def on_event(event, job):
+        with lock:
+            events.append((event, job.index))
+    jobs = [SignJob(index, file_path, signature_type,
+                    PDF_ATTRIBUTES if signature_type == "pdf" else P7M_ATTRIBUTES,
+                    signer.certificate_value, output_folder)
+            for index, (file_path, signature_type) in enumerate(documents)]
+    results = SignPipeline(signer, deliver=lambda job: delivered.append(job.signed_file_path),
+                           on_event=on_event).run(jobs)
+    return results, delivered
+
+
+def stages(events, index):
+    return [event for event, job in events if job == index]
+
+
+def test_pdf_and_p7m_batch(pools, documents, tmp_path):
+    signer = SlowSigner([])
+    results, delivered = run(signer, documents, str(tmp_path / "signed"))
+
+    assert [job.index for job in results] == list(range(len(documents)))
+    *signed, failed = results
+    assert [job.output_item["signed"] for job in signed] == ["yes"] * len(signed)
+    assert sorted(delivered) == sorted(job.signed_file_path for job in signed)
+    assert signer.session.sign_calls == len(signed)
+    for job in signed:
+        assert path.dirname(job.signed_file_path) == str(tmp_path / "signed")
+        with open(job.signed_file_path, "rb") as signed_file:
+            content = signed_file.read()
+        check = verify.verify if job.signature_type == "pdf" else verify.verify_p7m
+        assert all(result["hashok?"] and result["signatureok?"] for result in check(content))
+
+    # every file goes through the stages in order, the pdf ones are verified after signing
+    for job in signed:
+        expected = ["downloaded", "prepared", "signed", "delivered"]
+        if job.signature_type == "pdf":
+            expected.insert(3, "verified")
+        assert stages(signer.events, job.index) == expected
+    assert stages(signer.events, failed.index) == ["failed"]
+    assert failed.output_item["signed"] == "no" and isinstance(failed.error, ValueError)
+
+    # prepared files wait in the token queue or hold a slot, no more run ahead
+    assert max(signer.ahead) <= sign_pipeline.TOKEN_QUEUE_SIZE + CPU_WORKERS
+
+
+def test_process_pool_restarted_when_broken(pools, documents, tmp_path):
+    pools.start_cpu_workers()
+    cpu_pool = pools.cpu_pool()
+    for pid in list(cpu_pool._processes):
+        kill(pid, SIGKILL)
+    deadline = monotonic() + 5
+    while not cpu_pool._broken:
+        assert monotonic() < deadline, "pool not broken"
+        sleep(0.01)
+
+    signer = SlowSigner([])
+    results, _ = run(signer, documents[:2], str(tmp_path / "signed"))
+
+    assert [job.output_item["signed"] for job in results] == ["yes", "yes"]
+    assert pools.cpu_pool() is not cpu_pool
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+import pin_manager
+import pytest
+import sign_service
+
+
+USER_ID = "X" * 15
+CERTIFICATE = b"cached certificate"
+
+
+class CachedCertificate:
+    def certificate(self, user_id):
+        return CERTIFICATE
+
+
+class Owner:
+    def __init__(self, pin_valid):
+        self.pin_valid = pin_valid
+
+    def has_valid_pin(self, user_id):
+        return self.pin_valid
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setattr(sign_service, "SignCache", CachedCertificate)
+    monkeypatch.setattr(pin_manager, "memorized_pin", {})
+
+
+def service(token_owner=None):
+    logins = []
+    service = sign_service.SignService(pin_manager.get_user_pin, pin_manager.clear_pin,
+                                       token_owner, pin_manager.has_valid_pin)
+    service._login = lambda user_id: logins.append(user_id) or "live signer"
+    return service, logins
+
+
+def test_cached_certificate_without_pin_logs_in():
+    service_, logins = service()
+
+    assert service_._open_signer(USER_ID) == "live signer"
+    assert logins == [USER_ID]
+
+
+def test_cached_certificate_with_expired_pin_logs_in():
+    expired = datetime.now() - timedelta(seconds=pin_manager.PIN_TIMEOUT + 1)
+    pin_manager.memorized_pin[USER_ID] = {"pin": "1234", "timestamp": expired}
+    service_, logins = service()
+
+    assert service_._open_signer(USER_ID) == "live signer"
+    assert logins == [USER_ID]
+
+
+def test_cached_certificate_with_valid_pin_defers_login():
+    pin_manager.memorized_pin[USER_ID] = {"pin": "1234", "timestamp": datetime.now()}
+    service_, logins = service()
+
+    signer = service_._open_signer(USER_ID)
+    assert isinstance(signer, sign_service.LazyTokenSigner)
+    assert signer.certificate_value == CERTIFICATE
+    assert logins == []
+
+
+def test_token_owner_holds_the_pin():
+    # a PIN memorized in this process does not count, the owner's does
+    pin_manager.memorized_pin[USER_ID] = {"pin": "1234", "timestamp": datetime.now()}
+    service_, logins = service(Owner(pin_valid=False))
+    assert service_._open_signer(USER_ID) == "live signer"
+
+    service_, logins = service(Owner(pin_valid=True))
+    assert isinstance(service_._open_signer(USER_ID), sign_service.LazyTokenSigner)
+    assert logins == []
+
+
+def test_empty_file_list_is_refused():
+    service_, logins = service()
+
+    with pytest.raises(sign_service.SignRequestError) as err:
+        service_.sign(USER_ID, [], "/tmp")
+    assert (err.value.error_message, err.value.status) == ("Empty file_list", 404)
+    assert logins == []
@@ -0,0 +1,56 @@
+from singleton_type import SingletonType
+from threading import Event, Thread
+from types import SimpleNamespace
+import pin_manager
+import pytest
+import sign_service
+import token_owner
+
+
+class Signer:
+    def __init__(self, session):
+        self.certificate_value = session
+
+    def sign_bytes(self, bytes_to_sign):
+        return b"signed " + bytes_to_sign
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def smart_card(monkeypatch):
+    library = SimpleNamespace(get_smart_cards_sessions=lambda: ["slot"],
+                              session_login=lambda sessions, pin: f"session {pin}")
+    monkeypatch.setattr(sign_service, "digiSign_lib", SimpleNamespace(DigiSignLib=lambda: library))
+    monkeypatch.setattr(sign_service, "TokenSigner", Signer)
+    monkeypatch.setattr(SingletonType, "_instances", {})
+
+
+def test_pin_prompt_does_not_block_the_other_users(monkeypatch):
+    typing = Event()
+    typed = Event()
+
+    def get_user_pin(user_id):
+        if user_id == "slow":
+            typing.set()
+            assert typed.wait(5)
+        return f"pin of {user_id}"
+    monkeypatch.setattr(pin_manager, "get_user_pin", get_user_pin)
+
+    owner = token_owner.TokenOwner()
+    handle, certificate_value = owner.open("fast")
+    assert certificate_value == "session pin of fast"
+
+    opened = []
+    prompt = Thread(target=lambda: opened.append(owner.open("slow")))
+    prompt.start()
+    assert typing.wait(5)
+    # while the slow user types the PIN
+    assert owner.sign_bytes(handle, b"digest") == b"signed digest"
+    assert owner.open("other")[1] == "session pin of other"
+    owner.close(handle)
+
+    typed.set()
+    prompt.join(5)
+    assert opened[0][1] == "session pin of slow"
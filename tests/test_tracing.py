@@ -0,0 +1,74 @@
+from flask import Flask
+from json import load
+from tracing import Tracer, span, trace_context, traced, traced_request
+import pytest
+import tracing
+
+
+@traced("checksum")
+def checksum(data):
+    return sum(data)
+
+
+def worker_stage(trace):
+    ''' A stage run elsewhere: its spans are drained and sent back '''
+
+    with trace_context(trace), span("prepare", file="a.pdf"):
+        pass
+    return None if trace is None else Tracer().drain(trace[0])
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACES_FOLDER", str(tmp_path / "traces"))
+    monkeypatch.setattr(tracing, "SAMPLE_RATE", 0)
+    app = Flask(__name__)
+
+    @app.route("/api/sign", methods=["POST"])
+    @traced_request
+    def sign():
+        with span("token_sign"):
+            checksum(b"data")
+        Tracer().merge(worker_stage(tracing.current_trace.get()))
+        return "signed"
+
+    return app.test_client()
+
+
+def trace_events(trace_id):
+    with open(f"{tracing.TRACES_FOLDER}/{trace_id}.json") as _file:
+        trace = load(_file)
+    assert trace["otherData"]["trace_id"] == trace_id
+    return {event["name"]: event for event in trace["traceEvents"]}
+
+
+def test_traced_request_writes_chrome_trace(client):
+    response = client.post("/api/sign", headers={tracing.HEADER: "1"})
+
+    trace_id = response.headers["X-Trace-Id"]
+    events = trace_events(trace_id)
+    assert set(events) == {"POST /api/sign", "token_sign", "checksum", "prepare"}
+    for event in events.values():
+        assert event["ph"] == "X" and event["dur"] >= 0 and event["args"]["trace_id"] == trace_id
+    root = events["POST /api/sign"]
+    assert root["args"]["parent_id"] is None
+    assert events["token_sign"]["args"]["parent_id"] == root["args"]["span_id"]
+    assert events["checksum"]["args"]["parent_id"] == events["token_sign"]["args"]["span_id"]
+    assert events["prepare"]["args"]["parent_id"] == root["args"]["span_id"]
+    assert events["prepare"]["args"]["file"] == "a.pdf"
+    assert root["ts"] <= events["token_sign"]["ts"]
+
+
+def test_traceparent_keeps_trace_id(client):
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    response = client.post("/api/sign", headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"})
+
+    assert response.headers["X-Trace-Id"] == trace_id
+    assert "POST /api/sign" in trace_events(trace_id)
+
+
+def test_request_not_sampled(client, tmp_path):
+    response = client.post("/api/sign")
+
+    assert response.data == b"signed" and "X-Trace-Id" not in response.headers
+    assert not (tmp_path / "traces").exists()
@@ -0,0 +1,100 @@
+from singleton_type import SingletonType
+from test_crl_cache import CertificateAuthority, write
+from trust_store import TrustStore
+import pytest
+import trust_store
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def ca(tmp_path, monkeypatch):
+    ca = CertificateAuthority()
+    write(str(tmp_path / "ca"), "ca.der", ca.der)
+    monkeypatch.setattr(trust_store, "CA_FOLDER", str(tmp_path / "ca"))
+    monkeypatch.setattr(SingletonType, "_instances", {})
+    return ca
+
+
+@pytest.fixture
+def chain_checks(monkeypatch):
+    ''' Number of chains built by OpenSSL '''
+
+    checks = []
+    context = trust_store.crypto.X509StoreContext
+
+    def counted(*args):
+        checks.append(args)
+        return context(*args)
+    monkeypatch.setattr(trust_store.crypto, "X509StoreContext", counted)
+    return checks
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(trust_store, "monotonic", clock)
+    return clock
+
+
+def test_result_cached(ca, chain_checks, clock):
+    certificate = ca.issue(1002, "http://crl.example/ca.crl").dump()
+
+    assert TrustStore().verify_certificate(certificate)
+    assert TrustStore().verify_certificate(certificate)
+    assert len(chain_checks) == 1
+
+    # another chain is another check
+    assert TrustStore().verify_certificate(certificate, chain=[ca.der])
+    assert len(chain_checks) == 2
+
+
+def test_not_trusted_cached_too(ca, chain_checks, clock):
+    other = CertificateAuthority("other CA").issue(7, "http://crl.example/other.crl").dump()
+
+    assert not TrustStore().verify_certificate(other)
+    assert not TrustStore().verify_certificate(other)
+    assert len(chain_checks) == 1
+
+
+def test_result_expires(ca, chain_checks, clock, monkeypatch):
+    monkeypatch.setattr(trust_store, "CACHE_TTL", 60)
+    certificate = ca.issue(1002, "http://crl.example/ca.crl").dump()
+    TrustStore().verify_certificate(certificate)
+
+    clock.now += 59
+    TrustStore().verify_certificate(certificate)
+    assert len(chain_checks) == 1
+
+    clock.now += 2
+    TrustStore().verify_certificate(certificate)
+    assert len(chain_checks) == 2
+
+
+def test_reload_forgets_results(ca, chain_checks, clock, tmp_path):
+    certificate = ca.issue(1002, "http://crl.example/ca.crl").dump()
+    version = TrustStore().version()
+    assert TrustStore().verify_certificate(certificate)
+
+    (tmp_path / "ca" / "ca.der").unlink()
+    TrustStore().reload()
+
+    assert TrustStore().version() != version
+    assert not TrustStore().verify_certificate(certificate)
+    assert len(chain_checks) == 2
+
+
+def test_ca_folder_read_once(ca, monkeypatch):
+    loads = []
+    load_folder = trust_store._load_folder
+    monkeypatch.setattr(trust_store, "_load_folder", lambda folder: loads.append(folder) or load_folder(folder))
+
+    for serial_number in (1, 2, 3):
+        TrustStore().verify_certificate(ca.issue(serial_number, "http://crl.example/ca.crl").dump())
+    assert loads == [trust_store.CA_FOLDER]
@@ -0,0 +1,131 @@
+from asn1crypto import cms, x509 as asn1_x509
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+import pytest
+import verifier
+import verify
+
+
+CONTENT = b"document signed by two people"
+
+
+def identity(common_name, key_identifier=False):
+    ''' RSA key and self signed asn1crypto certificate, with a subject key identifier when asked '''
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.now(timezone.utc)
+    builder = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+        .public_key(key.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=30))
+    if key_identifier:
+        builder = builder.add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+    certificate = builder.sign(key, hashes.SHA256())
+    return key, asn1_x509.Certificate.load(certificate.public_bytes(Encoding.DER))
+
+
+def signer_info(key, certificate, content, by_key_identifier=False):
+    attributes = cms.CMSAttributes([
+        cms.CMSAttribute({"type": "content_type", "values": ["data"]}),
+        cms.CMSAttribute({"type": "message_digest", "values": [sha256(content).digest()]}),
+    ])
+    return cms.SignerInfo({
+        "sid": cms.SignerIdentifier({"subject_key_identifier": certificate.key_identifier})
+        if by_key_identifier else
+        cms.SignerIdentifier({"issuer_and_serial_number": cms.IssuerAndSerialNumber({
+            "issuer": certificate.issuer, "serial_number": certificate.serial_number})}),
+        "version": "v3" if by_key_identifier else "v1",
+        "digest_algorithm": {"algorithm": "sha256"},
+        "signed_attrs": attributes,
+        "signature_algorithm": {"algorithm": "rsassa_pkcs1v15"},
+        "signature": key.sign(attributes.dump(), padding.PKCS1v15(), hashes.SHA256()),
+    })
+
+
+def p7m(signers, content=CONTENT):
+    ''' Attached CMS of `content`, signed in parallel by every (key, certificate) '''
+
+    return cms.ContentInfo({"content_type": "signed_data", "content": cms.SignedData({
+        "version": "v1",
+        "digest_algorithms": [{"algorithm": "sha256"}],
+        "encap_content_info": {"content_type": "data", "content": content},
+        "certificates": [certificate for _, certificate in signers],
+        "signer_infos": [signer_info(key, certificate, content) for key, certificate in signers],
+    })}).dump()
+
+
+@pytest.fixture(scope="module")
+def signers():
+    return [identity("Mario Rossi"), identity("Anna Bianchi")]
+
+
+def trusted(signers):
+    return [certificate.dump() for _, certificate in signers]
+
+
+def test_every_parallel_signature_is_verified(signers):
+    results = verify.verify_p7m(p7m(signers), trusted(signers))
+
+    assert results == [{"hashok?": True, "signatureok?": True, "certok?": True}] * 2
+
+
+def test_co_signature_checked_on_its_own(signers):
+    # the second signer's certificate is not trusted
+    results = verify.verify_p7m(p7m(signers), trusted(signers[:1]))
+    assert [result["certok?"] for result in results] == [True, False]
+
+    # the second signature made with another key
+    other_key, _ = identity("Anna Bianchi")
+    results = verify.verify_p7m(p7m([signers[0], (other_key, signers[1][1])]), trusted(signers))
+    assert [result["signatureok?"] for result in results] == [True, False]
+
+
+def test_nested_p7m_levels_and_signers(signers):
+    inner = p7m(signers[:1])
+    results = verify.verify_p7m(p7m(signers, inner), trusted(signers))
+
+    # outer level signers first, then the inner one
+    assert len(results) == 3
+    assert all(all(result.values()) for result in results)
+
+
+def test_signer_certificate_by_issuer_and_serial_number(signers):
+    certificates = cms.CertificateSet([certificate for _, certificate in signers])
+    index = verifier.certificate_index(certificates)
+
+    for key, certificate in signers:
+        sid = signer_info(key, certificate, CONTENT)["sid"]
+        assert index[verifier.signer_key(sid)] == certificate.dump()
+
+
+def test_signer_certificate_by_key_identifier(signers):
+    key, certificate = identity("Luca Verdi", key_identifier=True)
+    certificates = cms.CertificateSet([certificate for _, certificate in signers] + [certificate])
+
+    sid = signer_info(key, certificate, CONTENT, by_key_identifier=True)["sid"]
+    assert verifier.signer_key(sid) == ("ski", certificate.key_identifier)
+    assert verifier.certificate_index(certificates)[verifier.signer_key(sid)] == certificate.dump()
+
+    # the certificates come in any order, the signer is still found
+    signed = cms.ContentInfo.load(p7m(signers + [(key, certificate)]))
+    signed["content"]["signer_infos"][2] = signer_info(key, certificate, CONTENT, by_key_identifier=True)
+    results = verify.verify_p7m(signed.dump(), trusted(signers) + [certificate.dump()])
+    assert results == [{"hashok?": True, "signatureok?": True, "certok?": True}] * 3
+
+
+def test_signer_certificate_missing(signers):
+    other_key, other = identity("Luca Verdi")
+    signed = cms.ContentInfo.load(p7m(signers))
+    signed["content"]["signer_infos"][1] = signer_info(other_key, other, CONTENT)
+
+    results = verify.verify_p7m(signed.dump(), trusted(signers) + [other.dump()])
+    # the signer infos are a SET OF, re-encoding sorts them
+    assert sorted(results, key=lambda result: result["certok?"]) == [
+        {"hashok?": True, "signatureok?": False, "certok?": False},
+        {"hashok?": True, "signatureok?": True, "certok?": True}]
@@ -0,0 +1,91 @@
+from singleton_type import SingletonType
+from test_verify import identity, p7m, CONTENT
+from time import sleep, time
+from verify_cache import VerifyCache
+import sqlite3
+import pytest
+import verifier
+import verify_cache
+
+
+RESULT = {"hashok?": True, "signatureok?": True, "certok?": False}
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(SingletonType, "_instances", {})
+    monkeypatch.setattr(verify_cache, "ENABLED", True)
+    monkeypatch.setattr(verify_cache, "TTL", 3600)
+    monkeypatch.setattr(verify_cache, "TRUST_STORE_TTL", 3600)
+    monkeypatch.setattr(verify_cache, "CACHE_FOLDER", str(tmp_path))
+    monkeypatch.setattr(verify_cache, "DB_FILE", str(tmp_path / "verify_cache.sqlite3"))
+    return VerifyCache()
+
+
+def expiry(cache, key):
+    return cache._results[key][1]
+
+
+def test_key():
+    key = VerifyCache.key(b"cms", b"digest", [b"a", b"b"], "v1")
+
+    assert key == VerifyCache.key(b"cms", b"digest", [b"b", b"a"], "v1")
+    assert key == VerifyCache.key(b"cms", b"digest", [b"a", b"b"], "v1", signer=0)
+    assert len({key,
+                VerifyCache.key(b"other cms", b"digest", [b"a", b"b"], "v1"),
+                VerifyCache.key(b"cms", b"other digest", [b"a", b"b"], "v1"),
+                VerifyCache.key(b"cms", b"digest", [b"a"], "v1"),
+                VerifyCache.key(b"cms", b"digest", [b"a", b"b"], "v2"),
+                VerifyCache.key(b"cms", b"digest", [b"a", b"b"], "v1", signer=1)}) == 6
+
+
+def test_expiry_is_the_shortest(cache, monkeypatch):
+    cache.put("ttl", RESULT)
+    assert expiry(cache, "ttl") <= time() + 3600
+
+    monkeypatch.setattr(verify_cache, "TRUST_STORE_TTL", 60)
+    cache.put("trust store", RESULT)
+    assert expiry(cache, "trust store") <= time() + 60
+
+    not_after = time() + 10
+    cache.put("certificate", RESULT, not_after)
+    assert expiry(cache, "certificate") == not_after
+    assert cache.get("certificate") == RESULT
+
+
+def test_expired_certificate_not_cached(cache):
+    cache.put("expired", RESULT, time() - 1)
+
+    assert cache.get("expired") is None
+    assert "expired" not in cache._results
+
+
+def test_verifier_caches_until_the_signer_certificate_expires(cache, monkeypatch):
+    monkeypatch.setattr(verify_cache, "TTL", 365 * 86400)
+    monkeypatch.setattr(verify_cache, "TRUST_STORE_TTL", 365 * 86400)
+    signers = [identity("Mario Rossi")]
+
+    verifier.verify(p7m(signers), CONTENT, [])
+
+    [(result, cached_expiry)] = cache._results.values()
+    assert cached_expiry == signers[0][1]['tbs_certificate']['validity']['not_after'].native.timestamp()
+
+
+def test_sqlite_pruned(cache, monkeypatch, tmp_path):
+    monkeypatch.setattr(verify_cache, "PERSISTENT", True)
+    monkeypatch.setattr(verify_cache, "PRUNE_EVERY", 4)
+    monkeypatch.setattr(verify_cache, "MAX_DISK_ENTRIES", 2)
+    cache.put("expiring", RESULT, time() + 0.01)
+    sleep(0.02)
+    for key, ttl in [("first", 10), ("second", 20), ("third", 30)]:
+        cache.put(key, RESULT, time() + ttl)
+
+    with sqlite3.connect(verify_cache.DB_FILE) as db:
+        keys = [row[0] for row in db.execute("SELECT key FROM results ORDER BY expiry")]
+    # expired first, then the ones expiring sooner over the limit
+    assert keys == ["second", "third"]
+
+    # a new process finds them on disk
+    monkeypatch.setattr(SingletonType, "_instances", {})
+    assert VerifyCache().get("third") == RESULT
+    assert VerifyCache().get("first") is None
@@ -0,0 +1,50 @@
+from os import path, utime
+from time import time
+import pytest
+import workspace
+
+
+@pytest.fixture(autouse=True)
+def folders(tmp_path, monkeypatch):
+    monkeypatch.setattr(workspace, "UPLOAD_FOLDER", str(tmp_path / "uploads"))
+    monkeypatch.setattr(workspace, "SIGNED_FOLDER", str(tmp_path / "signed"))
+
+
+def age(job, seconds):
+    ''' Make the folders of `job` look unused for `seconds` '''
+    past = time() - seconds
+    for folder in (job.upload_folder, job.signed_folder):
+        if path.isdir(folder):
+            utime(folder, (past, past))
+
+
+def test_live_workspace_is_not_reaped():
+    job = workspace.Workspace()
+    age(job, workspace.WORKSPACE_TTL * 2)
+
+    assert workspace.WorkspaceReaper.reap() == 0
+    assert path.isdir(job.upload_folder) and path.isdir(job.signed_folder)
+    # touched for the reapers of the other processes
+    assert path.getmtime(job.upload_folder) > time() - 60
+    job.cleanup()
+
+
+def test_finished_workspace_is_reaped_after_ttl():
+    job = workspace.Workspace(keep_signed=True)
+    job.cleanup()
+    assert not path.exists(job.upload_folder)
+
+    # the signed files can still be downloaded
+    assert workspace.WorkspaceReaper.reap() == 0
+    age(job, workspace.WORKSPACE_TTL + 1)
+    assert workspace.WorkspaceReaper.reap() == 1
+    assert not path.exists(job.signed_folder)
+
+
+def test_orphan_of_another_process_is_reaped():
+    job = workspace.Workspace()
+    # a crashed process never cleans up
+    workspace._live_workspaces.pop(job.job_id)
+    age(job, workspace.WORKSPACE_TTL + 1)
+
+    assert workspace.WorkspaceReaper.reap() == 2
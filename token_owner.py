@@ -0,0 +1,182 @@
+from admission import AdmissionController
+from jobs import BatchRegistry
+from metrics import Metrics
+from multiprocessing.managers import BaseManager
+from my_logger import get_logger, log_queue, use_log_queue
+from os import getpid, urandom
+from singleton_type import SingletonType
+from threading import Lock, RLock
+from uuid import uuid4
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# set by start_token_owner(), inherited by forked HTTP workers
+TOKEN_OWNER_ADDRESS = None
+TOKEN_OWNER_AUTHKEY = None
+####################################################################
+
+
+logger = get_logger("token_owner")
+
+
+class TokenOwner(object, metaclass=SingletonType):
+    ''' Lives in the token-owner process and holds every smart card session
+
+        HTTP workers only send it digests and bytes to sign, identified by
+        the handle returned from `open()`.
+    '''
+
+    def __init__(self):
+        # held around the smart card calls, never while a PIN is asked
+        self._lock = RLock()
+        self._signers = {}
+        # user_id: Lock, one PIN request at a time for a user
+        self._pin_locks = {}
+
+    def open(self, user_id):
+        ''' Login for `user_id`
+
+            Returns:
+                the session handle and the certificate value
+        '''
+        # imported here, only the owner process needs PIN and smart card
+        from pin_manager import clear_pin
+        from sign_service import open_token_signer
+
+        signer = open_token_signer(user_id, self._user_pin, clear_pin, card_lock=self._lock)
+        handle = uuid4().hex
+        with self._lock:
+            self._signers[handle] = signer
+        return handle, signer.certificate_value
+
+    def _user_pin(self, user_id):
+        # the other users go on signing while this one types the PIN
+        from pin_manager import get_user_pin
+
+        with self._lock:
+            pin_lock = self._pin_locks.setdefault(user_id, Lock())
+        with pin_lock:
+            return get_user_pin(user_id)
+
+    def has_valid_pin(self, user_id):
+        from pin_manager import has_valid_pin
+
+        return has_valid_pin(user_id)
+
+    def sign_pdf_digest(self, handle, digest):
+        with self._lock:
+            return self._signers[handle].sign_pdf_digest(digest)
+
+    def sign_bytes(self, handle, bytes_to_sign):
+        with self._lock:
+            return self._signers[handle].sign_bytes(bytes_to_sign)
+
+    def issuer_and_serial_number(self, handle):
+        with self._lock:
+            return self._signers[handle].issuer_and_serial_number()
+
+    def close(self, handle):
+        with self._lock:
+            signer = self._signers.pop(handle, None)
+            if signer is not None:
+                signer.close()
+
+    def warm_up(self):
+        ''' Load the smart card drivers before the first login '''
+        from signature_util import SignatureUtils
+
+        SignatureUtils.preload_drivers()
+
+    # metrics of every HTTP worker are gathered here
+    def merge_metrics(self, values):
+        Metrics().merge(values)
+
+    def render_metrics(self):
+        return Metrics().render()
+
+
+class TokenOwnerManager(BaseManager):
+    pass
+
+
+TokenOwnerManager.register("token_owner", TokenOwner)
+# one admission control for every HTTP worker
+TokenOwnerManager.register("admission", AdmissionController)
+# progress events of the background batches, read by any HTTP worker
+TokenOwnerManager.register("batches", BatchRegistry)
+
+
+class RemoteTokenSigner:
+    ''' `TokenSigner` interface forwarding every call to the token-owner process '''
+
+    def __init__(self, owner, user_id):
+        self._owner = owner
+        self._handle, self.certificate_value = owner.open(user_id)
+
+    def sign_pdf_digest(self, digest):
+        return self._owner.sign_pdf_digest(self._handle, digest)
+
+    def sign_bytes(self, bytes_to_sign):
+        return self._owner.sign_bytes(self._handle, bytes_to_sign)
+
+    def issuer_and_serial_number(self):
+        return self._owner.issuer_and_serial_number(self._handle)
+
+    def close(self):
+        try:
+            self._owner.close(self._handle)
+        except:
+            logger.error("session close failed")
+
+
+def start_token_owner():
+    ''' Start the token-owner process, return its manager '''
+
+    global TOKEN_OWNER_ADDRESS, TOKEN_OWNER_AUTHKEY
+    TOKEN_OWNER_AUTHKEY = urandom(32)
+    manager = TokenOwnerManager(address=("127.0.0.1", 0), authkey=TOKEN_OWNER_AUTHKEY)
+    # its records are written by this process
+    manager.start(initializer=use_log_queue, initargs=(log_queue(),))
+    TOKEN_OWNER_ADDRESS = manager.address
+    logger.info(f"token owner process listening on {TOKEN_OWNER_ADDRESS}")
+    return manager
+
+
+_proxies = {}
+
+
+def token_owner():
+    ''' Return a proxy of the token-owner process, None when it is not running '''
+
+    if TOKEN_OWNER_ADDRESS is None:
+        return None
+    return _proxy("token_owner")
+
+
+def admission_controller():
+    ''' Return the `AdmissionController` of the token-owner process, the local one when it is not running '''
+
+    if TOKEN_OWNER_ADDRESS is None:
+        return AdmissionController()
+    return _proxy("admission")
+
+
+def batch_registry():
+    ''' Return the `BatchRegistry` of the token-owner process, the local one when it is not running '''
+
+    if TOKEN_OWNER_ADDRESS is None:
+        return BatchRegistry()
+    return _proxy("batches")
+
+
+def _proxy(typeid):
+    # connections can not be shared across forked processes
+    key = (getpid(), typeid)
+    if key not in _proxies:
+        manager = TokenOwnerManager(address=TOKEN_OWNER_ADDRESS, authkey=TOKEN_OWNER_AUTHKEY)
+        manager.connect()
+        _proxies[key] = getattr(manager, typeid)()
+    return _proxies[key]
@@ -0,0 +1,204 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import request, make_response
+from functools import wraps
+from json import dump, load
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import path, makedirs, getpid, replace
+from random import random
+from re import fullmatch
+from singleton_type import SingletonType
+from threading import Lock, get_ident
+from time import time_ns
+from uuid import uuid4
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# fraction of the /api/sign, /api/jobs and /upload requests traced
+SAMPLE_RATE = MyConfigLoader().get_tracing_config()["sample_rate"]
+# requests carrying this header are always traced, so are the ones
+# with a sampled W3C traceparent header, keeping its trace id
+HEADER = MyConfigLoader().get_tracing_config()["header"]
+# one Chrome trace event file (chrome://tracing, Perfetto) per trace
+TRACES_FOLDER = MyConfigLoader().get_tracing_config()["traces_folder"]
+####################################################################
+
+
+logger = get_logger("tracing")
+
+# (trace id, span id) of the calling thread, None when not traced
+current_trace = ContextVar("current_trace", default=None)
+
+
+class Tracer(object, metaclass=SingletonType):
+    ''' Finished spans of the traces open in this process
+
+        Pipeline worker processes `drain()` the spans of a job into the
+        job itself, the process that started the trace `merge()`s them
+        and `export()`s the whole trace.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # trace id: list of Chrome trace events
+            self._spans = {}
+
+    def add(self, trace_id, event):
+        with self._lock:
+            self._spans.setdefault(trace_id, []).append(event)
+
+    def drain(self, trace_id):
+        ''' Return the spans of `trace_id` and forget them '''
+
+        with self._lock:
+            return self._spans.pop(trace_id, [])
+
+    def merge(self, spans):
+        ''' Add the spans drained by another process '''
+
+        if not spans:
+            return
+        with self._lock:
+            for event in spans:
+                self._spans.setdefault(event["args"]["trace_id"], []).append(event)
+
+    def export(self, trace_id):
+        ''' Write the spans of `trace_id` to its trace file, added to the ones already there '''
+
+        events = self.drain(trace_id)
+        makedirs(TRACES_FOLDER, exist_ok=True)
+        file_path = path.join(TRACES_FOLDER, f"{trace_id}.json")
+        with self._lock:
+            # a background batch goes on after its request
+            if path.exists(file_path):
+                try:
+                    with open(file_path) as _file:
+                        events = load(_file)["traceEvents"] + events
+                except (OSError, ValueError, KeyError):
+                    logger.warning(f"trace file {file_path} not readable, overwritten")
+            temp_path = f"{file_path}.{uuid4().hex}.part"
+            with open(temp_path, "w") as _file:
+                dump({"traceEvents": events, "displayTimeUnit": "ms",
+                      "otherData": {"trace_id": trace_id}}, _file)
+            replace(temp_path, file_path)
+        return file_path
+
+
+@contextmanager
+def span(name, **args):
+    ''' Time the block as a child of the current span, nothing is done when not traced '''
+
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    trace_id, parent_id = trace
+    span_id = uuid4().hex[:16]
+    token = current_trace.set((trace_id, span_id))
+    start = time_ns()
+    try:
+        yield
+    finally:
+        end = time_ns()
+        current_trace.reset(token)
+        args.update({"trace_id": trace_id, "span_id": span_id, "parent_id": parent_id})
+        Tracer().add(trace_id, {"name": name, "ph": "X", "ts": start / 1000,
+                                "dur": (end - start) / 1000, "pid": getpid(),
+                                "tid": get_ident(), "args": args})
+
+
+def traced(name):
+    ''' Decorator wrapping every call in a span named `name` '''
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def trace_context(trace):
+    ''' Go on with `trace` (a `current_trace` value) in another thread or process '''
+
+    token = current_trace.set(trace)
+    try:
+        yield
+    finally:
+        current_trace.reset(token)
+
+
+@contextmanager
+def request_trace(name, trace_id=None, parent_id=None):
+    ''' Root span of a new trace, or of a new part of `trace_id`,
+        the trace file is written at the end of the block
+
+        Returns:
+            the trace id
+    '''
+
+    if trace_id is None:
+        trace_id = uuid4().hex
+    with trace_context((trace_id, parent_id)):
+        try:
+            with span(name):
+                yield trace_id
+        finally:
+            logger.info(f"trace {trace_id} written to {Tracer().export(trace_id)}")
+
+
+@contextmanager
+def background_trace(name):
+    ''' Part of the current trace going on after its request, nothing is done when not traced '''
+
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    with request_trace(name, *trace):
+        yield
+
+
+def sampled(headers):
+    ''' Returns the trace id of a request with `headers` if it must be traced, else None '''
+
+    # version-trace_id-parent_id-flags
+    traceparent = fullmatch(r"[0-9a-f]{2}-([0-9a-f]{32})-[0-9a-f]{16}-([0-9a-f]{2})",
+                            headers.get("traceparent", ""))
+    if traceparent is not None and int(traceparent.group(2), 16) & 1:
+        return traceparent.group(1)
+    if headers.get(HEADER) or (SAMPLE_RATE and random() < SAMPLE_RATE):
+        return uuid4().hex
+    return None
+
+
+def traced_request(view):
+    ''' Flask view decorator tracing the sampled requests,
+        the trace id is given back in the X-Trace-Id header
+    '''
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        trace_id = sampled(request.headers)
+        if trace_id is None:
+            return view(*args, **kwargs)
+        with request_trace(f"{request.method} {request.path}", trace_id):
+            response = make_response(view(*args, **kwargs))
+        response.headers["X-Trace-Id"] = trace_id
+        return response
+
+    return wrapper
@@ -0,0 +1,173 @@
+from asn1crypto import pem
+from collections import OrderedDict
+from hashlib import sha256
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from OpenSSL import crypto
+from os import path, listdir
+from singleton_type import SingletonType
+from threading import Lock
+from time import monotonic
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# trusted CA certificates, PEM or DER, loaded once per process
+CA_FOLDER = MyConfigLoader().get_trust_store_config()["ca_folder"]
+CA_EXTENSIONS = (".pem", ".crt", ".cer", ".der")
+# seconds a chain validation result is reused
+CACHE_TTL = MyConfigLoader().get_trust_store_config()["cache_ttl"]
+MAX_ENTRIES = MyConfigLoader().get_trust_store_config()["max_entries"]
+# stores of the CA certificates plus the ones trusted by a caller
+MAX_STORES = 32
+####################################################################
+
+
+logger = get_logger("trust_store")
+
+
+class TrustStore(object, metaclass=SingletonType):
+    ''' Trusted CA certificates of the process and chain validation cache
+
+        The CA certificates of `CA_FOLDER` are parsed once, the X509Store
+        built on them and on the certificates a caller trusts is kept, and
+        the validation result of each certificate is cached by fingerprint
+        for `CACHE_TTL` seconds: verifying many documents signed under the
+        same CA builds each chain once.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._ca_certificates = None
+        self._version = None
+        # trusted fingerprints: X509Store
+        self._stores = OrderedDict()
+        # (fingerprint, trusted fingerprints, chain fingerprints): (valid, expiry)
+        self._results = OrderedDict()
+
+    def load(self):
+        ''' Parse the CA certificates, only the first time '''
+
+        with self._lock:
+            if self._ca_certificates is None:
+                self._ca_certificates = _load_folder(CA_FOLDER)
+                self._version = sha256("".join(sorted(
+                    certificate.digest("sha256").decode() for certificate in self._ca_certificates
+                )).encode()).hexdigest()
+                logger.info(f"{len(self._ca_certificates)} trusted CA certificates loaded")
+            return self._ca_certificates
+
+    def version(self):
+        ''' Fingerprint of the set of CA certificates, it changes when they do '''
+
+        self.load()
+        return self._version
+
+    def reload(self):
+        ''' Read `CA_FOLDER` again and forget every cached result '''
+
+        with self._lock:
+            self._ca_certificates = None
+            self._stores.clear()
+            self._results.clear()
+        self.load()
+
+    def verify_certificate(self, certificate_value, trusted=(), chain=()):
+        ''' Validate the chain of trust of a certificate
+
+            Param:
+                certificate_value: DER certificate
+                trusted: DER certificates trusted besides the CA ones
+                chain: untrusted DER certificates to build the chain with
+
+            Returns:
+                True when the certificate is valid
+        '''
+
+        trusted = tuple(bytes(cert) for cert in trusted)
+        trusted_key = frozenset(fingerprint(cert) for cert in trusted)
+        key = (fingerprint(certificate_value), trusted_key,
+               frozenset(fingerprint(cert) for cert in chain))
+        now = monotonic()
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None and result[1] > now:
+                self._results.move_to_end(key)
+                return result[0]
+
+        store = self._store(trusted_key, trusted)
+        context = crypto.X509StoreContext(
+            store, _load_certificate(certificate_value),
+            [_load_certificate(cert) for cert in chain])
+        try:
+            context.verify_certificate()
+            valid = True
+        except crypto.X509StoreContextError as err:
+            logger.info(f"certificate {key[0][:16]} not valid: {err}")
+            valid = False
+
+        with self._lock:
+            self._results[key] = (valid, now + CACHE_TTL)
+            self._results.move_to_end(key)
+            while len(self._results) > MAX_ENTRIES:
+                self._results.popitem(last=False)
+        return valid
+
+    def _store(self, trusted_key, trusted):
+        ''' X509Store of the CA certificates and `trusted` '''
+
+        ca_certificates = self.load()
+        with self._lock:
+            store = self._stores.get(trusted_key)
+            if store is not None:
+                self._stores.move_to_end(trusted_key)
+                return store
+
+        # X509Store cannot be copied, adding parsed certificates is cheap
+        store = crypto.X509Store()
+        for certificate in ca_certificates:
+            store.add_cert(certificate)
+        for cert in trusted:
+            store.add_cert(_load_certificate(cert))
+
+        with self._lock:
+            self._stores[trusted_key] = store
+            while len(self._stores) > MAX_STORES:
+                self._stores.popitem(last=False)
+        return store
+
+
+def fingerprint(certificate_value):
+    ''' SHA-256 fingerprint of a DER certificate '''
+    return sha256(bytes(certificate_value)).hexdigest()
+
+
+def _load_certificate(certificate_value):
+    return crypto.load_certificate(crypto.FILETYPE_ASN1, bytes(certificate_value))
+
+
+def _load_folder(folder):
+    ''' Parse the certificates of `folder`, the unreadable ones are skipped '''
+
+    if not path.isdir(folder):
+        logger.info(f"no trusted CA folder {folder}")
+        return []
+
+    certificates = []
+    for name in sorted(listdir(folder)):
+        if not name.lower().endswith(CA_EXTENSIONS):
+            continue
+        try:
+            with open(path.join(folder, name), "rb") as _file:
+                content = _file.read()
+            if pem.detect(content):
+                # a PEM file may hold a whole bundle
+                for _, _, der in pem.unarmor(content, multiple=True):
+                    certificates.append(_load_certificate(der))
+            else:
+                certificates.append(_load_certificate(content))
+        except Exception as err:
+            logger.warning(f"CA certificate {name} skipped: {err.__class__.__name__} {err}")
+    return certificates
@@ -1,35 +1,43 @@
 # *-* coding: utf-8 *-*
 import hashlib
 
+from functools import lru_cache
 from OpenSSL import crypto
 from asn1crypto import x509, core, pem, cms
+from crl_cache import CrlCache
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from my_logger import get_logger
+from tracing import traced
+from trust_store import TrustStore
+from verify_cache import VerifyCache
+
+
+logger = get_logger("verifier")
 
 
 class VerifyData(object):
+    ''' Verification of CMS signatures, certificates are validated against
+        the process `TrustStore` and the `trustedCerts` (DER)
+    '''
 
     def __init__(self, trustedCerts=None):
-        self.store = crypto.X509Store()
+        self.trusted = []
         if trustedCerts is not None:
             for cert in trustedCerts:
-                cert = crypto.load_certificate(crypto.FILETYPE_ASN1, bytes(cert))
                 self.add_cert(cert)
 
     def add_cert(self, trusted_cert):
-        self.store.add_cert(trusted_cert)
-
-    def verify_cert(self, cert_pem):
-        certificate = crypto.load_certificate(crypto.FILETYPE_PEM, cert_pem)
-        # Create a X590StoreContext with the cert and trusted certs
-        # and verify the the chain of trust
-        store_ctx = crypto.X509StoreContext(self.store, certificate)
-        # Returns None if certificate can be validated
+        self.trusted.append(bytes(trusted_cert))
+
+    def verify_cert(self, cert_der, chain=()):
+        ''' Validate the chain of trust of `cert_der`, with the untrusted certificates of `chain` '''
+
         try:
-            result = store_ctx.verify_certificate()
+            return TrustStore().verify_certificate(cert_der, self.trusted, chain)
         except:
-            result = False
-        return result is None
+            return False
 
     def _load_cert(self, relative_path):
         with open(relative_path, 'rb') as f:
@@ -38,14 +46,58 @@ class VerifyData(object):
                 _, _, cert_bytes = pem.unarmor(cert_bytes)
             return x509.Certificate.load(cert_bytes)
 
-    def verify(self, datas, datau):
+    @traced("verifier.verify_signature")
+    def verify(self, datas, datau, digest=None):
+        ''' Verify the CMS signature `datas` of `datau`, or of the data with `digest`
+
+            Returns:
+                one result per SignerInfo: the co-signatures of a parallel
+                p7m are all checked
+        '''
+
         signed_data = cms.ContentInfo.load(datas)['content']
         # signed_data.debug()
 
-        signature = signed_data['signer_infos'][0].native['signature']
-        algo = signed_data['digest_algorithms'][0]['algorithm'].native
-        attrs = signed_data['signer_infos'][0]['signed_attrs']
-        mdData = getattr(hashlib, algo)(datau).digest()
+        revocation = None
+        if CrlCache().enabled:
+            revocation = self.verify_revocation(
+                signed_data['certificates'], [cert.dump() for cert in signed_data['certificates']])
+
+        # algorithm: digest of the data, shared by the signers using it
+        digests = {}
+        results = []
+        for number, signer_info in enumerate(signed_data['signer_infos']):
+            algo = signer_info['digest_algorithm']['algorithm'].native
+            if digest is not None:
+                mdData = digest
+            else:
+                if algo not in digests:
+                    digests[algo] = getattr(hashlib, algo)(datau).digest()
+                mdData = digests[algo]
+
+            result = cache_key = None
+            if VerifyCache().enabled:
+                cache_key = VerifyCache.key(bytes(datas), mdData, self.trusted, TrustStore().version(),
+                                            signer=number)
+                result = VerifyCache().get(cache_key)
+            if result is None:
+                result = self._verify(signed_data, signer_info, datau, mdData, algo)
+                if cache_key is not None:
+                    VerifyCache().put(cache_key, result, signer_not_after(signed_data, signer_info))
+
+            if CrlCache().enabled:
+                result['revocationok?'] = revocation
+            results.append(result)
+        return results
+
+    def _verify(self, signed_data, signer_info, datau, mdData, algo):
+        ''' Hash, signature and certificate checks of one `signer_info` of `signed_data`,
+            `mdData` is the digest of the data
+        '''
+
+        signature = signer_info['signature'].native
+        attrs = signer_info['signed_attrs']
+        hash_algorithm = getattr(hashes, algo.upper())()
         if attrs is not None and not isinstance(attrs, core.Void):
             mdSigned = None
             for attr in attrs:
@@ -53,42 +105,113 @@ class VerifyData(object):
                     mdSigned = attr['values'].native[0]
             signedData = attrs.dump()
             signedData = b'\x31' + signedData[1:]
+        elif datau is None:
+            # no signed attributes, the digest itself is signed
+            mdSigned = mdData
+            signedData = mdData
+            hash_algorithm = Prehashed(hash_algorithm)
         else:
             mdSigned = mdData
             signedData = datau
         hashok = mdData == mdSigned
-        serial = signed_data['signer_infos'][0]['sid'].native['serial_number']
-        public_key = None
-        for cert in signed_data['certificates']:
-            if serial == cert.native['tbs_certificate']['serial_number']:
-                cert = cert.dump()
-                cert = pem.armor(u'CERTIFICATE', cert)
-                public_key = crypto.load_certificate(crypto.FILETYPE_PEM, cert).get_pubkey().to_cryptography_key()
-                break
+        certificates = [cert.dump() for cert in signed_data['certificates']]
+        signer_certificate = certificate_index(signed_data['certificates']).get(signer_key(signer_info['sid']))
+        public_key = None if signer_certificate is None else certificate_public_key(signer_certificate)
 
         try:
             public_key.verify(
                 signature,
                 signedData,
                 padding.PKCS1v15(),
-                getattr(hashes, algo.upper())()
+                hash_algorithm
             )
             signatureok = True
         except:
             signatureok = False
 
-        # TODO verify certificates
-        certok = True
-        for cert in signed_data['certificates']:
-            scert = pem.armor(u'CERTIFICATE', cert.dump()).decode()
-            if not self.verify_cert(scert):
-                print('*' * 10, 'failed certificate verification')
-                print('cert.issuer:', cert.native['tbs_certificate']['issuer'])
-                print('cert.subject:', cert.native['tbs_certificate']['subject'])
-                certok = False
+        # the other embedded certificates are the intermediates
+        certok = False
+        if signer_certificate is not None:
+            chain = [other for other in certificates if other != signer_certificate]
+            certok = self.verify_cert(signer_certificate, chain)
+            if not certok:
+                cert = x509.Certificate.load(signer_certificate)
+                logger.warning(f"failed certificate verification, issuer: {cert.issuer.human_friendly}"
+                               f", subject: {cert.subject.human_friendly}")
         return {'hashok?': hashok, 'signatureok?': signatureok, 'certok?': certok}
 
+    def verify_revocation(self, certificates, chain):
+        ''' Revocation status of the CMS `certificates` in the CRL cache, `chain` are their DER
+
+            Returns:
+                False when one is revoked, None when one has no up to date CRL, else True
+        '''
+
+        status = True
+        for cert in certificates:
+            if cert.name != 'certificate' or cert.chosen.self_signed != 'no':
+                continue
+            revocation = CrlCache().check(cert.chosen, chain)
+            if revocation is False:
+                logger.warning(f"revoked certificate, subject: {cert.chosen.subject.human_friendly}"
+                               f", serial number: {cert.chosen.serial_number}")
+                return False
+            if revocation is None:
+                status = None
+        return status
+
+
+def signer_not_after(signed_data, signer_info):
+    ''' Expiry timestamp of the certificate of `signer_info`, None when it is missing '''
+
+    signer_certificate = certificate_index(signed_data['certificates']).get(signer_key(signer_info['sid']))
+    if signer_certificate is None:
+        return None
+    validity = x509.Certificate.load(signer_certificate)['tbs_certificate']['validity']
+    return validity['not_after'].native.timestamp()
+
+
+def certificate_index(certificates):
+    ''' DER of the CMS `certificates` by (issuer, serial number) and by
+        ("ski", subject key identifier), only the fields needed are parsed
+    '''
+
+    index = {}
+    for cert in certificates:
+        if cert.name != 'certificate':
+            continue
+        cert = cert.chosen
+        tbs = cert['tbs_certificate']
+        cert_der = cert.dump()
+        index[(tbs['issuer'].hashable, tbs['serial_number'].native)] = cert_der
+        if cert.key_identifier is not None:
+            index[('ski', cert.key_identifier)] = cert_der
+    return index
+
+
+def signer_key(sid):
+    ''' `certificate_index()` key of the certificate of a signer identifier '''
+
+    if sid.name == 'issuer_and_serial_number':
+        return (sid.chosen['issuer'].hashable, sid.chosen['serial_number'].native)
+    return ('ski', sid.chosen.native)
+
+
+@lru_cache(maxsize=256)
+def certificate_public_key(cert_der):
+    ''' Public key of a DER certificate, kept for the signatures made with the same certificate '''
+    return crypto.load_certificate(crypto.FILETYPE_ASN1, cert_der).get_pubkey().to_cryptography_key()
+
 
 def verify(datas, datau, certs):
+    ''' Verify the CMS signature `datas` of `datau`, one result per signer '''
     cls = VerifyData(certs)
     return cls.verify(datas, datau)
+
+
+def verify_digest(datas, digest, certs):
+    ''' Verify the CMS signature `datas` of the data with `digest`, the data is not needed,
+        one result per signer
+    '''
+    cls = VerifyData(certs)
+    return cls.verify(datas, None, digest)
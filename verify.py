@@ -1,32 +1,66 @@
 # *-* coding: utf-8 *-*
+from asn1crypto import cms, pem
+from tracing import traced
 import verifier
 
 
+@traced("verify.verify")
 def verify(pdfdata, certs=None):
     '''
         Return the Hash, Signature and Cert verification result for each signature in the pdf
 
         Params:
-            pdfdata: Pdf content as bytes
+            pdfdata: Pdf content as bytes, or a memory map of the file
             certs: List of certificates
     '''
     verifier_results = []
-    n = 0
-    byte_ranges_count = pdfdata.count(b'/ByteRange')
-    for i in range(byte_ranges_count):
-        n = pdfdata.find(b'/ByteRange', n)
+    n = pdfdata.find(b'/ByteRange')
+    while n != -1:
         start = pdfdata.find(b'[', n)
         stop = pdfdata.find(b']', start)
-        assert n != -1 and start != -1 and stop != -1
+        assert start != -1 and stop != -1
         br = [int(i, 10) for i in pdfdata[start + 1:stop].split()]
         contents = pdfdata[br[0] + br[1] + 1:br[2] - 1]
-        data = []
-        for i in range(0, len(contents), 2):
-            data.append(int(contents[i:i + 2], 16))
-        bcontents = bytes(data)
+        bcontents = bytes.fromhex(contents.decode('ascii'))
         data1 = pdfdata[br[0]: br[0] + br[1]]
         data2 = pdfdata[br[2]: br[2] + br[3]]
         signedData = data1 + data2
-        verifier_results.append(verifier.verify(bcontents, signedData, certs))
-        n = stop
+        verifier_results += verifier.verify(bcontents, signedData, certs)
+        n = pdfdata.find(b'/ByteRange', stop)
     return verifier_results
+
+
+@traced("verify.verify_p7m")
+def verify_p7m(p7mdata, certs=None):
+    '''
+        Return the Hash, Signature and Cert verification result for each signer of
+        each level of a p7m, the outer one first: a p7m of a p7m is signed twice,
+        a p7m signed in parallel has more signers on the same level
+
+        Params:
+            p7mdata: p7m content as bytes (DER or PEM), or a memory map of the file
+            certs: List of certificates
+    '''
+    verifier_results = []
+    datas = bytes(p7mdata)
+    while True:
+        if pem.detect(datas):
+            _, _, datas = pem.unarmor(datas)
+        content_info = cms.ContentInfo.load(datas)
+        if content_info['content_type'].native != 'signed_data':
+            break
+        content = content_info['content']['encap_content_info']['content']
+        if content.native is None:
+            raise ValueError("detached p7m, the signed content is missing")
+        datau = content.native
+        verifier_results += verifier.verify(datas, datau, certs)
+        if not _is_p7m(datau):
+            break
+        datas = datau
+    return verifier_results
+
+
+def _is_p7m(data):
+    ''' Whether `data` looks like a CMS signed data, DER or PEM '''
+    return data[:1] == b'\x30' and b'\x06\x09\x2a\x86\x48\x86\xf7\x0d\x01\x07\x02' in data[:32] \
+        or pem.detect(data[:64])
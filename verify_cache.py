@@ -0,0 +1,148 @@
+from collections import OrderedDict
+from hashlib import sha256
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import path, makedirs, getpid
+from singleton_type import SingletonType
+from threading import Lock
+from time import time
+import sqlite3
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+ENABLED = MyConfigLoader().get_verify_cache_config()["enabled"]
+# results kept in memory, least recently used evicted first
+MAX_ENTRIES = MyConfigLoader().get_verify_cache_config()["max_entries"]
+# seconds a result is reused, certificates expire
+TTL = MyConfigLoader().get_verify_cache_config()["ttl"]
+# certok? is a chain validation, not kept longer than the trust store keeps it
+TRUST_STORE_TTL = MyConfigLoader().get_trust_store_config()["cache_ttl"]
+# sqlite backing shared by every process, survives restarts
+PERSISTENT = MyConfigLoader().get_verify_cache_config()["persistent"]
+CACHE_FOLDER = MyConfigLoader().get_verify_cache_config()["cache_folder"]
+DB_FILE = path.join(CACHE_FOLDER, "verify_cache.sqlite3")
+MAX_DISK_ENTRIES = MyConfigLoader().get_verify_cache_config()["max_disk_entries"]
+# puts between two clean-ups of the sqlite backing
+PRUNE_EVERY = 1000
+# the cached fields, 'revocationok?' changes with the CRLs and is not kept
+FIELDS = ('hashok?', 'signatureok?', 'certok?')
+####################################################################
+
+
+logger = get_logger("verify_cache")
+
+
+class VerifyCache(object, metaclass=SingletonType):
+    ''' Verification results of CMS signatures
+
+        A signature is verified once: the same CMS over the same bytes,
+        checked against the same trusted certificates, gets back the
+        hashok?, signatureok? and certok? found the first time.
+    '''
+
+    def __init__(self):
+        self.enabled = ENABLED
+        self._lock = Lock()
+        # key: (result, expiry)
+        self._results = OrderedDict()
+        self._db = None
+        self._db_pid = None
+        self._puts = 0
+
+    @staticmethod
+    def key(signature, digest, trusted, trust_store_version, signer=0):
+        ''' Cache key of the CMS `signature` of the bytes with `digest`,
+            verified with the `trusted` DER certificates, for its SignerInfo
+            number `signer`
+        '''
+
+        key = sha256(sha256(signature).digest())
+        key.update(digest)
+        if signer:
+            key.update(b"signer %d" % signer)
+        for fingerprint in sorted(sha256(cert).hexdigest() for cert in trusted):
+            key.update(fingerprint.encode())
+        key.update(trust_store_version.encode())
+        return key.hexdigest()
+
+    def get(self, key):
+        ''' Return the result of `key`, None when missing or expired '''
+
+        if not self.enabled:
+            return None
+        now = time()
+        with self._lock:
+            item = self._results.get(key)
+            if item is not None and item[1] > now:
+                self._results.move_to_end(key)
+                return dict(item[0])
+        if not PERSISTENT:
+            return None
+
+        row = self._execute("SELECT hashok, signatureok, certok, expiry FROM results WHERE key = ?",
+                            (key,), fetch=True)
+        if row is None or row[3] <= now:
+            return None
+        result = dict(zip(FIELDS, (bool(value) for value in row[:3])))
+        self._remember(key, result, row[3])
+        return dict(result)
+
+    def put(self, key, result, not_after=None):
+        ''' Keep `result` until the TTLs expire, or the signer certificate
+            does at the `not_after` timestamp
+        '''
+
+        if not self.enabled:
+            return
+        now = time()
+        expiry = now + min(TTL, TRUST_STORE_TTL)
+        if not_after is not None:
+            expiry = min(expiry, not_after)
+        if expiry <= now:
+            return
+        result = {field: result[field] for field in FIELDS}
+        self._remember(key, result, expiry)
+        if not PERSISTENT:
+            return
+
+        self._execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                      (key, *(int(result[field]) for field in FIELDS), expiry))
+        self._puts += 1
+        if self._puts % PRUNE_EVERY == 0:
+            self._execute("DELETE FROM results WHERE expiry <= ?", (time(),))
+            self._execute("DELETE FROM results WHERE key IN (SELECT key FROM results "
+                          "ORDER BY expiry DESC LIMIT -1 OFFSET ?)", (MAX_DISK_ENTRIES,))
+
+    def _remember(self, key, result, expiry):
+        with self._lock:
+            self._results[key] = (result, expiry)
+            self._results.move_to_end(key)
+            while len(self._results) > MAX_ENTRIES:
+                self._results.popitem(last=False)
+
+    def _execute(self, statement, parameters, fetch=False):
+        ''' Run `statement` on the sqlite backing, errors only make the cache miss '''
+
+        try:
+            with self._lock:
+                db = self._connection()
+                with db:
+                    cursor = db.execute(statement, parameters)
+                    return cursor.fetchone() if fetch else None
+        except sqlite3.Error as err:
+            logger.warning(f"verify cache: {err.__class__.__name__} {err}")
+            return None
+
+    def _connection(self):
+        # a connection is not shared with a forked process
+        if self._db is None or self._db_pid != getpid():
+            makedirs(CACHE_FOLDER, exist_ok=True)
+            self._db = sqlite3.connect(DB_FILE, timeout=5, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, hashok INTEGER, "
+                             "signatureok INTEGER, certok INTEGER, expiry REAL)")
+            self._db_pid = getpid()
+        return self._db
@@ -0,0 +1,128 @@
+from bulk_verify import verify_file
+from concurrent.futures import ProcessPoolExecutor
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger, log_queue, use_log_queue
+from os import path
+from singleton_type import SingletonType
+from threading import Lock
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# verification processes of each HTTP worker, apart from the signing pipeline
+API_WORKERS = MyConfigLoader().get_verify_config()["api_workers"]
+# user tips
+INVALID_VERIFY_REQUEST = "Richiesta di verifica non valida, contatta l'amministratore di sistema"
+NOTHING_TO_VERIFY = "Nessun file da verificare"
+####################################################################
+
+
+logger = get_logger("verify_service")
+
+
+# custom exceptions
+class VerifyRequestError(Exception):
+    ''' Raised when a verify request can not be served, carries the HTTP error response fields '''
+
+    def __init__(self, error_message, user_tip, status):
+        super().__init__(error_message, user_tip, status)
+        self.error_message = error_message
+        self.user_tip = user_tip
+        self.status = status
+
+    def __str__(self):
+        return self.error_message
+
+
+class VerifyPool(object, metaclass=SingletonType):
+    ''' Process pool of the signature verifications
+
+        Kept apart from the pipeline processes: verifications never wait
+        behind the files prepared for the smart card, nor delay them.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pool = None
+
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                logger.info(f"starting {API_WORKERS} verification processes")
+                self._pool = ProcessPoolExecutor(max_workers=API_WORKERS, initializer=_worker_init,
+                                                 initargs=(log_queue(),))
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+                self._pool = None
+
+
+class VerifyService:
+    ''' Verification of signed pdf and p7m documents, used by /api/verify '''
+
+    @staticmethod
+    def check_request(json_request):
+        ''' Check for a well formed request JSON. Raise a `VerifyRequestError`
+
+            Returns:
+                the paths of the files to verify
+        '''
+
+        if not json_request or not isinstance(json_request.get("file_list"), list) \
+                or not json_request["file_list"]:
+            raise VerifyRequestError("missing or empty file_list field", INVALID_VERIFY_REQUEST, 404)
+
+        file_paths = []
+        for json_file in json_request["file_list"]:
+            if not isinstance(json_file, dict) or "file" not in json_file:
+                raise VerifyRequestError("missing file field", INVALID_VERIFY_REQUEST, 404)
+            if not path.isfile(json_file["file"]):
+                raise VerifyRequestError(f"{json_file['file']} is not a file", NOTHING_TO_VERIFY, 404)
+            file_paths.append(json_file["file"])
+        return file_paths
+
+    @staticmethod
+    def verify_files(file_paths):
+        ''' Verify the server files `file_paths`, each one in a verification process
+
+            Returns:
+                a list of {file, type, bytes, valid, signatures, error, seconds}
+        '''
+
+        futures = [VerifyPool().pool().submit(verify_file, file_path) for file_path in file_paths]
+        return [_report(future.result()) for future in futures]
+
+    @staticmethod
+    def verify_documents(documents):
+        ''' Verify the uploaded `documents`, (file name, file path) pairs:
+            only the paths are sent to the verification processes
+
+            Returns:
+                a list of {file, type, bytes, valid, signatures, error, seconds},
+                file is the uploaded file name
+        '''
+
+        futures = [VerifyPool().pool().submit(verify_file, file_path, file_name)
+                   for file_name, file_path in documents]
+        return [_report(future.result()) for future in futures]
+
+
+def _report(result):
+    # revocation is reported even when not checked, as null
+    for signature in result["signatures"]:
+        signature.setdefault("revocationok?", None)
+    return result
+
+
+def _worker_init(log_queue):
+    use_log_queue(log_queue)
+    # trust store and CRLs loaded once per process, before the first request
+    from crl_cache import CrlCache
+    from trust_store import TrustStore
+    TrustStore().load()
+    CrlCache().load()
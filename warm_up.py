@@ -0,0 +1,65 @@
+from importlib import import_module
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from threading import Thread
+from time import perf_counter
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# preload in background once the server port is bound
+ENABLED = MyConfigLoader().get_server_config()["warm_up"]
+# otherwise loaded by the first sign request
+MODULES = ("digiSign_lib", "pdf_builder", "pdf_signer", "p7m_encoder", "signature_util",
+           "verifier", "requests")
+####################################################################
+
+
+logger = get_logger("warm_up")
+
+
+def warm_up(token_owner=None):
+    ''' Load what the first sign request would: libraries, crypto backends,
+        font, trusted CA certificates, CRLs, smart card drivers and pipeline processes
+
+        Param:
+            token_owner: proxy of the token-owner process, it loads the
+                drivers when given
+    '''
+
+    start = perf_counter()
+    for name in MODULES:
+        import_module(name)
+    # crypto backends
+    from cryptography.hazmat.backends import default_backend
+    default_backend()
+    import_module("pdf_builder").font_stream()
+    import_module("trust_store").TrustStore().load()
+    import_module("crl_cache").CrlCache().load()
+
+    if token_owner is None:
+        import_module("signature_util").SignatureUtils.preload_drivers()
+    else:
+        token_owner.warm_up()
+
+    # forked now, the pipeline processes inherit everything loaded above
+    from sign_pipeline import StagePools
+    StagePools().start_cpu_workers()
+    logger.info(f"warm-up completed in {perf_counter() - start:.2f}s")
+
+
+def start_warm_up(token_owner=None):
+    ''' `warm_up()` in a background thread, when enabled '''
+
+    if not ENABLED:
+        return
+    Thread(target=_run, args=(token_owner,), name="warm-up", daemon=True).start()
+
+
+def _run(token_owner):
+    try:
+        warm_up(token_owner)
+    except Exception as err:
+        logger.warning(f"warm-up failed: {err.__class__.__name__} {err}")
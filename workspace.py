@@ -0,0 +1,139 @@
+from my_config_loader import MyConfigLoader
+from my_logger import get_logger
+from os import path, makedirs, listdir, remove, utime
+from shutil import rmtree
+from singleton_type import SingletonType
+from threading import Event, Lock, Thread
+from time import time
+from uuid import uuid4
+
+
+
+####################################################################
+#       CONFIGURATION                                              #
+####################################################################
+# mapped directories
+UPLOAD_FOLDER = MyConfigLoader().get_server_config()["uploaded_file_folder"]
+SIGNED_FOLDER = MyConfigLoader().get_server_config()["signed_file_folder"]
+# seconds before an abandoned workspace is removed
+WORKSPACE_TTL = MyConfigLoader().get_server_config()["workspace_ttl"]
+# seconds between two reaper runs
+REAPER_INTERVAL = MyConfigLoader().get_server_config()["reaper_interval"]
+####################################################################
+
+
+logger = get_logger("workspace")
+
+# workspaces of the jobs running in this process, by job id
+_live_workspaces = {}
+_live_lock = Lock()
+
+
+class Workspace:
+    ''' Private upload and signed folders of a single signing job
+
+        A workspace is live from its creation to its cleanup: the reaper
+        never removes it, and touches its folders so the reapers of the
+        other processes see it as recent.
+
+        Param:
+            keep_signed: leave the signed folder in place on cleanup
+                (web downloads), the reaper removes it `WORKSPACE_TTL`
+                seconds after the job is over
+    '''
+
+    def __init__(self, keep_signed=False):
+        self.job_id = uuid4().hex
+        self.keep_signed = keep_signed
+        self.upload_folder = path.join(UPLOAD_FOLDER, self.job_id)
+        self.signed_folder = path.join(SIGNED_FOLDER, self.job_id)
+        makedirs(self.upload_folder)
+        makedirs(self.signed_folder)
+        with _live_lock:
+            _live_workspaces[self.job_id] = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+    def cleanup(self):
+        ''' Remove the job folders, the job is over '''
+        with _live_lock:
+            _live_workspaces.pop(self.job_id, None)
+        rmtree(self.upload_folder, ignore_errors=True)
+        if not self.keep_signed:
+            rmtree(self.signed_folder, ignore_errors=True)
+        else:
+            # the download time starts now
+            self.touch()
+
+    def touch(self):
+        ''' Mark the job folders as recently used, on every stage transition '''
+        for folder in (self.upload_folder, self.signed_folder):
+            try:
+                utime(folder)
+            except OSError:
+                pass
+
+
+class WorkspaceReaper(object, metaclass=SingletonType):
+    ''' Background removal of workspaces not used for `WORKSPACE_TTL` seconds
+
+        Every process creating workspaces runs a reaper: it touches its
+        live workspaces each `REAPER_INTERVAL` seconds, so they are never
+        found expired by the reapers of the other processes.
+    '''
+
+    def __init__(self):
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="workspace-reaper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.reap()
+            self._stop.wait(REAPER_INTERVAL)
+
+    @staticmethod
+    def reap():
+        ''' Remove orphan workspaces, return how many were removed '''
+
+        with _live_lock:
+            live_workspaces = list(_live_workspaces.values())
+        for workspace in live_workspaces:
+            workspace.touch()
+        live = set(workspace.job_id for workspace in live_workspaces)
+
+        removed = 0
+        expired = time() - WORKSPACE_TTL
+        for folder in (UPLOAD_FOLDER, SIGNED_FOLDER):
+            if not path.isdir(folder):
+                continue
+            for name in listdir(folder):
+                if name in live:
+                    continue
+                job_folder = path.join(folder, name)
+                try:
+                    if path.getmtime(job_folder) < expired:
+                        if path.isdir(job_folder):
+                            rmtree(job_folder)
+                        else:
+                            remove(job_folder)
+                        removed += 1
+                except FileNotFoundError:
+                    # removed by the reaper of another process
+                    pass
+                except OSError:
+                    logger.warning(f"can not reap {job_folder}")
+        if removed:
+            logger.info(f"reaped {removed} orphan workspaces")
+        return removed
@@ -0,0 +1,69 @@
+from collections import namedtuple
+from struct import pack
+from time import localtime
+from zlib import compressobj, crc32, DEFLATED, Z_DEFAULT_COMPRESSION
+
+
+
+# deflated member data, can be written again in any archive under any name
+CompressedMember = namedtuple("CompressedMember", ["crc", "size", "data", "date_time"])
+
+
+def compress(data, date_time=None):
+    ''' Deflate `data` once for `zip_stream`
+
+        Param:
+            date_time: modification time of the member, seconds since the
+                epoch, now when missing
+    '''
+
+    if isinstance(data, str):
+        data = data.encode()
+    compressor = compressobj(Z_DEFAULT_COMPRESSION, DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return CompressedMember(crc32(data), len(data), compressed, date_time)
+
+
+def zip_stream(members):
+    ''' Build a ZIP archive on the fly
+
+        Param:
+            members: iterable of (archive name, bytes, str or
+                `CompressedMember`), consumed lazily
+
+        Returns:
+            a generator of the archive chunks, one per member plus the
+            central directory, the archive is never kept whole in memory
+    '''
+
+    central_directory = []
+    offset = 0
+    for arcname, data in members:
+        member = data if isinstance(data, CompressedMember) else compress(data)
+        if offset + member.size + len(member.data) > 0xFFFFFFFF:
+            raise ValueError("archive too large, zip64 not supported")
+        name = arcname.encode()
+        dos_time, dos_date = _dos_date_time(member.date_time)
+        # sizes and crc are known, no data descriptor is needed
+        fields = pack("<HHHHHIII", 20, 0x0800, 8, dos_time, dos_date,
+                      member.crc, len(member.data), member.size)
+        header = pack("<I", 0x04034B50) + fields + pack("<HH", len(name), 0) + name
+        yield header + member.data
+        central_directory.append(
+            pack("<IH", 0x02014B50, 20) + fields
+            + pack("<HHHHHII", len(name), 0, 0, 0, 0, 0, offset) + name)
+        offset += len(header) + len(member.data)
+
+    directory = b''.join(central_directory)
+    count = len(central_directory)
+    yield directory + pack("<IHHHHIIH", 0x06054B50, 0, 0, count, count,
+                           len(directory), offset, 0)
+
+
+def _dos_date_time(date_time):
+    moment = localtime(date_time)
+    # MS-DOS dates start in 1980
+    year = max(moment.tm_year, 1980) - 1980
+    dos_time = (moment.tm_hour << 11) | (moment.tm_min << 5) | (moment.tm_sec // 2)
+    dos_date = (year << 9) | (moment.tm_mon << 5) | moment.tm_mday
+    return dos_time, dos_date